@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness of the rewarding app.
+
+Synthetic communities are generated in test databases created the same way
+as the test runner does, then the main rewarding operations are timed and
+their queries counted. Results are printed as JSON, so that runs on two
+commits can be compared. Usage:
+
+    python benchmarks.py [--operators 10] [--members 100000] [--coupons 20]
+                         [--samples 200] [--seed 0] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import math
+import random
+import subprocess
+
+sys.path.append("/home/libran/virtualenv/lib/python2.7/site-packages")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+from django.conf import settings
+from django.core import mail
+from django.db import connections
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+from django.core.management import call_command
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.accesscontrol.models import Member
+from ikwen.core.models import Service
+from ikwen.core.utils import add_database
+
+from ikwen.rewarding.models import Coupon, CRBillingPlan, CROperatorProfile, CRProfile, CumulatedCoupon, \
+    CouponSummary, CouponPurge, JoinRewardPack, ReferralRewardPack, PaymentRewardPack, Reward, run_coupon_purge, \
+    bump_coupon_catalogue_version
+from ikwen.rewarding.utils import QueryCounter, reward_member, use_coupon, donate_coupon, open_coupon_ledger
+
+from ikwen.rewarding import reward_crons
+
+BASE_SERVICE_ID = '56eb6d04b37b3379b531b102'  # Service of the test fixtures cloned for each community
+DB_PREFIX = 'test_rewarding_bench_'
+CHUNK_SIZE = 1000
+PAYMENT_INTERVALS = ((0, 5000), (5000, 15000), (15000, 50000))
+
+
+def make_id(*numbers):
+    """
+    Builds a deterministic ObjectId out of up to 3 numbers, so
+    that synthetic objects can be referenced without reading them back.
+    """
+    numbers = (list(numbers) + [0, 0])[:3]
+    return '%08x%08x%08x' % tuple(numbers)
+
+
+def get_umbrella_aliases():
+    """
+    Objects shared by all services are looked up either in the 'default'
+    or in the UMBRELLA database depending on the module, so they are
+    written in both when those are distinct.
+    """
+    if UMBRELLA in settings.DATABASES and UMBRELLA != 'default':
+        return ['default', UMBRELLA]
+    return ['default']
+
+
+def bulk_insert(model, obj_list, *aliases):
+    for alias in aliases:
+        for i in range(0, len(obj_list), CHUNK_SIZE):
+            model.objects.using(alias).bulk_create(obj_list[i:i + CHUNK_SIZE])
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0
+    rank = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+class Recorder(object):
+    """
+    Collects the duration and query counts of each call of an operation.
+    Queries are counted on the collections of the Mongo engine by QueryCounter,
+    in the current process only: operations must not fork workers.
+    """
+    def __init__(self):
+        self.samples = {}
+
+    def measure(self, name, func, *args, **kwargs):
+        with QueryCounter() as counter:
+            result = func(*args, **kwargs)
+        self.samples.setdefault(name, []).append((counter.duration, counter.queries))
+        return result
+
+    def report(self):
+        results = {}
+        for name, samples in self.samples.items():
+            durations = sorted([duration * 1000 for duration, queries in samples])
+            totals = [sum(queries.values()) for duration, queries in samples]
+            aliases = {}
+            for duration, queries in samples:
+                for alias, count in queries.items():
+                    aliases[alias] = aliases.get(alias, 0) + count
+            n = len(samples)
+            results[name] = {
+                'count': n,
+                'mean_ms': round(sum(durations) / n, 3),
+                'p50_ms': round(percentile(durations, 50), 3),
+                'p95_ms': round(percentile(durations, 95), 3),
+                'p99_ms': round(percentile(durations, 99), 3),
+                'max_ms': round(durations[-1], 3),
+                'mean_queries': round(float(sum(totals)) / n, 2),
+                'max_queries': max(totals),
+                'mean_queries_by_alias': dict([(alias, round(float(count) / n, 2))
+                                               for alias, count in aliases.items()])
+            }
+        return results
+
+
+def generate_community(index, plan, member_count, coupon_count, rng):
+    """
+    Creates a Service with its own database, an active CROperatorProfile,
+    member_count Members with their CRProfile, coupon_count approved Coupons
+    with their Join, Referral and Payment reward packs and a cumulated
+    balance for about 10% of Members on each Coupon.
+
+    :return: tuple (service, member_ids, coupon_list)
+    """
+    umbrella_aliases = get_umbrella_aliases()
+    db = '%s%d' % (DB_PREFIX, index)
+    add_database(db)
+    service = Service.objects.using(UMBRELLA).get(pk=BASE_SERVICE_ID)
+    service.id = make_id(1, index)
+    service.project_name = 'Bench %d' % index
+    service.project_name_slug = 'bench-%d' % index
+    service.database = db
+    service.status = Service.ACTIVE
+    for alias in umbrella_aliases + [db]:
+        service.save(using=alias)
+    for alias in umbrella_aliases:
+        CROperatorProfile(id=make_id(2, index), service=service, plan=plan,
+                          expiry=datetime.now() + timedelta(days=365)).save(using=alias)
+
+    member_ids = [make_id(3, index, i) for i in range(member_count)]
+    member_list = [Member(id=member_id, username='bench%d.%d' % (index, i), email='bench%d.%d@ikwen.com' % (index, i),
+                          first_name='Bench', last_name='Member %d' % i, customer_on_fk_list=[service.id])
+                   for i, member_id in enumerate(member_ids)]
+    bulk_insert(Member, member_list, db, *umbrella_aliases)
+    last_reward_date = datetime.now() - timedelta(days=2)
+    reward_scores = (CRProfile.JOIN_REWARD, CRProfile.FREE_REWARD)
+    profile_list = [CRProfile(member_id=member_id, reward_score=rng.choice(reward_scores),
+                              last_reward_date=last_reward_date) for member_id in member_ids]
+    bulk_insert(CRProfile, profile_list, db)
+
+    coupon_list, join_pack_list, referral_pack_list, payment_pack_list = [], [], [], []
+    types = [choice[0] for choice in Coupon.TYPE_CHOICES]
+    for i in range(coupon_count):
+        coupon = Coupon(id=make_id(4, index, i), service=service, name='Coupon %d' % i, slug='coupon-%d' % i,
+                        type=types[i % len(types)], status=Coupon.APPROVED, description='Coupon %d' % i,
+                        heap_size=100, month_quota=10)
+        coupon_list.append(coupon)
+        join_pack_list.append(JoinRewardPack(service=service, coupon=coupon, count=rng.randint(1, 10)))
+        referral_pack_list.append(ReferralRewardPack(service=service, coupon=coupon, count=rng.randint(1, 10)))
+        for floor, ceiling in PAYMENT_INTERVALS:
+            payment_pack_list.append(PaymentRewardPack(service=service, coupon=coupon, count=rng.randint(1, 10),
+                                                       floor=floor, ceiling=ceiling))
+    bulk_insert(Coupon, coupon_list, *umbrella_aliases)
+    bulk_insert(JoinRewardPack, join_pack_list, *umbrella_aliases)
+    bulk_insert(ReferralRewardPack, referral_pack_list, *umbrella_aliases)
+    bulk_insert(PaymentRewardPack, payment_pack_list, *umbrella_aliases)
+
+    cumul_list, summaries = [], {}
+    for coupon in coupon_list:
+        for member_id in rng.sample(member_ids, member_count // 10):
+            count = rng.randint(1, 150)
+            cumul_list.append(CumulatedCoupon(member_id=member_id, coupon=coupon, count=count))
+            summary = summaries.setdefault(member_id, [0, 0])
+            summary[0] += count
+            summary[1] += 1 if count >= coupon.heap_size else 0
+    summary_list = [CouponSummary(service=service, member_id=member_id, count=count, heaps_reached=heaps,
+                                  threshold_reached=heaps > 0)
+                    for member_id, (count, heaps) in summaries.items()]
+    bulk_insert(CumulatedCoupon, cumul_list, UMBRELLA)
+    bulk_insert(CouponSummary, summary_list, UMBRELLA)
+    for coupon in coupon_list:
+        open_coupon_ledger(coupon)
+    return service, member_ids, coupon_list
+
+
+def run_benchmarks(operators=10, members=100000, coupons=20, samples=200, seed=0):
+    """
+    Generates the synthetic communities and times the rewarding operations.
+
+    :return: dict of results ready to be dumped as JSON
+    """
+    rng = random.Random(seed)
+    recorder = Recorder()
+    t0 = datetime.now()
+    call_command('loaddata', 'setup_data.yaml', 'ikwen_members.yaml', verbosity=0)
+    for alias in get_umbrella_aliases():
+        call_command('loaddata', 'setup_data.yaml', 'ikwen_members.yaml', database=alias, verbosity=0)
+    plan = CRBillingPlan(id=make_id(5), name='Benchmark', slug='benchmark', audience_size=members)
+    for alias in get_umbrella_aliases():
+        plan.save(using=alias)
+    communities = [generate_community(index, plan, members, coupons, rng) for index in range(operators)]
+    setup_duration = (datetime.now() - t0).total_seconds()
+
+    for i in range(samples):
+        service, member_ids, coupon_list = rng.choice(communities)
+        member = Member(id=rng.choice(member_ids))
+        coupon = rng.choice(coupon_list)
+        recorder.measure('reward_member.join', reward_member, service, member, Reward.JOIN, db=service.database)
+        recorder.measure('reward_member.referral', reward_member, service, member, Reward.REFERRAL,
+                         db=service.database)
+        recorder.measure('reward_member.payment', reward_member, service, member, Reward.PAYMENT,
+                         amount=rng.randint(100, 50000), object_id=uuid4().hex, model_name='trade.Order',
+                         db=service.database)
+        recorder.measure('reward_member.manual', reward_member, service, member, Reward.MANUAL,
+                         coupon=coupon, count=coupon.heap_size, db=service.database)
+        recorder.measure('use_coupon', use_coupon, member, coupon, uuid4().hex)
+        reward_member(service, member, Reward.MANUAL, coupon=coupon, count=10, db=service.database)
+        receiver = Member(id=rng.choice(member_ids))
+        recorder.measure('donate_coupon', donate_coupon, member, receiver, coupon, 10, uuid4().hex)
+
+    recorder.measure('prepare_free_rewards', reward_crons.prepare_free_rewards)
+    recorder.measure('send_free_rewards', reward_crons.send_free_rewards)
+    mail_count = len(mail.outbox)
+
+    service, member_ids, coupon_list = communities[0]
+    for coupon in coupon_list:
+        Coupon.objects.using(UMBRELLA).filter(pk=coupon.id).update(deleted=True)
+        bump_coupon_catalogue_version(service.id)
+        purge, update = CouponPurge.objects.using(UMBRELLA).get_or_create(coupon=coupon)
+        recorder.measure('run_coupon_purge', run_coupon_purge, purge)
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        commit = None
+    return {
+        'commit': commit,
+        'started_on': t0.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': {'operators': operators, 'members': members, 'coupons': coupons,
+                  'samples': samples, 'seed': seed},
+        'setup_seconds': round(setup_duration, 3),
+        'mail_sent': mail_count,
+        'results': recorder.report()
+    }
+
+
+def drop_community_databases(operators):
+    for index in range(operators):
+        db = '%s%d' % (DB_PREFIX, index)
+        if db in settings.DATABASES:
+            connections[db].connection.drop_database(db)
+
+
+def get_option(argv, name, default):
+    if name in argv:
+        return type(default)(argv[argv.index(name) + 1])
+    return default
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    operators = get_option(argv, '--operators', 10)
+    # DiscoverRunner creates test databases and sets the locmem mail backend
+    runner = DiscoverRunner(verbosity=0, interactive=False)
+    runner.setup_test_environment()
+    old_config = runner.setup_databases()
+    try:
+        # Queries of forked workers would not be counted, so crons run in this process
+        with override_settings(IKWEN_SERVICE_ID=BASE_SERVICE_ID, CR_CRON_WORKERS=1):
+            report = run_benchmarks(operators=operators,
+                                    members=get_option(argv, '--members', 100000),
+                                    coupons=get_option(argv, '--coupons', 20),
+                                    samples=get_option(argv, '--samples', 200),
+                                    seed=get_option(argv, '--seed', 0))
+        for name, result in sorted(report['results'].items()):
+            if not result['max_queries']:
+                sys.stderr.write("Warning: no query counted for %s, query counting is probably broken.\n" % name)
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if '--output' in argv:
+            with open(argv[argv.index('--output') + 1], 'w') as fh:
+                fh.write(output)
+        print(output)
+    finally:
+        drop_community_databases(operators)
+        runner.teardown_databases(old_config)
+        runner.teardown_test_environment()
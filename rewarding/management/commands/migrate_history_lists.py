@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ikwen.rewarding.models import Coupon, CROperatorProfile
+from ikwen.rewarding.utils import migrate_history_lists
+
+
+class Command(BaseCommand):
+    """
+    Copies the *_history lists of Coupon and CROperatorProfile into
+    HistoryBucket. Must be run once when deploying HistoryBucket and can be
+    run again safely as buckets are set rather than incremented. With
+    --clear, lists are emptied once copied.
+
+    Usage: manage.py migrate_history_lists [--clear]
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--clear', action='store_true', dest='clear', default=False,
+                    help="Empty the history lists once copied."),
+    )
+    help = "Copies the history lists of coupons and rewarding operators into HistoryBucket."
+
+    def handle(self, *args, **options):
+        for model in (Coupon, CROperatorProfile):
+            migrate_history_lists(model, options['clear'])
+            self.stdout.write("History lists of %s migrated" % model.__name__)
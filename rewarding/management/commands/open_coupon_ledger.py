@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.rewarding.models import Coupon
+from ikwen.rewarding.utils import open_coupon_ledger
+
+
+class Command(BaseCommand):
+    """
+    Writes the Opening CouponLedgerEntry of Coupons created before the ledger
+    existed, so that verify_coupon_balances() can be trusted on them. Must be
+    run once when deploying the ledger. Coupons already opened are skipped,
+    so it can be run again safely.
+
+    Usage: manage.py open_coupon_ledger [<service_id> ...]
+    """
+    args = '[<service_id> ...]'
+    help = "Opens the coupon ledger of all coupons of the given services, or of all services."
+
+    def handle(self, *args, **options):
+        coupon_qs = Coupon.objects.using(UMBRELLA).filter(ledger_opened_on__isnull=True)
+        if args:
+            coupon_qs = coupon_qs.filter(service__in=args)
+        for coupon in list(coupon_qs):
+            entry_count = open_coupon_ledger(coupon)
+            self.stdout.write("Ledger of %s opened with %d entries" % (coupon.name, entry_count))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.core.models import Service
+from ikwen.rewarding.models import CROperatorProfile
+from ikwen.rewarding.utils import rebuild_heaps_reached
+
+
+class Command(BaseCommand):
+    """
+    Initializes CouponSummary.heaps_reached of existing data. Summaries created
+    before the counter existed are at 0, so the first heap a Member goes back
+    below would drive it negative. Must be run once when deploying the counter
+    and can be run again anytime to repair it.
+
+    Usage: manage.py rebuild_heaps_reached [<service_id> ...]
+    """
+    args = '[<service_id> ...]'
+    help = "Recomputes CouponSummary.heaps_reached of the given services, or of all rewarding operators."
+
+    def handle(self, *args, **options):
+        if args:
+            service_list = list(Service.objects.using(UMBRELLA).filter(pk__in=args))
+        else:
+            service_list = [operator.service for operator in CROperatorProfile.objects.using(UMBRELLA).all()]
+        for service in service_list:
+            rebuild_heaps_reached(service)
+            self.stdout.write("heaps_reached rebuilt for %s" % service.project_name)
@@ -1,11 +1,15 @@
+import time
+from datetime import datetime, timedelta
 from threading import Thread
 
 from django.conf import settings
+from django.core.cache import get_cache
 from django.db import models
+from django.db.models import F
 from django.db.models.signals import post_save
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from djangotoolbox.fields import ListField
+from djangotoolbox.fields import ListField, DictField
 
 from ikwen.conf.settings import IKWEN_SERVICE_ID as UMBRELLA_SERVICE_ID
 from ikwen.accesscontrol.backends import UMBRELLA
@@ -24,6 +28,45 @@ MANUAL_REWARD_OFFERED = 'ManualRewardOffered'
 REFERRAL_REWARD_OFFERED = 'ReferralRewardOffered'
 
 
+def get_catalogue_cache():
+    """
+    Cache holding the coupon catalogues of services. It is the
+    CR_CATALOGUE_CACHE alias of settings.CACHES, shared by all workers
+    if backed by memcached or the like. Falls back to a process-local
+    memory cache if that alias is not configured.
+    """
+    alias = getattr(settings, 'CR_CATALOGUE_CACHE', 'default')
+    if alias in getattr(settings, 'CACHES', {}):
+        return get_cache(alias)
+    return get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='rewarding-catalogue')
+
+
+def get_coupon_catalogue_version(service_id):
+    cache = get_catalogue_cache()
+    key = 'rewarding:catalogue_version:%s' % service_id
+    version = cache.get(key)
+    if version is None:
+        # Version is started from the current time rather than 1 so that it
+        # cannot match a catalogue cached before the version key was evicted.
+        version = int(time.time() * 1000)
+        cache.add(key, version)
+        version = cache.get(key, version)
+    return version
+
+
+def bump_coupon_catalogue_version(service_id):
+    """
+    Invalidates the coupon catalogue of a Service. Must be called
+    whenever its coupons or reward packs change.
+    """
+    cache = get_catalogue_cache()
+    key = 'rewarding:catalogue_version:%s' % service_id
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000))
+
+
 class Coupon(AbstractWatchModel):
     """
     A coupon that a Member may collect
@@ -76,10 +119,16 @@ class Coupon(AbstractWatchModel):
                                                     "the month."))
     is_active = models.BooleanField(default=True)
     deleted = models.BooleanField(default=False)
+    ledger_opened_on = models.DateTimeField(blank=True, null=True, editable=False,
+                                            help_text="Since when CouponLedgerEntry account for all the coupons. "
+                                                      "Set at creation or by rewarding.utils.open_coupon_ledger().")
 
     offered_history = ListField(editable=False)
     total_offered = models.IntegerField(default=0)
 
+    # History is now kept in HistoryBucket. Lists are deferred when loading coupons in bulk.
+    HISTORY_FIELDS = ('offered_history', )
+
     class Meta:
         unique_together = (
             ('service', 'name'),
@@ -102,9 +151,13 @@ class Coupon(AbstractWatchModel):
             self.coefficient = 3
         elif self.type == self.DOWNLOAD:
             self.coefficient = 4
+        if self._state.adding and not self.ledger_opened_on:
+            # All coupons of a new Coupon go through the ledger
+            self.ledger_opened_on = datetime.now()
         if getattr(settings, 'IKWEN_SERVICE_ID') != UMBRELLA_SERVICE_ID:
             kwargs['using'] = UMBRELLA
         super(Coupon, self).save(**kwargs)
+        bump_coupon_catalogue_version(self.service_id)
 
     def to_dict(self):
         var = to_dict(self)
@@ -114,6 +167,7 @@ class Coupon(AbstractWatchModel):
             del(var['month_winners'])
             del(var['offered_history'])
             del(var['total_offered'])
+            del(var['ledger_opened_on'])
         except:
             pass
         return var
@@ -146,6 +200,7 @@ class Reward(Model):
     """
     # Statuses
     PREPARED = 'Prepared'
+    SENDING = 'Sending'  # Claimed by a send_free_rewards() process until lease_expiry
     SENT = 'Sent'
 
     # Type of reward
@@ -164,6 +219,8 @@ class Reward(Model):
     object_id = models.CharField(max_length=60, blank=True, null=True, db_index=True)
     amount = models.FloatField(blank=True, null=True, db_index=True,
                                help_text="Amount that was paid to trigger the reward.")
+    lease_owner = models.CharField(max_length=60, blank=True, null=True, db_index=True)
+    lease_expiry = models.DateTimeField(blank=True, null=True, db_index=True)
 
 
 class MemberCoupon(Model):
@@ -199,6 +256,9 @@ class CouponSummary(Model):
     service = models.ForeignKey(Service, related_name='+')
     member = models.ForeignKey(Member)
     count = models.IntegerField(default=0)
+    heaps_reached = models.IntegerField(default=0,
+                                        help_text="Number of CumulatedCoupon of the Member on this service "
+                                                  "which count is at least the heap_size of their coupon.")
     threshold_reached = models.BooleanField(default=False)
 
     class Meta:
@@ -218,6 +278,31 @@ class CouponUse(MemberCoupon):
     object_id = models.CharField(max_length=30, blank=True, null=True)
 
 
+class CouponLedgerEntry(MemberCoupon):
+    """
+    Append-only record of a credit or debit of the coupons of a Member.
+    CumulatedCoupon.count remains the balance used on the fly, the
+    ledger being the reference to audit or rebuild it.
+    """
+    OPENING = "Opening"
+    REVERSAL = "Reversal"
+
+    count = models.IntegerField(help_text="Number of coupons credited, or debited if negative.")
+    source = models.CharField(max_length=30,
+                              help_text="What caused the entry: a Reward type, a CouponUse usage, "
+                                        "an Opening of the ledger or the Reversal of a failed operation.")
+    object_id = models.CharField(max_length=30, blank=True, null=True)
+
+
+class CouponBalanceSnapshot(MemberCoupon):
+    """
+    Balance of the coupons of a Member including all
+    CouponLedgerEntry created until taken_on.
+    """
+    balance = models.IntegerField(default=0)
+    taken_on = models.DateTimeField(db_index=True)
+
+
 class CRProfile(Model):
     """
     Member CR information on a community. This object
@@ -277,6 +362,9 @@ class CROperatorProfile(AbstractWatchModel):
     total_gift = models.IntegerField(default=0)
     total_discount = models.IntegerField(default=0)
 
+    # History is now kept in HistoryBucket. Lists are deferred when loading operators in bulk.
+    HISTORY_FIELDS = ('push_history', 'purchaseorder_history', 'gift_history', 'discount_history', )
+
     class Meta:
         verbose_name_plural = "CR Operators"
 
@@ -334,45 +422,240 @@ class PaymentRewardPack(EarnedReward):
         )
 
 
+class HistoryBucket(Model):
+    """
+    Value of a metric of an object on a given day. Replaces the
+    ever-growing *_history ListField of Coupon and CROperatorProfile,
+    so that history is only loaded when asked, for the range asked.
+    """
+    model_name = models.CharField(max_length=60,
+                                  help_text="Django style model name of the object. *Eg: rewarding.Coupon*")
+    object_id = models.CharField(max_length=60)
+    metric = models.CharField(max_length=30,
+                              help_text="Name of the history field without the _history suffix. *Eg: offered*")
+    day = models.DateField()
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('model_name', 'object_id', 'metric', 'day', )
+
+
+class RewardReceipt(Model):
+    """
+    Proof that a Member was rewarded for an object. It guarantees
+    that a payment is rewarded only once, even if the payment
+    callback is run many times.
+
+    A receipt is claimed before rewarding and set complete once rewards are
+    written. An incomplete receipt whose lease expired was left by a process
+    that died in the meantime, so it can be taken over by a retry. Receipts
+    written before is_complete existed lack the field and count as complete.
+    """
+    service = models.ForeignKey(Service, related_name='+')
+    member = models.ForeignKey(Member)
+    type = models.CharField(max_length=15)
+    object_id = models.CharField(max_length=60)
+    is_complete = models.BooleanField(default=False)
+    lease_expiry = models.DateTimeField(blank=True, null=True,
+                                        help_text="Receipt can be taken over if not complete by that time.")
+
+    class Meta:
+        unique_together = ('service', 'member', 'object_id', 'type', )
+
+
+class RewardJob(Model):
+    """
+    Reward enqueued by rewarding.utils.reward_member_async() and
+    processed later by rewarding.utils.process_reward_jobs(). Jobs
+    live in the local database of the Service.
+    """
+    PENDING = 'Pending'
+    RUNNING = 'Running'
+    DONE = 'Done'
+    FAILED = 'Failed'
+
+    service = models.ForeignKey(Service, related_name='+')
+    member = models.ForeignKey(Member)
+    type = models.CharField(max_length=15)
+    kwargs = DictField()
+    idempotency_key = models.CharField(max_length=240, unique=True,
+                                       help_text="Avoids enqueuing the same reward twice.")
+    status = models.CharField(max_length=15, default=PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    lease_owner = models.CharField(max_length=60, blank=True, null=True, db_index=True)
+    lease_expiry = models.DateTimeField(blank=True, null=True, db_index=True,
+                                        help_text="Job is put back in the queue if not done by that time.")
+    error = models.TextField(blank=True, null=True)
+
+
+class CronRun(Model):
+    """
+    An execution of the free rewards cron. Its id is the run ID
+    under which its CronCheckpoint are saved. Only the main process
+    of the cron creates runs, hosts sharing its send phase attach to it.
+    Runs without a kind were created by shard hosts of former versions
+    and are never resumed.
+    """
+    RUNNING = 'Running'
+    COMPLETE = 'Complete'
+    FAILED = 'Failed'
+
+    # Kinds of run
+    MAIN = 'Main'  # Resets the month, prepares and sends the free rewards
+
+    kind = models.CharField(max_length=15, default=MAIN, db_index=True)
+    status = models.CharField(max_length=15, default=RUNNING, db_index=True)
+    finished_on = models.DateTimeField(blank=True, null=True)
+
+
+class CronCheckpoint(Model):
+    """
+    Progress of a phase of a CronRun, for a given key in that phase.
+    *Eg: the preparation of free rewards of an operator.* A resumed run
+    skips checkpoints done and continues the others from *position*
+    and *state*. The checkpoint of a phase with an empty key is done once
+    the whole phase is, which shard hosts wait for in the PREPARE phase.
+    """
+    RESET = 'Reset'
+    PREPARE = 'Prepare'
+    SEND = 'Send'
+
+    run = models.ForeignKey(CronRun)
+    phase = models.CharField(max_length=15)
+    key = models.CharField(max_length=60, blank=True, default='')
+    position = models.CharField(max_length=60, blank=True, null=True,
+                                help_text="Primary key of the last object processed in a keyset iteration.")
+    state = DictField()
+    done = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('run', 'phase', 'key', )
+
+
+class CouponPurge(Model):
+    """
+    Background job clearing the references to a deleted Coupon. CumulatedCoupon
+    are processed by batches in the order of their ids. The deltas of a batch
+    are saved in *plan* before being applied to CouponSummary, so a purge
+    interrupted at any point resumes from where it stopped.
+    """
+    PENDING = 'Pending'
+    RUNNING = 'Running'
+    COMPLETE = 'Complete'
+
+    coupon = models.ForeignKey(Coupon, unique=True)
+    status = models.CharField(max_length=15, default=PENDING, db_index=True)
+    total = models.IntegerField(default=0)
+    progress = models.IntegerField(default=0)
+    batch = ListField(help_text="IDs of the CumulatedCoupon of the batch being processed.")
+    plan = ListField(help_text="CouponSummary deltas of the current batch not applied yet.")
+    lease_expiry = models.DateTimeField(default=datetime.now, db_index=True,
+                                        help_text="Purge can be taken over by another worker after that time.")
+    finished_on = models.DateTimeField(blank=True, null=True)
+
+    def _get_percentage(self):
+        if self.status == self.COMPLETE or not self.total:
+            return 100 if self.status == self.COMPLETE else 0
+        return min(self.progress * 100 / self.total, 100)
+    percentage = property(_get_percentage)
+
+    def claim(self):
+        """
+        Takes the lease of this purge for CR_PURGE_LEASE seconds.
+        :return: True if the lease was taken, False if another worker holds it.
+        """
+        now = datetime.now()
+        lease_expiry = now + timedelta(seconds=getattr(settings, 'CR_PURGE_LEASE', 300))
+        claimed = CouponPurge.objects.using(UMBRELLA).filter(pk=self.id, lease_expiry__lte=now)\
+            .exclude(status=self.COMPLETE).update(lease_expiry=lease_expiry)
+        if claimed:
+            self.lease_expiry = lease_expiry
+        return claimed > 0
+
+
+def complete_purge_batch(purge):
+    """
+    Deletes the CumulatedCoupon of the current batch of a purge, then applies
+    the CouponSummary deltas saved in purge.plan. Members sharing the same
+    deltas are updated with a single query, and each group is removed from
+    the plan as soon as it is applied.
+    """
+    if purge.batch:
+        CumulatedCoupon.objects.using(UMBRELLA).filter(pk__in=purge.batch).delete()
+    summary_qs = CouponSummary.objects.using(UMBRELLA).filter(service=purge.coupon.service_id)
+    while purge.plan:
+        group = purge.plan[0]
+        summary_qs.filter(member__in=group['member_ids'])\
+            .update(count=F('count') - group['count'], heaps_reached=F('heaps_reached') - group['heaps'])
+        if group['heaps']:
+            summary_qs.filter(member__in=group['member_ids'], heaps_reached__lte=0).update(threshold_reached=False)
+        purge.plan = purge.plan[1:]
+        purge.save()
+    purge.batch = []
+    purge.save()
+
+
+def run_coupon_purge(purge, batch_size=500):
+    """
+    Clears all references to a deleted Coupon: uncollected CouponWinner are
+    deleted and CumulatedCoupon are removed by batches, their counts being
+    withdrawn from the CouponSummary of their Members.
+    """
+    if not purge.claim():
+        return
+    coupon = purge.coupon
+    lease = getattr(settings, 'CR_PURGE_LEASE', 300)
+    if purge.status == CouponPurge.PENDING:
+        CouponWinner.objects.using(UMBRELLA).filter(coupon=coupon, collected=False).delete()
+        purge.total = CumulatedCoupon.objects.using(UMBRELLA).filter(coupon=coupon).count()
+        purge.status = CouponPurge.RUNNING
+        purge.save()
+    complete_purge_batch(purge)  # Batch left over by an interrupted run, if any
+    while True:
+        # Processed rows are deleted, so the first rows are always the next batch
+        cumul_list = list(CumulatedCoupon.objects.using(UMBRELLA).filter(coupon=coupon).order_by('id')[:batch_size])
+        if not cumul_list:
+            break
+        groups = {}
+        for cumul in cumul_list:
+            heaps = 1 if cumul.count >= coupon.heap_size else 0
+            groups.setdefault((cumul.count, heaps), []).append(cumul.member_id)
+        purge.batch = [cumul.id for cumul in cumul_list]
+        purge.plan = [{'count': count, 'heaps': heaps, 'member_ids': member_ids}
+                      for (count, heaps), member_ids in groups.items()]
+        purge.progress += len(cumul_list)
+        purge.lease_expiry = datetime.now() + timedelta(seconds=lease)
+        purge.save()
+        complete_purge_batch(purge)
+    CouponLedgerEntry.objects.using(UMBRELLA).filter(coupon=coupon).delete()
+    CouponBalanceSnapshot.objects.using(UMBRELLA).filter(coupon=coupon).delete()
+    purge.status = CouponPurge.COMPLETE
+    purge.progress = purge.total
+    purge.finished_on = datetime.now()
+    purge.save()
+
+
 def purge_coupon(sender, **kwargs):
     """
     Deletes all references to a Coupon whenever its
     status is set to delete=True. We avoid actual deletion
     in order to prevent ForeignKey references issues.
+
+    The work is tracked by a CouponPurge. It starts right away in a
+    separate thread and is resumed by the rewarding crons if interrupted.
     """
     if sender != Coupon:  # Avoid unending recursive call
         return
     instance = kwargs['instance']
     if not instance.deleted:
         return
-
-    def clear_references(coupon):
-        service = coupon.service
-        for win in CouponWinner.objects.using(UMBRELLA).filter(coupon=coupon, collected=False):
-            win.delete()
-
-        # Avoid memory overflow by processing in chunks of 500
-        total = CumulatedCoupon.objects.using(UMBRELLA).filter(coupon=coupon).count()
-        chunks = total / 500 + 1
-        for i in range(chunks):
-            start = i * 500
-            finish = (i + 1) * 500
-            for cumul in CumulatedCoupon.objects.using(UMBRELLA).filter(coupon=coupon)[start:finish]:
-                member = cumul.member
-                summary = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
-                summary.count -= cumul.count
-                cumul.delete()
-                threshold_reached = False
-                for c in CumulatedCoupon.objects.using(UMBRELLA).filter(member=member):
-                    if c.count >= c.coupon.heap_size:
-                        threshold_reached = True
-                        break
-                summary.threshold_reached = threshold_reached
-                summary.save()
+    purge, update = CouponPurge.objects.using(UMBRELLA).get_or_create(coupon=instance)
+    if purge.status == CouponPurge.COMPLETE:
+        return
     if getattr(settings, 'UNIT_TESTING', False):
-        clear_references(instance)
+        run_coupon_purge(purge)
     else:  # Run in separate thread in production as it may take some time
-        Thread(target=clear_references, args=(instance,)).start()
+        Thread(target=run_coupon_purge, args=(purge,)).start()
 
 
-post_save.connect(purge_coupon, dispatch_uid="coupon_post_save_id")
\ No newline at end of file
+post_save.connect(purge_coupon, dispatch_uid="coupon_post_save_id")
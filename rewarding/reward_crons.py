@@ -3,27 +3,40 @@
 
 import os
 import sys
+import json
+import time
+import zlib
 import random
 import logging
+from multiprocessing import Process, Queue
+from multiprocessing.queues import Empty
+from multiprocessing.pool import ThreadPool
 
 sys.path.append("/home/libran/virtualenv/lib/python2.7/site-packages")
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ikwen.conf.settings")
 
+from copy import copy
 from datetime import datetime, timedelta
+from uuid import uuid4
 from django.conf import settings
 from django.core import mail
 from django.core.mail import EmailMessage
+from django.db import connections
+from django.db.models import F
 from django.utils.translation import gettext as _, activate
 
 from ikwen.accesscontrol.backends import ARCH_EMAIL
 from ikwen.accesscontrol.models import Member
 from ikwen.core.models import Service, XEmailObject
-from ikwen.core.utils import get_service_instance, add_event, set_counters, add_database
-from ikwen.core.utils import get_mail_content, increment_history_field
+from ikwen.core.utils import get_service_instance, add_event, add_database
+from ikwen.core.utils import get_mail_content
 
-from ikwen.rewarding.models import CROperatorProfile, Reward, Coupon, CRProfile, JoinRewardPack, CumulatedCoupon, \
-    CouponSummary, CouponWinner, FREE_REWARD_OFFERED, WELCOME_REWARD_OFFERED
-from ikwen.rewarding.utils import get_last_reward
+from ikwen.rewarding.models import CROperatorProfile, Reward, Coupon, CRProfile, CumulatedCoupon, \
+    CouponSummary, CouponWinner, FREE_REWARD_OFFERED, WELCOME_REWARD_OFFERED, CouponPurge, run_coupon_purge, \
+    CouponLedgerEntry, CronRun, CronCheckpoint
+from ikwen.rewarding.utils import process_reward_jobs, get_heap_crossing, iter_keyset, iter_keyset_chunks, \
+    get_last_reward_map, get_reward_rules, HistoryAccumulator, take_balance_snapshots, QueryCounter, instrument, \
+    count_rows, add_cumulated_count
 
 from ikwen.core.log import CRONS_LOGGING
 logging.config.dictConfig(CRONS_LOGGING)
@@ -38,273 +51,949 @@ logger = logging.getLogger('ikwen.crons')
 
 now = datetime.now()  # Reference time for the whole script
 DEBUG = False
+DRY_RUN = False  # Free reward plans are dumped instead of being applied
 
 
-def offer_free_coupon(service, member, profile, coupon, cumul):
-    MAX_FREE = getattr(settings, 'CR_MAX_FREE', 30)
-    MIN_FREE = getattr(settings, 'CR_MIN_FREE', 4)
-    left = coupon.heap_size - cumul.count - 5
-    max_count = min(MAX_FREE, left) / coupon.coefficient
-    min_count = min(MIN_FREE, max_count)
-    count = random.randint(min_count, max_count)
-    reward, update = Reward.objects.get_or_create(service=service, member=member, coupon=coupon,
-                                                  type=Reward.FREE, status=Reward.PREPARED)
-    reward.count += count
-    reward.save()
-    profile.coupon_score += count * coupon.coefficient
-    profile.last_reward_date = datetime.now()
-
-
-def get_remaining_days_in_month():
-    next_month = now.month + 1
+def get_remaining_days_in_month(day=None):
+    day = day or now
+    next_month = day.month + 1
     if next_month > 12:
         next_month = next_month % 12
-    year = now.year if now.month < 12 else now.year + 1
+    year = day.year if day.month < 12 else day.year + 1
     first_of_next_month = datetime(year, next_month, 1)
-    return (first_of_next_month - now).days
+    return (first_of_next_month - day).days
+
+
+def get_member_shard(member_id, shard_count):
+    return (zlib.crc32(member_id.encode('utf-8')) & 0xffffffff) % shard_count
+
+
+def parse_shard(argv):
+    """
+    Reads the --shard k/N option of the command line.
+
+    :return: tuple (k, N) or None if the option is absent
+    """
+    if '--shard' not in argv:
+        return None
+    shard, shard_count = argv[argv.index('--shard') + 1].split('/')
+    shard, shard_count = int(shard), int(shard_count)
+    if not 0 <= shard < shard_count:
+        raise ValueError("Shard must be given as k/N with 0 <= k < N")
+    return shard, shard_count
+
+
+def load_prepared_rewards(shard=None):
+    """
+    Streams all PREPARED rewards once, reading only their member and service,
+    to get the members to send rewards to. Rewards themselves are read when
+    claimed, so memory only grows with the number of members.
+
+    :param shard: tuple (k, N). If given, only members of shard k out of N are kept.
+    :return: tuple (member_ids, service_ids), member_ids being sorted
+    """
+    member_ids, service_ids = set(), set()
+    reward_qs = Reward.objects.filter(status=Reward.PREPARED, count__gt=0)
+    for reward in iter_keyset(reward_qs, chunk_size=1000, fields=('member', 'service')):
+        if shard and get_member_shard(reward.member_id, shard[1]) != shard[0]:
+            continue
+        member_ids.add(reward.member_id)
+        service_ids.add(reward.service_id)
+    return sorted(member_ids), service_ids
+
+
+def claim_prepared_rewards(member_ids, owner, lease):
+    """
+    Sets the PREPARED rewards of members SENDING under a lease of
+    *lease* seconds taken by owner, so that no other process sends them.
+
+    :return: dict of lists of rewards claimed, keyed by member_id
+    """
+    lease_expiry = datetime.now() + timedelta(seconds=lease)
+    Reward.objects.filter(member__in=member_ids, status=Reward.PREPARED, count__gt=0)\
+        .update(status=Reward.SENDING, lease_owner=owner, lease_expiry=lease_expiry)
+    claimed = {}
+    for reward in Reward.objects.filter(member__in=member_ids, status=Reward.SENDING, lease_owner=owner).order_by('id'):
+        claimed.setdefault(reward.member_id, []).append(reward)
+    return claimed
+
+
+def release_expired_leases():
+    """
+    Sets back PREPARED the rewards of a send_free_rewards()
+    process that stopped before its lease expired.
+    """
+    Reward.objects.filter(status=Reward.SENDING, lease_expiry__lte=datetime.now())\
+        .update(status=Reward.PREPARED, lease_owner=None, lease_expiry=None)
 
 
-def group_rewards_by_service(member):
+def load_reward_lookups(service_ids):
+    """
+    Loads in lookup dicts the active Services among service_ids, their
+    active CROperatorProfile and their approved and active Coupons.
+    """
+    service_qs = Service.objects.filter(pk__in=list(service_ids), status=Service.ACTIVE)
+    services = dict([(service.id, service) for service in service_qs])
+    operator_qs = CROperatorProfile.objects.defer(*CROperatorProfile.HISTORY_FIELDS)\
+        .filter(service__in=services.keys(), is_active=True)
+    operators = dict([(operator.service_id, operator) for operator in operator_qs])
+    coupon_qs = Coupon.objects.defer(*Coupon.HISTORY_FIELDS)\
+        .filter(service__in=operators.keys(), status=Coupon.APPROVED, is_active=True)
+    coupons = dict([(coupon.id, coupon) for coupon in coupon_qs])
+    return {'services': services, 'operators': operators, 'coupons': coupons}
+
+
+def group_rewards_by_service(member, reward_list, lookups, history):
     """
     Goes through all reward prepared for a member,
-    Set those reward actually and groups them by
-    Service in a dictionary object which keys are
-    the Service and values are matching reward_list
+    and groups them by Service in a dictionary object
+    which keys are the Service and values are matching
+    reward_list. Rewards on services the member is not
+    customer of, or which rewarding is off are dropped.
+    Operator and coupon statistics are collected in
+    the HistoryAccumulator history.
     """
     grouped_rewards = {}
-    service_list = []
-    for service_id in member.customer_on_fk_list:
+    for reward in reward_list:
+        coupon = lookups['coupons'].get(reward.coupon_id)
+        if not coupon or reward.service_id not in member.customer_on_fk_list:
+            continue
+        service = lookups['services'][reward.service_id]
+        operator = lookups['operators'][reward.service_id]
+        reward.coupon = coupon
+        reward.service = service
+        if service not in grouped_rewards:
+            history.increment(operator, 'push_history')
+            grouped_rewards[service] = []
+        grouped_rewards[service].append(reward)
+        history.increment(operator, coupon.type.lower() + '_history', reward.count)
+        history.increment(coupon, 'offered_history', reward.count)
+    return grouped_rewards
+
+
+def credit_prepared_rewards(reward_list):
+    """
+    Credits the CumulatedCoupon and CouponSummary of Members with their
+    rewards. Each CumulatedCoupon is credited with add_cumulated_count(),
+    so heaps reached are told from exact counts, while CouponSummary,
+    CouponWinner and ledger entries of many members are written together.
+    """
+    if not reward_list:
+        return
+    # Ledger entries carry the reward id and are written once the credit is
+    # done. Only the part of a reward not found there yet is credited, so
+    # rewards credited by an interrupted run are not credited twice, while an
+    # increment of their count by a later preparation is still credited.
+    # A crash between the credit and the ledger write credits them again on
+    # resume, which verify_coupon_balances() reveals.
+    reward_ids = [reward.id for reward in reward_list]
+    entry_qs = CouponLedgerEntry.objects.filter(object_id__in=reward_ids, source__in=[Reward.FREE, Reward.JOIN])
+    credited = {}
+    for entry in entry_qs.only('object_id', 'count'):
+        credited[entry.object_id] = credited.get(entry.object_id, 0) + entry.count
+    credit_list = [(reward, reward.count - credited.get(reward.id, 0)) for reward in reward_list
+                   if reward.count > credited.get(reward.id, 0)]
+    if not credit_list:
+        return
+    member_ids = list(set([reward.member_id for reward, count in credit_list]))
+    coupon_ids = list(set([reward.coupon_id for reward, count in credit_list]))
+    service_ids = list(set([reward.service_id for reward, count in credit_list]))
+    cumul_qs = CumulatedCoupon.objects.filter(member__in=member_ids, coupon__in=coupon_ids)
+    with_cumul = set([(cumul.member_id, cumul.coupon_id) for cumul in cumul_qs.only('member', 'coupon')])
+    summary_qs = CouponSummary.objects.filter(member__in=member_ids, service__in=service_ids)
+    summaries = dict([((summary.member_id, summary.service_id), summary) for summary in summary_qs])
+    winner_list = []
+    summary_deltas = {}
+    for reward, count in credit_list:
+        coupon = reward.coupon
+        key = (reward.member_id, coupon.id)
+        before, after = add_cumulated_count(reward.member_id, coupon, count, key in with_cumul, 'default')
+        with_cumul.add(key)
+        if after >= coupon.heap_size:
+            winner_list.append(CouponWinner(member_id=reward.member_id, coupon=coupon))
+        delta = summary_deltas.setdefault((reward.member_id, reward.service_id), [0, 0])
+        delta[0] += count
+        delta[1] += get_heap_crossing(before, after, coupon.heap_size)
+    new_summary_list = []
+    summary_ids_by_delta = {}
+    for (member_id, service_id), (count, heaps) in summary_deltas.items():
+        summary = summaries.get((member_id, service_id))
+        if summary:
+            summary_ids_by_delta.setdefault((count, heaps), []).append(summary.id)
+        else:
+            new_summary_list.append(CouponSummary(service_id=service_id, member_id=member_id, count=count,
+                                                  heaps_reached=heaps, threshold_reached=heaps > 0))
+    for (count, heaps), summary_ids in summary_ids_by_delta.items():
+        if heaps > 0:
+            CouponSummary.objects.filter(pk__in=summary_ids)\
+                .update(count=F('count') + count, heaps_reached=F('heaps_reached') + heaps, threshold_reached=True)
+        else:
+            CouponSummary.objects.filter(pk__in=summary_ids).update(count=F('count') + count)
+    if new_summary_list:
+        CouponSummary.objects.bulk_create(new_summary_list)
+    if winner_list:
+        CouponWinner.objects.bulk_create(winner_list)
+    CouponLedgerEntry.objects.bulk_create([CouponLedgerEntry(member_id=reward.member_id, coupon=reward.coupon,
+                                                             count=count, source=reward.type, object_id=reward.id)
+                                           for reward, count in credit_list])
+    count_rows(2 * len(credit_list) + len(summary_deltas) + len(winner_list))
+
+
+def get_checkpoint(run_id, phase, key=''):
+    """
+    Gets the CronCheckpoint of a phase of a run. If run_id is None, progress is
+    not tracked and an unsaved CronCheckpoint is returned, on which
+    save_checkpoint() does nothing.
+    """
+    if run_id is None:
+        return CronCheckpoint(phase=phase, key=key, state={})
+    checkpoint, update = CronCheckpoint.objects.get_or_create(run_id=run_id, phase=phase, key=key)
+    return checkpoint
+
+
+def save_checkpoint(checkpoint):
+    if checkpoint.run_id:
+        checkpoint.save()
+
+
+def get_cron_run(resume=False):
+    """
+    Gets the CronRun of this execution. With resume, the latest main run is
+    continued under its run ID if it failed. Runs still RUNNING are never
+    resumed as their process may be alive.
+
+    :raise: ValueError if resuming while a failed run is followed by newer
+        main runs, as it would prepare and send rewards of a stale day again.
+    """
+    if resume:
+        run_qs = CronRun.objects.filter(kind=CronRun.MAIN)
         try:
-            service_list.append(Service.objects.get(pk=service_id, status=Service.ACTIVE))
-        except Service.DoesNotExist:
-            pass
-    for service in service_list:
+            run = run_qs.order_by('-id')[0]
+        except IndexError:
+            run = None
+        if run and run.status == CronRun.FAILED:
+            run.status = CronRun.RUNNING
+            run.save()
+            return run
+        if run_qs.filter(status=CronRun.FAILED).exists():
+            raise ValueError("Failed runs were followed by newer ones and cannot be resumed anymore.")
+    return CronRun.objects.create(kind=CronRun.MAIN)
+
+
+def attach_cron_run(run_id):
+    """
+    Gets the running main CronRun that a shard host joins, once it prepared
+    all free rewards. The run is left untouched: only its main process sets
+    its status.
+
+    :raise: CronRun.DoesNotExist if there is no such main run running
+    """
+    run = CronRun.objects.get(pk=run_id, kind=CronRun.MAIN, status=CronRun.RUNNING)
+    wait_run_prepared(run.id)
+    return run
+
+
+def wait_run_prepared(run_id):
+    """
+    Waits until the main run run_id is done preparing free rewards, checking
+    every CR_SHARD_POLL_INTERVAL seconds. Rewards of a member are prepared
+    by many operators, so a shard sending earlier would mail and credit the
+    member for the rewards prepared so far, then again for the others.
+
+    :raise: CronRun.DoesNotExist if the run stops running in the meantime and
+        ValueError if it is still preparing after CR_SHARD_MAX_WAIT seconds.
+    """
+    poll_interval = getattr(settings, 'CR_SHARD_POLL_INTERVAL', 30)
+    deadline = time.time() + getattr(settings, 'CR_SHARD_MAX_WAIT', 4 * 3600)
+    checkpoint_qs = CronCheckpoint.objects.filter(run=run_id, phase=CronCheckpoint.PREPARE, key='', done=True)
+    while not checkpoint_qs.exists():
+        CronRun.objects.get(pk=run_id, kind=CronRun.MAIN, status=CronRun.RUNNING)
+        if time.time() >= deadline:
+            raise ValueError("Run %s still preparing free rewards, shard gives up." % run_id)
+        time.sleep(poll_interval)
+
+
+def draw_winning_indexes(coupon_list, n, remaining_days, rng):
+    """
+    Paces the month_quota of coupons over the remaining days of the month
+    and sets on each coupon the set of indexes of today's candidates who win it.
+    """
+    list_n = list(range(n))
+    for coupon in coupon_list:
+        winners_count = coupon.month_quota - coupon.month_winners
+        if remaining_days == 0:
+            winners_today = winners_count
+        else:
+            winners_today = winners_count // remaining_days
+        winners_today = max(min(winners_today, n), 0)
+        coupon.winning_indexes = set(rng.sample(list_n, winners_today))
+
+
+def allocate_free_rewards(candidate_ids, cumuls, coupon_list, rng):
+    """
+    Decides the free reward of each candidate, in order. Candidate i wins the
+    first coupon having i among its winning_indexes and gets enough coupons to
+    reach its heap. Others get a random count, bounded by heap_size and the
+    coefficient, of a random coupon they have less than
+    FREE_COUPON_CRITICAL_LIMIT of, or of any coupon if they are all critical.
+
+    :param cumuls: dict of current CumulatedCoupon counts keyed by (member_id, coupon_id)
+    :return: tuple (rewards, winners), rewards being a list of dicts with keys
+        *member_id*, *coupon_id*, *count* and *winner* and winners the number
+        of winners of each coupon
+    """
+    max_free = getattr(settings, 'CR_MAX_FREE', 30)
+    min_free = getattr(settings, 'CR_MIN_FREE', 4)
+    critical_limit = getattr(settings, 'FREE_COUPON_CRITICAL_LIMIT', 75)
+    rewards = []
+    winners = dict([(coupon.id, 0) for coupon in coupon_list])
+    for i, member_id in enumerate(candidate_ids):
+        for coupon in coupon_list:
+            if i in coupon.winning_indexes:
+                remaining = max(coupon.heap_size - cumuls.get((member_id, coupon.id), 0), 0)
+                count = remaining + rng.randrange(3, 20, 3)
+                winners[coupon.id] += 1
+                winner = True
+                break
+        else:
+            shuffled_coupon_list = list(coupon_list)
+            rng.shuffle(shuffled_coupon_list)
+            for coupon in shuffled_coupon_list:
+                if cumuls.get((member_id, coupon.id), 0) < critical_limit:
+                    break
+            else:  # All coupons are critical
+                coupon = rng.choice(coupon_list)
+            left = coupon.heap_size - cumuls.get((member_id, coupon.id), 0) - 5
+            max_count = min(max_free, left) // coupon.coefficient
+            min_count = min(min_free, max_count)
+            count = rng.randint(min_count, max_count)
+            winner = False
+        if count > 0:
+            rewards.append({'member_id': member_id, 'coupon_id': coupon.id, 'count': count, 'winner': winner})
+    return rewards, winners
+
+
+def plan_free_rewards(service, n, coupon_list, remaining_days, t0, seed=None):
+    """
+    Computes the free rewards of the day for up to n members of a Service
+    without writing anything. Candidates are the CRProfile not rewarded
+    for two days, taken in the usual reward_score, coupon_score and
+    last_reward_date order. They and their CumulatedCoupon are loaded with
+    a constant number of queries. The random draws come from a generator
+    seeded with *seed*, which is kept in the plan so a run can be replayed.
+
+    :param coupon_list: Coupons of the Service that may be offered
+    :return: dict with keys *service_id*, *seed*, *created_on*, *winners*,
+        the number of winners of each coupon, and *rewards*, a list of
+        dicts with keys *member_id*, *coupon_id*, *count* and *winner*.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    db = service.database
+    draw_winning_indexes(coupon_list, n, remaining_days, rng)
+
+    two_days_back = t0 - timedelta(days=2)
+    profile_qs = CRProfile.objects.using(db).filter(last_reward_date__lte=two_days_back)\
+        .order_by('reward_score', 'coupon_score', 'last_reward_date').only('member')[:n]
+    candidate_ids = [profile.member_id for profile in profile_qs]
+    members = Member.objects.using(db).only('email', 'is_superuser').in_bulk(candidate_ids)
+    members_u = Member.objects.only('id').in_bulk(candidate_ids)  # Members from umbrella database
+    candidate_ids = [member_id for member_id in candidate_ids if is_free_reward_candidate(members.get(member_id))
+                     and member_id in members_u]
+    coupon_ids = [coupon.id for coupon in coupon_list]
+    cumul_qs = CumulatedCoupon.objects.filter(member__in=candidate_ids, coupon__in=coupon_ids)
+    cumuls = dict([((cumul.member_id, cumul.coupon_id), cumul.count)
+                   for cumul in cumul_qs.only('member', 'coupon', 'count')])
+    rewards, winners = allocate_free_rewards(candidate_ids, cumuls, coupon_list, rng)
+    return {'service_id': service.id, 'seed': seed, 'created_on': t0.strftime('%Y-%m-%d %H:%M:%S'),
+            'winners': winners, 'rewards': rewards}
+
+
+def is_free_reward_candidate(member):
+    if not member or member.email == ARCH_EMAIL:
+        return False
+    return member.is_superuser or not DEBUG  # Process only superusers in debug mode
+
+
+def dump_free_reward_plan(plan, plan_dir):
+    """
+    Writes a plan computed by plan_free_rewards() as JSON in plan_dir
+    """
+    filename = 'free-rewards-%s-%s.json' % (plan['service_id'], plan['created_on'][:10])
+    with open(os.path.join(plan_dir, filename), 'w') as fh:
+        json.dump(plan, fh, indent=2, sort_keys=True)
+
+
+def get_free_reward_operations(plan, coupon_list):
+    """
+    Turns a plan computed by plan_free_rewards() into the list of writes
+    applying it: new PREPARED free Reward are bulk created, counts are added
+    to existing ones, CRProfile and Coupon.month_winners are updated by
+    groups of equal increments. Operations only hold JSON types, so they
+    can be saved in a CronCheckpoint before being run.
+    """
+    coupons = dict([(coupon.id, coupon) for coupon in coupon_list])
+    member_ids = list(set([item['member_id'] for item in plan['rewards']]))
+    reward_qs = Reward.objects.filter(service=plan['service_id'], member__in=member_ids, type=Reward.FREE,
+                                      status=Reward.PREPARED)
+    rewards = dict([((reward.member_id, reward.coupon_id), reward.id)
+                    for reward in reward_qs.only('member', 'coupon')])
+    new_reward_list = []
+    reward_ids_by_count, member_ids_by_score = {}, {}
+    for item in plan['rewards']:
+        coupon = coupons[item['coupon_id']]
+        reward_id = rewards.get((item['member_id'], coupon.id))
+        if reward_id:
+            reward_ids_by_count.setdefault(item['count'], []).append(reward_id)
+        else:
+            new_reward_list.append([item['member_id'], coupon.id, item['count']])
+        member_ids_by_score.setdefault(item['count'] * coupon.coefficient, []).append(item['member_id'])
+    operations = []
+    if new_reward_list:
+        operations.append({'op': 'create_rewards', 'rewards': new_reward_list})
+    for count, reward_ids in reward_ids_by_count.items():
+        operations.append({'op': 'increment_rewards', 'count': count, 'reward_ids': reward_ids})
+    for score, score_member_ids in member_ids_by_score.items():
+        operations.append({'op': 'update_profiles', 'score': score, 'member_ids': score_member_ids})
+    for coupon_id, winners in plan['winners'].items():
+        if winners:
+            operations.append({'op': 'add_month_winners', 'coupon_id': coupon_id, 'winners': winners})
+    return operations
+
+
+def run_free_reward_operation(service, operation):
+    if operation['op'] == 'create_rewards':
+        reward_list = [Reward(service=service, member_id=member_id, coupon_id=coupon_id, count=count,
+                              type=Reward.FREE, status=Reward.PREPARED)
+                       for member_id, coupon_id, count in operation['rewards']]
+        Reward.objects.bulk_create(reward_list)
+        count_rows(len(reward_list))
+    elif operation['op'] == 'increment_rewards':
+        Reward.objects.filter(pk__in=operation['reward_ids']).update(count=F('count') + operation['count'])
+        count_rows(len(operation['reward_ids']))
+    elif operation['op'] == 'update_profiles':
+        CRProfile.objects.using(service.database).filter(member__in=operation['member_ids'])\
+            .update(reward_score=CRProfile.FREE_REWARD, coupon_score=F('coupon_score') + operation['score'],
+                    last_reward_date=datetime.now())
+        count_rows(len(operation['member_ids']))
+    elif operation['op'] == 'add_month_winners':
+        Coupon.objects.filter(pk=operation['coupon_id'])\
+            .update(month_winners=F('month_winners') + operation['winners'])
+        count_rows(1)
+
+
+def apply_free_reward_plan(plan, coupon_list, checkpoint=None):
+    """
+    Writes a plan computed by plan_free_rewards(). The operations are saved in
+    the checkpoint along with the index of the next one to run, so a resumed
+    run continues where the interrupted one stopped instead of applying the
+    plan twice.
+    """
+    service = Service.objects.get(pk=plan['service_id'])
+    if checkpoint is None:
+        checkpoint = CronCheckpoint(state={})
+    if checkpoint.state.get('operations') is None:
+        checkpoint.state['operations'] = get_free_reward_operations(plan, coupon_list)
+        checkpoint.state['next_op'] = 0
+        save_checkpoint(checkpoint)
+    operations = checkpoint.state['operations']
+    for i in range(checkpoint.state['next_op'], len(operations)):
+        run_free_reward_operation(service, operations[i])
+        checkpoint.state['next_op'] = i + 1
+        save_checkpoint(checkpoint)
+
+
+@instrument()
+def prepare_operator_free_rewards(operator, remaining_days, run_id=None):
+    """
+    Prepares the free rewards of the community of an Operator
+
+    If run_id is given, progress is saved in a CronCheckpoint after each chunk
+    of members welcomed and each write of the plan, so that a resumed run
+    only does what the interrupted one did not.
+
+    :return: dict of stats with keys *service*, *welcomed*, *rewarded* and *duration*
+    """
+    t0 = datetime.now()
+    N = operator.plan.audience_size / 30
+    service = operator.service
+    stats = {'service': service.project_name, 'welcomed': 0, 'rewarded': 0, 'duration': 0}
+    checkpoint = get_checkpoint(run_id, CronCheckpoint.PREPARE, operator.id)
+    if checkpoint.done:
+        stats['skipped'] = True
+        return stats
+    if service.status != Service.ACTIVE:
+        return stats
+    db = service.database
+    add_database(db)
+    never_rewarded_count = checkpoint.state.get('welcomed', 0)
+
+    # Start the list with member that have never
+    # been rewarded. Those with a None last_reward
+
+    # Processing members in a Member.objects.all() may cause
+    # segmentation_fault() error. So stream them by chunks of 500
+    if DEBUG:
+        # Process only superusers in debug mode
+        member_queryset = Member.objects.using(db).filter(is_superuser=True)
+    else:
+        member_queryset = Member.objects.using(db).all()
+    join_pack_list = [pack for pack in get_reward_rules(service, Reward.JOIN)
+                      if pack.coupon.is_active and pack.coupon.status == Coupon.APPROVED]
+    join_score = sum([pack.count * pack.coupon.coefficient for pack in join_pack_list])
+    # Members welcomed by an interrupted run already have rewards, so they are
+    # in the last_reward_map of their chunk and are not welcomed twice if it is redone.
+    if checkpoint.state.get('plan') is not None:
+        member_chunks = []  # Welcome phase completed by the interrupted run
+    else:
+        member_chunks = iter_keyset_chunks(member_queryset, fields=('id', ), start_after=checkpoint.position)
+    for member_list in member_chunks:
+        member_ids = [member.id for member in member_list]
+        last_reward_map = get_last_reward_map(service, member_ids)
+        profile_qs = CRProfile.objects.using(db).filter(member__in=member_ids)
+        profiles = dict([(profile.member_id, profile) for profile in profile_qs])
+        new_profile_list, welcomed_ids, others_ids = [], [], []
         reward_list = []
-        try:
-            operator = CROperatorProfile.objects.get(service=service, is_active=True)
-        except CROperatorProfile.DoesNotExist:
-            continue
-        if Coupon.objects.filter(service=service, status=Coupon.APPROVED, is_active=True).count() == 0:
+        last_reward_date = datetime.now()
+        for member in member_list:
+            welcomed = False
+            if member.id not in last_reward_map and never_rewarded_count < N:
+                never_rewarded_count += 1
+                for pack in join_pack_list:
+                    reward_list.append(Reward(service=service, member_id=member.id, coupon=pack.coupon,
+                                              count=pack.count, type=Reward.JOIN, status=Reward.PREPARED))
+                welcomed = len(join_pack_list) > 0
+            if member.id not in profiles:
+                profile = CRProfile(member_id=member.id, reward_score=CRProfile.FREE_REWARD)
+                if welcomed:
+                    profile.coupon_score = join_score
+                    profile.last_reward_date = last_reward_date
+                new_profile_list.append(profile)
+            elif welcomed:
+                welcomed_ids.append(member.id)
+            else:
+                others_ids.append(member.id)
+        if DRY_RUN:
             continue
-        set_counters(operator)
-        for coupon in Coupon.objects.filter(service=service, status=Coupon.APPROVED, is_active=True):
-            try:
-                reward = Reward.objects.get(member=member, coupon=coupon, status=Reward.PREPARED)
-                reward_list.append(reward)
-                cumul, update = CumulatedCoupon.objects.get_or_create(member=member, coupon=coupon)
-                cumul.count += reward.count
-                cumul.save()
-                summary, update = CouponSummary.objects.get_or_create(service=service, member=member)
-                summary.count += reward.count
-                if cumul.count > coupon.heap_size:
-                    CouponWinner.objects.create(member=member, coupon=coupon)
-                    summary.threshold_reached = True
-                summary.save()
-                history_field = coupon.type.lower() + '_history'
-                increment_history_field(operator, history_field, reward.count)
-
-                set_counters(coupon)
-                increment_history_field(coupon, 'offered_history', reward.count)
-            except Reward.DoesNotExist:
-                pass
+        # Rewards are written first: once they exist, members are no longer
+        # welcomed, so a chunk redone after a crash cannot welcome them twice.
+        if reward_list:
+            Reward.objects.bulk_create(reward_list)
+        if new_profile_list:
+            CRProfile.objects.using(db).bulk_create(new_profile_list)
+        if welcomed_ids:
+            CRProfile.objects.using(db).filter(member__in=welcomed_ids)\
+                .update(reward_score=CRProfile.FREE_REWARD, coupon_score=F('coupon_score') + join_score,
+                        last_reward_date=last_reward_date)
+        if others_ids:
+            CRProfile.objects.using(db).filter(member__in=others_ids).update(reward_score=CRProfile.FREE_REWARD)
+        count_rows(len(reward_list) + len(new_profile_list) + len(welcomed_ids) + len(others_ids))
+        checkpoint.position = member_list[-1].id
+        checkpoint.state['welcomed'] = never_rewarded_count
+        save_checkpoint(checkpoint)
 
-        increment_history_field(operator, 'push_history')
-        grouped_rewards[service] = reward_list
-    return grouped_rewards
+    # Add extra members to reach N people
+    n = N - never_rewarded_count
+    coupon_qs = Coupon.objects.defer(*Coupon.HISTORY_FIELDS).filter(service=service, status=Coupon.APPROVED,
+                                                                   is_active=True)
+    coupon_list = list(coupon_qs)
+    stats['welcomed'] = never_rewarded_count
+    if not coupon_list:
+        checkpoint.done = True
+        save_checkpoint(checkpoint)
+        stats['duration'] = (datetime.now() - t0).seconds
+        return stats
+    plan = checkpoint.state.get('plan')
+    if plan is None:
+        plan = plan_free_rewards(service, n, coupon_list, remaining_days, t0,
+                                 getattr(settings, 'CR_FREE_REWARD_SEED', None))
+        plan_dir = getattr(settings, 'CR_FREE_REWARD_PLAN_DIR', None)
+        if plan_dir or DRY_RUN:
+            dump_free_reward_plan(plan, plan_dir or '.')
+        checkpoint.state['plan'] = plan
+        save_checkpoint(checkpoint)
+    if not DRY_RUN:
+        apply_free_reward_plan(plan, coupon_list, checkpoint)
+    checkpoint.done = True
+    save_checkpoint(checkpoint)
+    stats['rewarded'] = len(plan['rewards'])
+    stats['duration'] = (datetime.now() - t0).seconds
+    return stats
+
+
+def _prepare_operator_free_rewards(operator_id, remaining_days, run_id=None):
+    """
+    Entry point of prepare_operator_free_rewards() in pool workers.
+    Failures are logged and reported instead of being raised.
+    """
+    try:
+        operator = CROperatorProfile.objects.get(pk=operator_id)
+        return prepare_operator_free_rewards(operator, remaining_days, run_id)
+    except:
+        logger.error(u"Failed to prepare free rewards of operator %s" % operator_id, exc_info=True)
+        return {'service': operator_id, 'error': True}
+
+
+def _run_operator_worker(operator_id, remaining_days, run_id, results):
+    """
+    Target of the worker processes of prepare_free_rewards().
+    """
+    results.put((operator_id, _prepare_operator_free_rewards(operator_id, remaining_days, run_id)))
 
 
-def prepare_free_rewards():
+@instrument()
+def prepare_free_rewards(run_id=None):
     """
-    Prepares rewards to be sent further
+    Prepares rewards to be sent further. Operators are processed by up to
+    CR_CRON_WORKERS processes if greater than 1, each operator in its own
+    process. A process still running CR_OPERATOR_TIMEOUT seconds after it
+    started is killed and its operator counted as failed. Operators
+    completed under run_id by a previous execution are skipped. Once all
+    operators are processed, the run is marked prepared, so that shard
+    hosts waiting in wait_run_prepared() start sending.
+
+    :return: Number of operators which preparation failed
     """
     t0 = datetime.now()
     remaining_days = get_remaining_days_in_month()
-    for operator in CROperatorProfile.objects.filter(is_active=True):
-        N = operator.plan.audience_size / 30
-        service = operator.service
-        if service.status != Service.ACTIVE:
+    workers = getattr(settings, 'CR_CRON_WORKERS', 1)
+    operator_ids = [operator.id for operator in CROperatorProfile.objects.filter(is_active=True)]
+    stats_list = []
+    if workers <= 1:
+        for operator_id in operator_ids:
+            stats_list.append(_prepare_operator_free_rewards(operator_id, remaining_days, run_id))
+    else:
+        timeout = getattr(settings, 'CR_OPERATOR_TIMEOUT', 3600)
+        # Closing is a no-op on django-mongodb-engine: workers get sockets of their own
+        # because pymongo resets its pool when it runs under a new pid. Connections are
+        # closed anyway for backends that do keep a socket on the wrapper.
+        for connection in connections.all():
+            connection.close()
+        pending = list(operator_ids)
+        running = {}  # operator_id -> (process, deadline)
+        results = Queue()
+        while pending or running:
+            while pending and len(running) < workers:
+                operator_id = pending.pop(0)
+                process = Process(target=_run_operator_worker, args=(operator_id, remaining_days, run_id, results))
+                process.start()
+                running[operator_id] = (process, time.time() + timeout)
+            try:
+                operator_id, stats = results.get(timeout=1)
+                worker = running.pop(operator_id, None)
+                if worker:  # Otherwise it was counted as failed on timeout already
+                    worker[0].join()
+                    stats_list.append(stats)
+            except Empty:
+                pass
+            for operator_id, (process, deadline) in list(running.items()):
+                if time.time() > deadline:
+                    # The worker is killed to free its slot. A resumed run continues from its checkpoint.
+                    process.terminate()
+                    process.join()
+                    logger.error(u"Free rewards of operator %s not prepared within %d seconds" % (operator_id, timeout))
+                elif process.exitcode not in (None, 0):
+                    logger.error(u"Worker preparing free rewards of operator %s died with exit code %s"
+                                 % (operator_id, process.exitcode))
+                else:
+                    continue
+                del running[operator_id]
+                stats_list.append({'service': operator_id, 'error': True})
+    welcomed, rewarded, failures, skipped = 0, 0, 0, 0
+    for stats in stats_list:
+        if stats.get('error'):
+            failures += 1
             continue
-        db = service.database
-        add_database(db)
-        never_rewarded_count = 0
-
-        # Start the list with member that have never
-        # been rewarded. Those with a None last_reward
-
-        # Processing members in a Member.objects.all() may cause
-        # segmentation_fault() error. So split into chunks of 500
-        total = Member.objects.using(db).filter(is_ghost=False).count()
-        chunks = total / 500 + 1
-        for i in range(chunks):
-            start = i * 500
-            finish = (i + 1) * 500
-            if DEBUG:
-                # Process only superusers in debug mode
-                member_queryset = Member.objects.using(db).filter(is_superuser=True)
-            else:
-                member_queryset = Member.objects.using(db)
-            for member in member_queryset[start:finish]:
-                profile, update = CRProfile.objects.using(db).get_or_create(member=member)
-                last_reward = get_last_reward(member, service)
-                if not last_reward and never_rewarded_count < N:
-                    never_rewarded_count += 1
-                    for coupon in Coupon.objects.filter(service=service, is_active=True, status=Coupon.APPROVED):
-                        try:
-                            reward_pack = JoinRewardPack.objects.get(service=service, coupon=coupon, count__gt=0)
-                            member_u = Member.objects.get(pk=member.id)  # Member from umbrella
-                            Reward.objects.create(service=service, member=member_u, coupon=coupon,
-                                                  count=reward_pack.count, type=Reward.JOIN, status=Reward.PREPARED)
-                            profile.coupon_score += reward_pack.count * coupon.coefficient
-                            profile.last_reward_date = datetime.now()
-                        except:
-                            continue
-                profile.reward_score = CRProfile.FREE_REWARD
-                profile.save()
-
-        # Add extra members to reach N people
-        n = N - never_rewarded_count
-        two_days_back = t0 - timedelta(days=2)
-        list_n = list(range(n))  # Generate a list of
-        coupon_list = []
-        for coupon in Coupon.objects.filter(service=service, status=Coupon.APPROVED, is_active=True):
-            winners_count = coupon.month_quota - coupon.month_winners
-            if remaining_days == 0:
-                winners_today = winners_count
-            else:
-                winners_today = winners_count / remaining_days
-            winners_today = min(winners_today, n)
-            coupon.winning_indexes = random.sample(list_n, winners_today)
-            coupon_list.append(coupon)
-        if not coupon_list:
+        if stats.get('skipped'):
+            skipped += 1
             continue
-        i = 0
-        for profile in CRProfile.objects.using(db).filter(last_reward_date__lte=two_days_back).order_by('reward_score', 'coupon_score', 'last_reward_date')[:n]:
-            member = profile.member
-            if member.email == ARCH_EMAIL:
-                continue
-            try:
-                member_u = Member.objects.get(pk=member.id)  # Member from umbrella database
-            except Member.DoesNotExist:
-                continue
-            if DEBUG and not member.is_superuser:
-                continue  # Process only superusers in debug mode
-            for coupon in coupon_list:
-                if i in coupon.winning_indexes:
-                    cumul, update = CumulatedCoupon.objects.get_or_create(member=member_u, coupon=coupon)
-                    remaining = coupon.heap_size - cumul.count
-                    if remaining < 0:
-                        remaining = 0
-                    extra = random.randrange(3, 20, 3)
-                    count = remaining + extra
-                    reward, update = Reward.objects.get_or_create(service=service, member=member_u, coupon=coupon,
-                                                                  type=Reward.FREE, status=Reward.PREPARED)
-                    reward.count += count
-                    reward.save()
-                    profile.coupon_score += count * coupon.coefficient
-                    profile.last_reward_date = datetime.now()
-                    coupon.month_winners += 1
-                    coupon.save()
-                    break
-            else:
-                shuffled_coupon_list = list(coupon_list)
-                random.shuffle(shuffled_coupon_list)
-                all_coupon_critical = True
-                for coupon in shuffled_coupon_list:
-                    cumul, update = CumulatedCoupon.objects.get_or_create(member=member_u, coupon=coupon)
-                    CRITICAL_LIMIT = getattr(settings, 'FREE_COUPON_CRITICAL_LIMIT', 75)
-                    if cumul.count >= CRITICAL_LIMIT:
-                        continue
-                    all_coupon_critical = False
-                    offer_free_coupon(service, member_u, profile, coupon, cumul)
-                    break
-                if all_coupon_critical:
-                    coupon = random.choice(coupon_list)
-                    cumul = CumulatedCoupon.objects.get(member=member_u, coupon=coupon)
-                    offer_free_coupon(service, member_u, profile, coupon, cumul)
-            profile.reward_score = CRProfile.FREE_REWARD
-            profile.save()
-            i += 1
+        welcomed += stats['welcomed']
+        rewarded += stats['rewarded']
+        logger.debug(u"%s: %d members welcomed, %d rewarded in %d seconds" %
+                     (stats['service'], stats['welcomed'], stats['rewarded'], stats['duration']))
+    # The main process sends next whatever failed, so shards are released alike
+    checkpoint = get_checkpoint(run_id, CronCheckpoint.PREPARE)
+    checkpoint.done = True
+    save_checkpoint(checkpoint)
     duration = datetime.now() - t0
-    logger.debug("prepare_free_rewards() run in %d seconds" % duration.seconds)
+    logger.debug("prepare_free_rewards() run in %d seconds. %d operators, %d members welcomed, %d rewarded, "
+                 "%d failures, %d skipped" % (duration.seconds, len(stats_list), welcomed, rewarded, failures, skipped))
+    return failures
 
 
-def send_free_rewards():
+def simulate_free_rewards(operator, days, seed=None):
     """
-    This cron task regularly sends free rewards
-    to ikwen member
+    Projects the free rewards of an Operator over a number of days without
+    writing anything. Profiles, members, coupons and CumulatedCoupon of the
+    community are loaded once in memory, then each day is played with the
+    selection logic of prepare_operator_free_rewards(): audience_size/30
+    members, welcome of members never rewarded, month_quota paced over the
+    remaining days of the month and critical limits. Rewards of a day are
+    applied to the in-memory snapshot before playing the next day.
+
+    The projection runs no query, so its cost tells nothing about the nightly
+    code. To watch the latter, plan_free_rewards() is also run read-only for
+    the first day, as prepare_operator_free_rewards() would run it.
+
+    :return: dict with keys *service*, *seed*, *days*, a list of daily
+        projections, *totals* and *phases*. Phases *snapshot* and *planner*
+        give the wall time and number of queries of loading the snapshot and
+        of the real planner, *projection* the wall time of the projection.
     """
-    ikwen_service = get_service_instance()
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    service = operator.service
+    db = service.database
+    add_database(db)
+    N = operator.plan.audience_size / 30
+    phases = {}
+
+    def measure(name, counter):
+        phases[name] = {'duration': counter.duration, 'queries': counter.total}
+
+    with QueryCounter() as counter:
+        member_ids, candidates, rewarded_ids = [], set(), set()
+        for member_list in iter_keyset_chunks(Member.objects.using(db).all(), fields=('id', 'email', 'is_superuser')):
+            chunk_ids = [member.id for member in member_list]
+            members_u = Member.objects.only('id').in_bulk(chunk_ids)  # Members from umbrella database
+            rewarded_ids.update(get_last_reward_map(service, chunk_ids).keys())
+            for member in member_list:
+                member_ids.append(member.id)
+                if is_free_reward_candidate(member) and member.id in members_u:
+                    candidates.add(member.id)
+        profiles = {}
+        for profile in iter_keyset(CRProfile.objects.using(db).all(),
+                                   fields=('member', 'reward_score', 'coupon_score', 'last_reward_date')):
+            profiles[profile.member_id] = [profile.reward_score, profile.coupon_score, profile.last_reward_date]
+        join_pack_list = [pack for pack in get_reward_rules(service, Reward.JOIN)
+                          if pack.coupon.is_active and pack.coupon.status == Coupon.APPROVED]
+        coupon_list = list(Coupon.objects.defer(*Coupon.HISTORY_FIELDS)
+                           .filter(service=service, status=Coupon.APPROVED, is_active=True))
+        cumuls = {}
+        cumul_qs = CumulatedCoupon.objects.filter(coupon__in=[coupon.id for coupon in coupon_list])
+        for cumul in iter_keyset(cumul_qs, fields=('member', 'coupon', 'count')):
+            cumuls[(cumul.member_id, cumul.coupon_id)] = cumul.count
+    measure('snapshot', counter)
+
+    def credit(member_id, coupon, count, day):
+        cumuls[(member_id, coupon.id)] = cumuls.get((member_id, coupon.id), 0) + count
+        profile = profiles.setdefault(member_id, [CRProfile.FREE_REWARD, 0, day])
+        profile[0] = CRProfile.FREE_REWARD
+        profile[1] += count * coupon.coefficient
+        profile[2] = day
+
+    report = {'service': service.project_name, 'seed': seed, 'days': []}
+    projection_duration = 0
+    for d in range(days):
+        day = now + timedelta(days=d)
+        if d > 0 and day.month != (day - timedelta(days=1)).month:
+            for coupon in coupon_list:
+                coupon.month_winners = 0
+        projection = {'day': day.strftime('%Y-%m-%d'), 'welcomed': 0, 'rewarded': 0, 'winners': 0, 'coupons': 0}
+        t0 = time.time()
+        for member_id in member_ids:
+            # Like prepare_operator_free_rewards(), every member gets a profile set to FREE_REWARD
+            profiles.setdefault(member_id, [CRProfile.FREE_REWARD, 0, day])[0] = CRProfile.FREE_REWARD
+            if projection['welcomed'] >= N or member_id in rewarded_ids:
+                continue
+            rewarded_ids.add(member_id)
+            projection['welcomed'] += 1
+            for pack in join_pack_list:
+                credit(member_id, pack.coupon, pack.count, day)
+                projection['coupons'] += pack.count
+        n = N - projection['welcomed']
+        if d == 0:
+            # Coupons are copied as the planner sets their winning_indexes
+            with QueryCounter() as counter:
+                plan_free_rewards(service, n, [copy(coupon) for coupon in coupon_list],
+                                  get_remaining_days_in_month(day), day, seed)
+            measure('planner', counter)
+        draw_winning_indexes(coupon_list, n, get_remaining_days_in_month(day), rng)
+        two_days_back = day - timedelta(days=2)
+        candidate_ids = sorted([member_id for member_id, profile in profiles.items()
+                                if profile[2] <= two_days_back], key=lambda member_id: profiles[member_id])[:n]
+        candidate_ids = [member_id for member_id in candidate_ids if member_id in candidates]
+        rewards, winners = allocate_free_rewards(candidate_ids, cumuls, coupon_list, rng)
+        coupons = dict([(coupon.id, coupon) for coupon in coupon_list])
+        for item in rewards:
+            credit(item['member_id'], coupons[item['coupon_id']], item['count'], day)
+            rewarded_ids.add(item['member_id'])
+            projection['coupons'] += item['count']
+        for coupon in coupon_list:
+            coupon.month_winners += winners[coupon.id]
+        projection['rewarded'] = len(rewards)
+        projection['winners'] = sum(winners.values())
+        projection_duration += time.time() - t0
+        report['days'].append(projection)
+    report['totals'] = dict([(key, sum([projection[key] for projection in report['days']]))
+                             for key in ('welcomed', 'rewarded', 'winners', 'coupons')])
+    phases['projection'] = {'duration': projection_duration - phases.get('planner', {}).get('duration', 0)}
+    report['phases'] = phases
+    return report
+
+
+def render_free_reward_mail(entry):
+    """
+    Renders the free reward mail of an entry built by send_free_rewards()
+    and sets it as entry['msg']. Meant to be run in a pool of threads, so
+    the language of the member is activated in the rendering thread.
+    """
+    member = entry['member']
+    if member.language:
+        activate(member.language)
+    else:
+        activate('en')
+    subject = _("%d free coupons are waiting for you" % entry['total_coupon'])
+    html_content = get_mail_content(subject, '', template_name='rewarding/mails/free_reward.html',
+                                    extra_context={'member_name': member.first_name,
+                                                   'grouped_rewards': entry['grouped_rewards'],
+                                                   'total_coupon': entry['total_coupon'],
+                                                   'total_companies': entry['total_companies'],
+                                                   'project_names': ', '.join(entry['project_name_list'])})
+    sender = 'ikwen <no-reply@ikwen.com>'
+    msg = EmailMessage(subject, html_content, sender, [member.email])
+    msg.content_subtype = "html"
+    entry['msg'] = msg
+    return entry
+
+
+def dispatch_free_reward_mails(entry_list, connection):
+    """
+    Sends the mails of entry_list over an already opened connection.
+    Each message goes through its own send_messages() call, so that
+    a failure is isolated without risking to mail anyone twice.
+
+    :return: A tuple (sent_list, failed_list) of entries
+    """
+    sent_list, failed_list = [], []
+    for entry in entry_list:
+        try:
+            if connection.send_messages([entry['msg']]):
+                sent_list.append(entry)
+                continue
+        except:
+            logger.error(u"Free reward mail not sent to %s" % entry['member'].email, exc_info=True)
+        failed_list.append(entry)
+    return sent_list, failed_list
+
+
+def record_free_reward_mail(entry, history):
+    member = entry['member']
+    msg = entry['msg']
+    for service in entry['grouped_rewards'].keys():
+        db = service.database
+        add_database(db)
+        XEmailObject.objects.using(db).create(to=member.email, subject=msg.subject, body=msg.body,
+                                              type=XEmailObject.REWARDING, status="OK")
+        history.increment(service, 'rewarding_email_history', using=db)
+    logger.debug(u"Free reward sent to %s: %s. %s" % (member.username, member.email, entry['summary']))
+
+
+def open_mail_connection():
     connection = mail.get_connection()
     try:
         connection.open()
     except:
         logger.error(u"Connexion error", exc_info=True)
+    return connection
+
+
+@instrument()
+def send_free_rewards(run_id=None, shard=None):
+    """
+    This cron task regularly sends free rewards
+    to ikwen member
+
+    Mails are rendered by a pool of CR_MAIL_RENDER_WORKERS threads and sent
+    by batches of CR_MAIL_BATCH_SIZE over a single SMTP connection. Failed
+    mails are queued and retried CR_MAIL_MAX_RETRIES times at the end.
+
+    Rewards of a batch are claimed as SENDING under a lease of CR_SEND_LEASE
+    seconds before being processed, then set SENT, so several processes can
+    share the work. With shard (k, N), only members of shard k are processed,
+    once the run is done preparing rewards.
+    The position reached is saved in a CronCheckpoint if run_id is given,
+    so a resumed run starts from the batch that was interrupted.
+    """
+    shard_key = '%d/%d' % shard if shard else ''
+    checkpoint = get_checkpoint(run_id, CronCheckpoint.SEND, shard_key)
+    if checkpoint.done:
+        return
+    if shard and run_id:
+        wait_run_prepared(run_id)
+    ikwen_service = get_service_instance()
+    batch_size = getattr(settings, 'CR_MAIL_BATCH_SIZE', 50)
+    max_retries = getattr(settings, 'CR_MAIL_MAX_RETRIES', 2)
+    render_pool = ThreadPool(getattr(settings, 'CR_MAIL_RENDER_WORKERS', 4))
+    connection = open_mail_connection()
     t0 = datetime.now()
-    member_list = set()
-    reward_sent = 0
-    mail_sent = 0
-    for reward in Reward.objects.select_related('coupon', 'member').filter(status=Reward.PREPARED, count__gt=0):
-        member = reward.member
-        if member in member_list:
+    reward_sent = checkpoint.state.get('reward_sent', 0)
+    mail_sent = checkpoint.state.get('mail_sent', 0)
+    pending_list, retry_queue = [], []
+    history = HistoryAccumulator()
+
+    def flush(entry_list):
+        sent_list, failed_list = dispatch_free_reward_mails(render_pool.map(render_free_reward_mail, entry_list),
+                                                            connection)
+        for entry in sent_list:
+            record_free_reward_mail(entry, history)
+        retry_queue.extend(failed_list)
+        return len(sent_list)
+
+    MIN_FOR_SENDING = getattr(settings, 'CR_MIN_FOR_SENDING', 1)
+    MAX_NRM_DAYS = getattr(settings, 'CR_MAX_NRM_DAYS', 3)  # NRM = No Reward Message
+    owner = uuid4().hex
+    lease = getattr(settings, 'CR_SEND_LEASE', 600)
+    release_expired_leases()
+    member_ids, service_ids = load_prepared_rewards(shard)
+    if checkpoint.position:
+        member_ids = [member_id for member_id in member_ids if member_id > checkpoint.position]
+    lookups = load_reward_lookups(service_ids)
+    for i in range(0, len(member_ids), batch_size):
+        claimed = claim_prepared_rewards(member_ids[i:i + batch_size], owner, lease)
+        if not claimed:
             continue
-        reward_qs = Reward.objects.filter(member=member, status=Reward.PREPARED, count__gt=0)
-        reward_count = reward_qs.count()
-        last_reward = reward_qs.order_by('-id')[0]
-        diff = t0 - last_reward.created_on
-        MIN_FOR_SENDING = getattr(settings, 'CR_MIN_FOR_SENDING', 1)
-        MAX_NRM_DAYS = getattr(settings, 'CR_MAX_NRM_DAYS', 3)  # NRM = No Reward Message
-        if reward_count >= MIN_FOR_SENDING or diff.days >= MAX_NRM_DAYS:
-            member_list.add(member)
-            grouped_rewards = group_rewards_by_service(member)
-            reward_sent += 1
-            total_coupon = 0
-            total_companies = 0
-            project_name_list = []
-            summary = []
-            for service, reward_list in grouped_rewards.items():
-                coupons = ['%s: %d' % (reward.coupon.name, reward.count) for reward in reward_list]
-                val = service.project_name + ' ' + ','.join(coupons)
-                total_coupon += reward.count
-                total_companies += 1
-                project_name_list.append(service.project_name)
-                summary.append(val)
-            summary = ' - '.join(summary)
-            if last_reward.type == Reward.JOIN:
+        batch = sorted(claimed.items())
+        members = Member.objects.in_bulk([member_id for member_id, reward_list in batch])
+        batch_entries, credit_list, sent_member_ids = [], [], []
+        for member_id, reward_list in batch:
+            member = members.get(member_id)
+            if not member:
+                continue
+            last_reward = reward_list[-1]
+            diff = t0 - last_reward.created_on
+            if len(reward_list) >= MIN_FOR_SENDING or diff.days >= MAX_NRM_DAYS:
+                sent_member_ids.append(member.id)
+                grouped_rewards = group_rewards_by_service(member, reward_list, lookups, history)
+                reward_sent += 1
+                total_coupon = 0
+                total_companies = 0
+                project_name_list = []
+                summary = []
+                for service, service_reward_list in grouped_rewards.items():
+                    credit_list.extend(service_reward_list)
+                    coupons = ['%s: %d' % (reward.coupon.name, reward.count) for reward in service_reward_list]
+                    val = service.project_name + ' ' + ','.join(coupons)
+                    total_coupon += sum([reward.count for reward in service_reward_list])
+                    total_companies += 1
+                    project_name_list.append(service.project_name)
+                    summary.append(val)
+                summary = ' - '.join(summary)
+                batch_entries.append({'member': member, 'grouped_rewards': grouped_rewards,
+                                      'total_coupon': total_coupon, 'total_companies': total_companies,
+                                      'project_name_list': project_name_list, 'summary': summary,
+                                      'last_reward': last_reward})
+        credit_prepared_rewards(credit_list)
+        for entry in batch_entries:
+            member = entry['member']
+            if entry['last_reward'].type == Reward.JOIN:
                 add_event(ikwen_service, WELCOME_REWARD_OFFERED, member=member, )
             else:
                 add_event(ikwen_service, FREE_REWARD_OFFERED, member=member, )
             if member.email:
-                if member.language:
-                    activate(member.language)
-                else:
-                    activate('en')
-                subject = _("%d free coupons are waiting for you" % total_coupon)
-                html_content = get_mail_content(subject, '', template_name='rewarding/mails/free_reward.html',
-                                                extra_context={'member_name': member.first_name,
-                                                               'grouped_rewards': grouped_rewards,
-                                                               'total_coupon': total_coupon, 'total_companies': total_companies,
-                                                               'project_names': ', '.join(project_name_list)})
-                sender = 'ikwen <no-reply@ikwen.com>'
-                msg = EmailMessage(subject, html_content, sender, [member.email])
-                msg.content_subtype = "html"
-                try:
-                    if msg.send():
-                        for service, reward_list in grouped_rewards.items():
-                            db = service.database
-                            add_database(db)
-                            service_original = Service.objects.using(db).get(pk=service.id)
-                            XEmailObject.objects.using(db).create(to=member.email, subject=subject, body=html_content,
-                                                                  type=XEmailObject.REWARDING, status="OK")
-                            set_counters(service_original)
-                            increment_history_field(service_original, 'rewarding_email_history')
-                        mail_sent += 1
-                        logger.debug(u"Free reward sent to %s: %s. %s" % (member.username, member.email, summary))
-                    else:
-                        logger.error(u"Free reward set but not sent to %s: %s. %s" % (member.username, member.email, summary),
-                                     exc_info=True)
-                except:
-                    logger.error(u"Free reward set but not sent to %s: %s. %s" % (member.username, member.email, summary),
-                                 exc_info=True)
+                pending_list.append(entry)
 
             # if sms_text:
             #     if member.phone:
@@ -312,14 +1001,90 @@ def send_free_rewards():
             #             send_sms(member.phone, sms_text)
             #         else:
             #             QueuedSMS.objects.create(recipient=member.phone, text=sms_text)
-    for member in member_list:
-        Reward.objects.filter(member=member, status=Reward.PREPARED).update(status=Reward.SENT)
+        if pending_list:
+            mail_sent += flush(pending_list)
+            pending_list = []
+        claimed_rewards = Reward.objects.filter(member__in=list(claimed.keys()), status=Reward.SENDING,
+                                                lease_owner=owner)
+        if sent_member_ids:
+            claimed_rewards.filter(member__in=sent_member_ids)\
+                .update(status=Reward.SENT, lease_owner=None, lease_expiry=None)
+        # Rewards of members not sent this time are left to the next runs
+        claimed_rewards.update(status=Reward.PREPARED, lease_owner=None, lease_expiry=None)
+        count_rows(sum([len(reward_list) for member_id, reward_list in batch]))
+        history.flush()
+        checkpoint.position = batch[-1][0]
+        checkpoint.state.update({'reward_sent': reward_sent, 'mail_sent': mail_sent})
+        save_checkpoint(checkpoint)
+    for i in range(max_retries):
+        if not retry_queue:
+            break
+        try:
+            connection.close()
+        except:
+            pass
+        connection = open_mail_connection()
+        entry_list = list(retry_queue)
+        del retry_queue[:]
+        sent_list, failed_list = dispatch_free_reward_mails(entry_list, connection)
+        for entry in sent_list:
+            record_free_reward_mail(entry, history)
+        mail_sent += len(sent_list)
+        retry_queue.extend(failed_list)
+    for entry in retry_queue:
+        member = entry['member']
+        logger.error(u"Free reward set but not sent to %s: %s. %s" % (member.username, member.email, entry['summary']))
+    render_pool.close()
+    history.flush()
+    checkpoint.done = True
+    save_checkpoint(checkpoint)
     try:
         connection.close()
     finally:
         pass
     duration = datetime.now() - t0
-    logger.debug("send_free_rewards() run in %d seconds" % duration.seconds)
+    logger.debug("send_free_rewards() run in %d seconds. %d members rewarded, %d mails sent" %
+                 (duration.seconds, reward_sent, mail_sent))
+
+
+@instrument()
+def drain_reward_queues():
+    """
+    Processes rewards enqueued with reward_member_async()
+    in the local database of every active Operator
+    """
+    t0 = datetime.now()
+    total_done, total_failed = 0, 0
+    for operator in CROperatorProfile.objects.filter(is_active=True):
+        service = operator.service
+        db = service.database
+        add_database(db)
+        done_count, failed_count = process_reward_jobs(db)
+        total_done += done_count
+        total_failed += failed_count
+    duration = datetime.now() - t0
+    logger.debug("drain_reward_queues() run in %d seconds. %d jobs done, %d failed" %
+                 (duration.seconds, total_done, total_failed))
+
+
+@instrument()
+def resume_coupon_purges():
+    """
+    Resumes the purges of deleted coupons
+    that were interrupted before completion
+    """
+    for purge in CouponPurge.objects.filter(lease_expiry__lte=datetime.now()).exclude(status=CouponPurge.COMPLETE):
+        logger.debug("Resuming purge of coupon %s at %d%%" % (purge.coupon_id, purge.percentage))
+        run_coupon_purge(purge)
+
+
+@instrument()
+def snapshot_coupon_balances():
+    """
+    Materializes the ledger balances of all coupons not deleted
+    """
+    for coupon in Coupon.objects.defer(*Coupon.HISTORY_FIELDS).filter(deleted=False):
+        take_balance_snapshots(coupon)
 
 
 # def remind_100_coupon_reached():
@@ -466,15 +1231,49 @@ def send_free_rewards():
 
 
 if __name__ == "__main__":
+    run = None
     try:
         try:
             DEBUG = sys.argv[1] == 'debug'
         except IndexError:
             DEBUG = False
-        yesterday = now - timedelta(days=1)
-        if yesterday.month != now.month:
-            Coupon.objects.update(month_winners=0)
-        prepare_free_rewards()
-        send_free_rewards()
+        DRY_RUN = 'dryrun' in sys.argv[1:]
+        if 'simulate' in sys.argv[1:]:
+            # reward_crons.py simulate --operator <operator_id> [--days 30] [--seed <seed>]
+            argv = sys.argv[1:]
+            operator = CROperatorProfile.objects.get(pk=argv[argv.index('--operator') + 1])
+            days = int(argv[argv.index('--days') + 1]) if '--days' in argv else 30
+            seed = int(argv[argv.index('--seed') + 1]) if '--seed' in argv else None
+            print(json.dumps(simulate_free_rewards(operator, days, seed), indent=2, sort_keys=True))
+        elif 'jobs' in sys.argv[1:]:
+            drain_reward_queues()
+            resume_coupon_purges()
+            snapshot_coupon_balances()
+        elif DRY_RUN:
+            prepare_free_rewards()
+        elif '--shard' in sys.argv[1:]:
+            # reward_crons.py --shard <k>/<N> --run <run_id>
+            # Extra hosts share the send phase of the main run, once it is done preparing rewards
+            argv = sys.argv[1:]
+            shard = parse_shard(argv)
+            main_run = attach_cron_run(argv[argv.index('--run') + 1])
+            send_free_rewards(main_run.id, shard)
+        else:
+            # With 'resume', the last main run that failed is continued under its run ID
+            run = get_cron_run('resume' in sys.argv[1:])
+            logger.debug("Free rewards run %s started" % run.id)
+            yesterday = now - timedelta(days=1)
+            reset = get_checkpoint(run.id, CronCheckpoint.RESET)
+            if yesterday.month != now.month and not reset.done:
+                Coupon.objects.update(month_winners=0)
+                reset.done = True
+                save_checkpoint(reset)
+            failures = prepare_free_rewards(run.id)
+            send_free_rewards(run.id)
+            run.status = CronRun.FAILED if failures else CronRun.COMPLETE
+            run.finished_on = datetime.now()
+            run.save()
     except:
         logger.error(u"Fatal error occured", exc_info=True)
+        if run:
+            CronRun.objects.filter(pk=run.id).update(status=CronRun.FAILED)
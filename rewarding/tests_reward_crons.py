@@ -2,7 +2,10 @@
 import json
 from datetime import timedelta
 
+from django.core import mail
+from django.core.mail.backends import locmem
 from django.core.management import call_command
+from django.db.models import F
 from django.test.client import Client
 from django.test.utils import override_settings
 from django.utils import unittest
@@ -13,7 +16,22 @@ from ikwen.rewarding.tests_views import wipe_test_data
 from ikwen.rewarding.models import *
 from ikwen.rewarding.utils import *
 
-from ikwen.rewarding.reward_crons import prepare_free_rewards, send_free_rewards
+from ikwen.rewarding.reward_crons import prepare_free_rewards, send_free_rewards, get_cron_run, get_checkpoint, \
+    attach_cron_run, plan_free_rewards, apply_free_reward_plan, claim_prepared_rewards, release_expired_leases, \
+    load_prepared_rewards, simulate_free_rewards, credit_prepared_rewards
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """
+    Fails the next *failures* messages, as a dropping SMTP server would.
+    """
+    failures = 0
+
+    def send_messages(self, messages):
+        if FlakyEmailBackend.failures > 0:
+            FlakyEmailBackend.failures -= 1
+            raise IOError("Connection dropped")
+        return super(FlakyEmailBackend, self).send_messages(messages)
 
 
 class RewardingRewardingCronsTestCase(unittest.TestCase):
@@ -100,3 +118,208 @@ class RewardingRewardingCronsTestCase(unittest.TestCase):
                 self.assertGreater(cumul.count, 0)
             summary = CouponSummary.objects.get(service=service, member=member)
             self.assertGreater(summary.count, 30)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102',
+                       EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                       CR_MIN_FOR_SENDING=0)
+    def test_free_rewards_run_interrupted_then_resumed(self):
+        service = Service.objects.get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        for member in Member.objects.all():
+            member.customer_on_fk_list = ['56eb6d04b37b3379b531b101', '56eb6d04b37b3379b531b102', '56eb6d04b37b3379b531b103']
+            member.save()
+        run = get_cron_run()
+        self.assertEqual(get_checkpoint(run.id, CronCheckpoint.RESET).run_id, run.id)
+        self.assertEqual(prepare_free_rewards(run.id), 0)
+        prepared_count = Reward.objects.filter(service=service, status=Reward.PREPARED).count()
+        self.assertGreater(prepared_count, 0)
+        # Run dies before sending
+        run.status = CronRun.FAILED
+        run.save()
+
+        resumed = get_cron_run(resume=True)
+        self.assertEqual(resumed.id, run.id)
+        self.assertEqual(prepare_free_rewards(resumed.id), 0)
+        self.assertEqual(Reward.objects.filter(service=service).count(), prepared_count)
+        send_free_rewards(resumed.id)
+        self.assertEqual(Reward.objects.filter(service=service, status=Reward.SENT).count(), prepared_count)
+        self.assertTrue(get_checkpoint(resumed.id, CronCheckpoint.SEND).done)
+        send_free_rewards(resumed.id)  # Done already, nothing is credited twice
+        total = sum([reward.count for reward in Reward.objects.filter(service=service)])
+        self.assertEqual(sum([cumul.count for cumul in CumulatedCoupon.objects.all()]), total)
+
+    @override_settings(CR_SHARD_MAX_WAIT=0)
+    def test_get_cron_run_resumes_only_failed_main_runs(self):
+        failed = CronRun.objects.create(kind=CronRun.MAIN, status=CronRun.FAILED)
+        CronRun.objects.create(kind='', status=CronRun.FAILED)  # Shard run of a former version
+        self.assertEqual(get_cron_run(resume=True).id, failed.id)
+        # The failed run is running again, so a new run is created
+        running = get_cron_run(resume=True)
+        self.assertNotEqual(running.id, failed.id)
+        # Failed again, but a newer run exists: resuming would replay a stale day
+        CronRun.objects.filter(pk=failed.id).update(status=CronRun.FAILED)
+        self.assertRaises(ValueError, get_cron_run, True)
+        # Shards do not join a run still preparing rewards
+        self.assertRaises(ValueError, attach_cron_run, running.id)
+        CronCheckpoint.objects.create(run=running, phase=CronCheckpoint.PREPARE, done=True)
+        self.assertEqual(attach_cron_run(running.id).status, CronRun.RUNNING)
+        running.status = CronRun.COMPLETE
+        running.save()
+        self.assertRaises(CronRun.DoesNotExist, attach_cron_run, running.id)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', CR_FREE_REWARD_SEED=42)
+    def test_free_reward_plan_is_deterministic_and_applied_once(self):
+        service = Service.objects.get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        db = service.database
+        add_database(db)
+        last_reward_date = datetime.now() - timedelta(days=10)
+        for member in Member.objects.using(db).exclude(email=ARCH_EMAIL):
+            CRProfile.objects.using(db).create(member=member, last_reward_date=last_reward_date)
+        coupon_qs = Coupon.objects.filter(service=service, status=Coupon.APPROVED, is_active=True)
+        seed = getattr(settings, 'CR_FREE_REWARD_SEED')
+        t0 = datetime.now()
+        plan = plan_free_rewards(service, 10, list(coupon_qs), 15, t0, seed)
+        replay = plan_free_rewards(service, 10, list(coupon_qs), 15, t0, seed)
+        self.assertGreater(len(plan['rewards']), 0)
+        self.assertEqual(plan['rewards'], replay['rewards'])
+        self.assertEqual(plan['winners'], replay['winners'])
+
+        run = get_cron_run()
+        apply_free_reward_plan(plan, list(coupon_qs), get_checkpoint(run.id, CronCheckpoint.PREPARE, 'test'))
+        # Applying again under the same run, as a resumed run would, writes nothing more
+        apply_free_reward_plan(plan, list(coupon_qs), get_checkpoint(run.id, CronCheckpoint.PREPARE, 'test'))
+        reward_qs = Reward.objects.filter(service=service, type=Reward.FREE)
+        self.assertEqual(sum([reward.count for reward in reward_qs]), sum([item['count'] for item in plan['rewards']]))
+
+    def prepare_with_workers(self, workers):
+        service = Service.objects.get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        db = service.database
+        add_database(db)
+        last_reward_date = datetime.now() - timedelta(days=10)
+        for member in Member.objects.using(db).exclude(email=ARCH_EMAIL):
+            CRProfile.objects.using(db).create(member=member, last_reward_date=last_reward_date)
+        with override_settings(CR_CRON_WORKERS=workers):
+            self.assertEqual(prepare_free_rewards(), 0)
+        rewards = sorted([(reward.service_id, reward.member_id, reward.coupon_id, reward.count, reward.type)
+                          for reward in Reward.objects.all()])
+        profiles = sorted([(profile.member_id, profile.reward_score, profile.coupon_score)
+                           for profile in CRProfile.objects.using(db).all()])
+        return rewards, profiles
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', CR_FREE_REWARD_SEED=42)
+    def test_prepare_free_rewards_with_workers_matches_serial_run(self):
+        rewards, profiles = self.prepare_with_workers(2)
+        self.assertGreater(len(rewards), 0)
+        self.tearDown()
+        self.setUp()
+        self.assertEqual(self.prepare_with_workers(1), (rewards, profiles))
+
+    def prepare_rewards(self):
+        service = Service.objects.get(pk='56eb6d04b37b3379b531b102')
+        c1 = Coupon.objects.get(pk='593928184fc0c279dc0f73b1')
+        member_ids = []
+        for member in Member.objects.exclude(email=ARCH_EMAIL):
+            Reward.objects.create(service=service, member=member, coupon=c1, count=5,
+                                  type=Reward.FREE, status=Reward.PREPARED)
+            member_ids.append(member.id)
+        return member_ids
+
+    def test_credit_prepared_rewards_credits_only_what_is_not_credited_yet(self):
+        member_ids = self.prepare_rewards()
+        c1 = '593928184fc0c279dc0f73b1'
+        reward_list = list(Reward.objects.filter(member__in=member_ids))
+        credit_prepared_rewards(reward_list)
+        credit_prepared_rewards(reward_list)  # Resumed run: credited already
+        for member_id in member_ids:
+            self.assertEqual(CumulatedCoupon.objects.get(member=member_id, coupon=c1).count, 5)
+        # Count of a reward credited is increased by a later preparation
+        reward = reward_list[0]
+        Reward.objects.filter(pk=reward.id).update(count=F('count') + 3)
+        credit_prepared_rewards(list(Reward.objects.filter(member__in=member_ids)))
+        self.assertEqual(CumulatedCoupon.objects.get(member=reward.member_id, coupon=c1).count, 8)
+        self.assertEqual(sum([cumul.count for cumul in CumulatedCoupon.objects.filter(coupon=c1)]),
+                         5 * len(member_ids) + 3)
+
+    def test_expired_lease_is_released_then_claimed_again(self):
+        member_ids = self.prepare_rewards()
+        claimed = claim_prepared_rewards(member_ids, 'dead-host', -1)  # Lease expired already
+        self.assertEqual(sorted(claimed.keys()), sorted(member_ids))
+        self.assertEqual(claim_prepared_rewards(member_ids, 'live-host', 600), {})
+        release_expired_leases()
+        self.assertEqual(Reward.objects.filter(status=Reward.SENDING).count(), 0)
+        claimed = claim_prepared_rewards(member_ids, 'live-host', 600)
+        self.assertEqual(sorted(claimed.keys()), sorted(member_ids))
+        # A lease still running is left to its owner
+        release_expired_leases()
+        self.assertEqual(Reward.objects.filter(status=Reward.SENDING, lease_owner='live-host').count(),
+                         len(member_ids))
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102',
+                       EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                       CR_MIN_FOR_SENDING=0, CR_MAIL_BATCH_SIZE=1)
+    def test_two_shards_split_members_without_overlap(self):
+        member_ids = self.prepare_rewards()
+        shard0, service_ids = load_prepared_rewards((0, 2))
+        shard1, service_ids = load_prepared_rewards((1, 2))
+        self.assertEqual(set(shard0) & set(shard1), set())
+        self.assertEqual(sorted(shard0 + shard1), sorted(member_ids))
+
+        run = get_cron_run()
+        CronCheckpoint.objects.create(run=run, phase=CronCheckpoint.PREPARE, done=True)
+        send_free_rewards(run.id, (0, 2))
+        self.assertEqual(sorted(Reward.objects.filter(status=Reward.SENT).values_list('member', flat=True)),
+                         sorted(shard0))
+        send_free_rewards(run.id, (1, 2))
+        self.assertEqual(Reward.objects.filter(status=Reward.SENT).count(), len(member_ids))
+        for member_id in member_ids:
+            self.assertEqual(CumulatedCoupon.objects.get(member=member_id, coupon='593928184fc0c279dc0f73b1').count, 5)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102',
+                       EMAIL_BACKEND='ikwen.rewarding.tests_reward_crons.FlakyEmailBackend',
+                       CR_MIN_FOR_SENDING=0, CR_MAIL_MAX_RETRIES=2)
+    def test_send_free_rewards_retries_failed_mails(self):
+        member_ids = self.prepare_rewards()
+        mail.outbox = []
+        FlakyEmailBackend.failures = 2
+        send_free_rewards()
+        recipients = [member.email for member in Member.objects.filter(pk__in=member_ids) if member.email]
+        self.assertEqual(FlakyEmailBackend.failures, 0)
+        self.assertEqual(sorted([msg.to[0] for msg in mail.outbox]), sorted(recipients))
+        self.assertEqual(Reward.objects.filter(status=Reward.SENT).count(), len(member_ids))
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102',
+                       EMAIL_BACKEND='ikwen.rewarding.tests_reward_crons.FlakyEmailBackend',
+                       CR_MIN_FOR_SENDING=0, CR_MAIL_MAX_RETRIES=2)
+    def test_send_free_rewards_gives_up_after_max_retries(self):
+        member_ids = self.prepare_rewards()
+        mail.outbox = []
+        FlakyEmailBackend.failures = 1000
+        send_free_rewards()
+        FlakyEmailBackend.failures = 0
+        self.assertEqual(len(mail.outbox), 0)
+        # Rewards are credited anyway, only the mail is lost
+        self.assertEqual(Reward.objects.filter(status=Reward.SENT).count(), len(member_ids))
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_simulate_free_rewards(self):
+        service = Service.objects.get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        db = service.database
+        add_database(db)
+        operator = CROperatorProfile.objects.get(service=service)
+        report = simulate_free_rewards(operator, 3, seed=42)
+        self.assertEqual(report['seed'], 42)
+        self.assertEqual(len(report['days']), 3)
+        # Every member is welcomed the first day and only then
+        N = operator.plan.audience_size / 30
+        self.assertEqual(report['days'][0]['welcomed'], min(N, Member.objects.using(db).count()))
+        self.assertEqual(report['days'][1]['welcomed'], 0)
+        self.assertGreater(report['days'][0]['coupons'], 0)
+        for key in ('welcomed', 'rewarded', 'winners', 'coupons'):
+            self.assertEqual(report['totals'][key], sum([projection[key] for projection in report['days']]))
+        phases = report['phases']
+        self.assertGreater(phases['snapshot']['queries'], 0)
+        self.assertGreater(phases['planner']['queries'], 0)
+        self.assertNotIn('queries', phases['projection'])
+        # Nothing is written and the same seed projects the same plan
+        self.assertEqual(Reward.objects.all().count(), 0)
+        self.assertEqual(CumulatedCoupon.objects.all().count(), 0)
+        self.assertEqual(simulate_free_rewards(operator, 3, seed=42)['days'], report['days'])
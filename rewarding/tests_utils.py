@@ -1,18 +1,29 @@
 # -*- coding: utf-8 -*-
 import json
+import hashlib
+from datetime import date, datetime, timedelta
 
 from django.core.management import call_command
 from django.test.client import Client
 from django.test.utils import override_settings
 from django.utils import unittest
 from django.conf import settings
+from django.db.models.query import QuerySet
+
+from ikwen.core.utils import set_counters
 
 from ikwen.accesscontrol.models import Member
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.core.models import Service
 from ikwen.rewarding.models import Coupon, Reward, JoinRewardPack, CumulatedCoupon, CouponSummary, PaymentRewardPack, \
-    ReferralRewardPack, CouponUse
-from ikwen.rewarding.utils import reward_member, use_coupon, donate_coupon
+    ReferralRewardPack, CouponUse, RewardJob, CROperatorProfile, CouponWinner, RewardReceipt, CouponLedgerEntry, \
+    CRProfile
+from ikwen.rewarding.utils import reward_member, use_coupon, donate_coupon, find_payment_reward_packs, \
+    invalidate_payment_interval_index, reward_member_async, process_reward_jobs, iter_keyset_chunks, \
+    increment_metric, get_metric_series, rollup_metric_series, get_active_operator_profile, get_coupon_catalogue, \
+    get_coupon_balance, take_balance_snapshots, verify_coupon_balances, donate_coupons_bulk, reward_members_bulk, \
+    get_metrics, reset_metrics, debit_cumulated_coupon, swap_cumulated_count, HistoryAccumulator, QueryCounter, \
+    claim_reward_receipt, open_coupon_ledger, add_cumulated_count, get_last_reward_map
 from ikwen.rewarding.tests_views import wipe_test_data
 
 
@@ -86,6 +97,350 @@ class RewardingUtilsTestCase(unittest.TestCase):
         scs = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
         self.assertEqual(scs.count, total_count)
 
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_reward_member_with_payment_callback_retried(self):
+        member = Member.objects.using(UMBRELLA).get(username='member3')
+        service = Service.objects.using(UMBRELLA).get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        amount = 8000
+        reward_pack_list, coupon_count = reward_member(service, member, Reward.PAYMENT, amount=amount,
+                                                       object_id='56eb6d04b37b3379b531b102', model_name='core.Service')
+        replay_pack_list, replay_count = reward_member(service, member, Reward.PAYMENT, amount=amount,
+                                                       object_id='56eb6d04b37b3379b531b102', model_name='core.Service')
+        self.assertEqual(replay_count, coupon_count)
+        self.assertEqual(sorted([(pack.coupon.id, pack.count) for pack in replay_pack_list]),
+                         sorted([(pack.coupon.id, pack.count) for pack in reward_pack_list]))
+        self.assertEqual(Reward.objects.using(UMBRELLA).filter(member=member).count(), len(reward_pack_list))
+        scs = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(scs.count, coupon_count)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_reward_member_payment_after_process_died(self):
+        member = Member.objects.using(UMBRELLA).get(username='member3')
+        service = Service.objects.using(UMBRELLA).get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        amount = 8000
+        object_id = '56eb6d04b37b3379b531b102'
+        # Process claimed the receipt then died before writing rewards
+        receipt = claim_reward_receipt(service.id, member.id, Reward.PAYMENT, object_id,
+                                       datetime.now() + timedelta(seconds=300))
+        # Retry while the lease runs does nothing
+        self.assertEqual(reward_member(service, member, Reward.PAYMENT, amount=amount,
+                                       object_id=object_id, model_name='core.Service'), ([], 0))
+        RewardReceipt.objects.using(UMBRELLA).filter(pk=receipt.id)\
+            .update(lease_expiry=datetime.now() - timedelta(seconds=1))
+        reward_pack_list, coupon_count = reward_member(service, member, Reward.PAYMENT, amount=amount,
+                                                       object_id=object_id, model_name='core.Service')
+        self.assertGreater(coupon_count, 0)
+        self.assertTrue(RewardReceipt.objects.using(UMBRELLA).get(pk=receipt.id).is_complete)
+        scs = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(scs.count, coupon_count)
+        # Complete receipts are not taken over
+        replay_pack_list, replay_count = reward_member(service, member, Reward.PAYMENT, amount=amount,
+                                                       object_id=object_id, model_name='core.Service')
+        self.assertEqual(replay_count, coupon_count)
+        self.assertEqual(CouponSummary.objects.using(UMBRELLA).get(service=service, member=member).count,
+                         coupon_count)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_reward_member_async(self):
+        member = Member.objects.get(username='member3')
+        service = Service.objects.get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        amount = 8000
+        for i in range(2):  # Simulates the payment callback being called twice
+            reward_member_async(service, member, Reward.PAYMENT, amount=amount,
+                                object_id='56eb6d04b37b3379b531b102', model_name='core.Service')
+        self.assertEqual(RewardJob.objects.filter(status=RewardJob.PENDING).count(), 1)
+        self.assertEqual(Reward.objects.using(UMBRELLA).filter(member=member).count(), 0)
+
+        done_count, failed_count = process_reward_jobs()
+        self.assertEqual((done_count, failed_count), (1, 0))
+        RewardJob.objects.get(status=RewardJob.DONE)
+        total_count = 0
+        for pr in PaymentRewardPack.objects.using(UMBRELLA).filter(service=service, floor__lt=amount, ceiling__gte=amount):
+            total_count += pr.count
+            Reward.objects.using(UMBRELLA).get(member=member, coupon=pr.coupon, count=pr.count,
+                                               type=Reward.PAYMENT, status=Reward.SENT)
+        scs = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(scs.count, total_count)
+
+        # Worker died after running the job but before saving it: the lease expires and the job is run again
+        job = RewardJob.objects.get(status=RewardJob.DONE)
+        job.status = RewardJob.RUNNING
+        job.lease_expiry = datetime.now() - timedelta(seconds=1)
+        job.save()
+        self.assertEqual(process_reward_jobs(), (1, 0))
+        RewardJob.objects.get(status=RewardJob.DONE)
+        scs = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(scs.count, total_count)
+        self.assertEqual(Reward.objects.using(UMBRELLA).filter(member=member).count(),
+                         PaymentRewardPack.objects.using(UMBRELLA).filter(service=service, floor__lt=amount,
+                                                                          ceiling__gte=amount).count())
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_process_reward_jobs_after_worker_died_before_rewarding(self):
+        member = Member.objects.get(username='member3')
+        service = Service.objects.get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        job = reward_member_async(service, member, Reward.MANUAL, coupon=coupon, count=5)
+        # Worker claimed the job and its receipt, then died before writing the reward
+        job.status = RewardJob.RUNNING
+        job.lease_expiry = datetime.now() - timedelta(seconds=1)
+        job.save()
+        receipt = claim_reward_receipt(service.id, member.id, Reward.MANUAL,
+                                       hashlib.sha1(job.idempotency_key.encode('utf-8')).hexdigest(), job.lease_expiry)
+        self.assertIsNotNone(receipt)
+        self.assertEqual(process_reward_jobs(), (1, 0))
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=member, coupon=coupon).count, 5)
+        self.assertTrue(RewardReceipt.objects.using(UMBRELLA).get(pk=receipt.id).is_complete)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_reward_member_increments_summary_and_profile(self):
+        member = Member.objects.using(UMBRELLA).get(username='member3')
+        service = Service.objects.using(UMBRELLA).get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        self.assertEqual(add_cumulated_count(member.id, coupon, 10, exists=False), (0, 10))
+        self.assertEqual(add_cumulated_count(member.id, coupon, coupon.heap_size - 20), (10, coupon.heap_size - 10))
+        # Written by another process, must not be overwritten
+        CouponSummary.objects.using(UMBRELLA).create(service=service, member=member, count=coupon.heap_size - 10,
+                                                     heaps_reached=2, threshold_reached=True)
+        CRProfile.objects.create(member=member, coupon_score=7)
+        reward_member(service, member, Reward.MANUAL, coupon=coupon, count=20)
+        summary = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual((summary.count, summary.heaps_reached), (coupon.heap_size + 10, 3))
+        profile = CRProfile.objects.get(member=member)
+        self.assertEqual(profile.coupon_score, 7 + 20 * coupon.coefficient)
+        self.assertEqual(profile.reward_score, CRProfile.MANUAL_REWARD)
+        CouponWinner.objects.using(UMBRELLA).get(member=member, coupon=coupon)
+
+    def test_iter_keyset_chunks(self):
+        chunk_list = list(iter_keyset_chunks(Member.objects.all(), chunk_size=2, fields=('id', )))
+        member_ids = [member.id for chunk in chunk_list for member in chunk]
+        self.assertTrue(all([len(chunk) <= 2 for chunk in chunk_list]))
+        self.assertEqual(member_ids, sorted(member_ids))
+        self.assertEqual(set(member_ids), set([member.id for member in Member.objects.all()]))
+
+    def test_get_last_reward_map(self):
+        service = Service.objects.get(pk='56eb6d04b37b3379b531b102')
+        coupon = Coupon.objects.get(pk='593928184fc0c279dc0f73b1')
+        member2 = Member.objects.get(username='member2')
+        member3 = Member.objects.get(username='member3')
+        Reward.objects.create(service=service, member=member2, coupon=coupon, count=5)
+        last = Reward.objects.create(service=service, member=member2, coupon=coupon, count=5)
+        Reward.objects.create(service=service, member=member3, coupon=coupon, count=5)
+        # Only members of the chunk are looked up
+        self.assertEqual(get_last_reward_map(service, [member2.id]), {member2.id: last.id})
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_get_active_operator_profile(self):
+        service = Service.objects.using(UMBRELLA).get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        self.assertIsNotNone(get_active_operator_profile(service))
+        operator = CROperatorProfile.objects.using(UMBRELLA).get(service=service)
+        operator.is_active = False
+        operator.save()
+        self.assertIsNone(get_active_operator_profile(service))
+        self.assertEqual(reward_member(service, Member.objects.using(UMBRELLA).get(username='member3'),
+                                       Reward.JOIN), (None, 0))
+        operator.is_active = True
+        operator.save()
+        self.assertIsNotNone(get_active_operator_profile(service))
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_get_coupon_catalogue(self):
+        service = Service.objects.using(UMBRELLA).get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        catalogue = get_coupon_catalogue(service)
+        self.assertEqual(get_coupon_catalogue(service)['version'], catalogue['version'])
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        coupon.heap_size = 50
+        coupon.save()
+        catalogue2 = get_coupon_catalogue(service)
+        self.assertNotEqual(catalogue2['version'], catalogue['version'])
+        self.assertEqual(catalogue2['coupons'][coupon.id].heap_size, 50)
+        for pack in catalogue2['packs'][Reward.JOIN]:
+            self.assertEqual(pack.coupon.service_id, service.id)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', UNIT_TESTING=True)
+    def test_coupon_ledger(self):
+        donor = Member.objects.using(UMBRELLA).get(username='member3')
+        receiver = Member.objects.using(UMBRELLA).get(username='member4')
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        service = coupon.service
+        reward_member(service, donor, Reward.MANUAL, coupon=coupon, count=30)
+        donate_coupon(donor, receiver, coupon, 10, 'obj_id')
+        self.assertEqual(get_coupon_balance(donor, coupon), 20)
+        self.assertEqual(get_coupon_balance(receiver, coupon), 10)
+        take_balance_snapshots(coupon, until=datetime.now())
+        donate_coupon(donor, receiver, coupon, 5, 'obj_id')
+        self.assertEqual(get_coupon_balance(donor, coupon), 15)
+        self.assertEqual(get_coupon_balance(receiver, coupon), 15)
+        self.assertEqual(verify_coupon_balances(coupon), [])
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', UNIT_TESTING=True)
+    def test_open_coupon_ledger(self):
+        member = Member.objects.using(UMBRELLA).get(username='member3')
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        # 80 coupons held before the ledger existed, then 10 more logged in the ledger
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=member, coupon=coupon, count=80)
+        reward_member(coupon.service, member, Reward.MANUAL, coupon=coupon, count=10)
+        self.assertEqual(get_coupon_balance(member, coupon), 10)
+        self.assertRaises(ValueError, verify_coupon_balances, coupon, True)
+        call_command('open_coupon_ledger', coupon.service_id)
+        CouponLedgerEntry.objects.using(UMBRELLA).get(member=member, coupon=coupon, count=80,
+                                                      source=CouponLedgerEntry.OPENING)
+        self.assertEqual(get_coupon_balance(member, coupon), 90)
+        self.assertEqual(verify_coupon_balances(coupon, fix=True), [])
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=member, coupon=coupon).count, 90)
+        self.assertEqual(open_coupon_ledger(coupon), 0)  # Opened already
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', UNIT_TESTING=True)
+    def test_donate_coupons_bulk(self):
+        donor = Member.objects.using(UMBRELLA).get(username='member3')
+        receiver1 = Member.objects.using(UMBRELLA).get(username='member4')
+        receiver2 = Member.objects.using(UMBRELLA).get(username='member2')
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=donor, coupon=coupon, count=30)
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=receiver1, coupon=coupon, count=5)
+        self.assertRaises(ValueError, donate_coupons_bulk, donor, [(receiver1, 20), (receiver2, 20)], coupon)
+        total = donate_coupons_bulk(donor, [(receiver1, 10), (receiver2, 10)], coupon, 'obj_id')
+        self.assertEqual(total, 20)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=donor, coupon=coupon).count, 10)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=receiver1, coupon=coupon).count, 15)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=receiver2, coupon=coupon).count, 10)
+        CouponUse.objects.using(UMBRELLA).get(member=donor, coupon=coupon, usage=CouponUse.DONATION, count=20)
+        summary = CouponSummary.objects.using(UMBRELLA).get(service=coupon.service, member=receiver2)
+        self.assertEqual(summary.count, 10)
+        # A negative count would debit the receiver
+        self.assertRaises(ValueError, donate_coupons_bulk, donor, [(receiver1, 5), (receiver2, -5)], coupon)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=donor, coupon=coupon).count, 10)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=receiver2, coupon=coupon).count, 10)
+
+    def test_donate_coupons_bulk_reverts_credits_when_a_write_fails(self):
+        donor = Member.objects.using(UMBRELLA).get(username='member3')
+        receiver1 = Member.objects.using(UMBRELLA).get(username='member4')
+        receiver2 = Member.objects.using(UMBRELLA).get(username='member2')
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=donor, coupon=coupon, count=30)
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=receiver1, coupon=coupon, count=5)
+        bulk_create = QuerySet.bulk_create
+
+        def failing_bulk_create(queryset, objs, *args, **kwargs):
+            if queryset.model == CouponLedgerEntry:  # Ledger is written last, after all credits
+                raise IOError("Connection dropped")
+            return bulk_create(queryset, objs, *args, **kwargs)
+        QuerySet.bulk_create = failing_bulk_create
+        try:
+            self.assertRaises(IOError, donate_coupons_bulk, donor, [(receiver1, 10), (receiver2, 10)], coupon)
+        finally:
+            QuerySet.bulk_create = bulk_create
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=donor, coupon=coupon).count, 30)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=receiver1, coupon=coupon).count, 5)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=receiver2, coupon=coupon).count, 0)
+        self.assertEqual(CouponSummary.objects.using(UMBRELLA).get(service=coupon.service, member=receiver2).count, 0)
+        self.assertEqual(CouponUse.objects.using(UMBRELLA).filter(member=donor, coupon=coupon).count(), 0)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_reward_members_bulk(self):
+        service = Service.objects.using(UMBRELLA).get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        member2 = Member.objects.using(UMBRELLA).get(username='member2')
+        member3 = Member.objects.using(UMBRELLA).get(username='member3')
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=member3, coupon=coupon, count=coupon.heap_size - 10)
+        count = reward_members_bulk(service, coupon, 20, [member2.id, member3.id, member3.id], batch_size=1)
+        self.assertEqual(count, 2)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=member2, coupon=coupon).count, 20)
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=member3, coupon=coupon).count,
+                         coupon.heap_size + 10)
+        self.assertEqual(Reward.objects.using(UMBRELLA).filter(coupon=coupon, type=Reward.MANUAL).count(), 2)
+        CouponWinner.objects.using(UMBRELLA).get(member=member3, coupon=coupon)
+        summary = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member3)
+        self.assertTrue(summary.threshold_reached)
+
+    def test_query_counter(self):
+        with QueryCounter() as counter:
+            coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+            Coupon.objects.using(UMBRELLA).filter(pk=coupon.id).update(name=coupon.name)
+        self.assertEqual(counter.queries, {UMBRELLA: 2})
+        with QueryCounter() as outer:
+            with QueryCounter() as inner:
+                list(Member.objects.using(UMBRELLA).all())
+            Coupon.objects.using(UMBRELLA).count()
+        self.assertEqual((inner.total, outer.total), (1, 2))
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', CR_METRICS_REGISTRY=True)
+    def test_instrument_metrics(self):
+        reset_metrics()
+        service = Service.objects.using(UMBRELLA).get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        member2 = Member.objects.using(UMBRELLA).get(username='member2')
+        reward_member(service, member2, Reward.MANUAL, coupon=coupon, count=20)
+        reward_member(service, member2, Reward.MANUAL, coupon=coupon, count=20)
+        metrics = get_metrics()['utils.reward_member']
+        self.assertEqual(metrics['calls'], 2)
+        self.assertEqual(metrics['failures'], 0)
+        self.assertGreater(metrics['rows'], 0)
+        self.assertGreater(metrics['queries'].get(UMBRELLA, 0), 0)
+        reset_metrics()
+        self.assertEqual(get_metrics(), {})
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_history_accumulator_keeps_history_lists_aligned(self):
+        service_id = getattr(settings, 'IKWEN_SERVICE_ID')
+        Service.objects.filter(pk=service_id).update(counters_reset_on=datetime.now() - timedelta(days=3))
+        history = HistoryAccumulator()
+        history.increment(Service.objects.get(pk=service_id), 'rewarding_email_history', 2)
+        history.flush()
+        service = Service.objects.get(pk=service_id)
+        self.assertEqual(service.rewarding_email_history[-1], 2)
+        history_lists = dict([(field.name, list(getattr(service, field.name)))
+                              for field in service._meta.fields if field.name.endswith('_history')])
+        # All lists were shifted and written back with the reset date, so they are not shifted again
+        set_counters(service)
+        for name, value in history_lists.items():
+            self.assertEqual(getattr(service, name), value)
+
+    def test_metric_series(self):
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        today = date.today()
+        increment_metric(coupon, 'offered', 5)
+        increment_metric(coupon, 'offered', 3)
+        increment_metric(coupon, 'offered', 2, day=today - timedelta(days=2))
+        series = get_metric_series(coupon, 'offered', today - timedelta(days=3))
+        self.assertEqual([value for day, value in series], [0, 2, 0, 8])
+        self.assertEqual(sum([value for period, value in rollup_metric_series(series, 'month')]), 10)
+
+    def test_migrate_history_lists(self):
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        operator = CROperatorProfile.objects.using(UMBRELLA).all()[0]
+        reset_on = datetime.now()
+        offered_history = [4, 0, 7, 2]
+        push_history, gift_history = [1, 3, 0], [0, 5]
+        Coupon.objects.using(UMBRELLA).filter(pk=coupon.id)\
+            .update(offered_history=offered_history, counters_reset_on=reset_on)
+        CROperatorProfile.objects.using(UMBRELLA).filter(pk=operator.id)\
+            .update(push_history=push_history, gift_history=gift_history, counters_reset_on=reset_on)
+        call_command('migrate_history_lists')
+        call_command('migrate_history_lists', clear=True)  # Run again, values are not counted twice
+        today = reset_on.date()
+
+        def get_values(obj, metric, history):
+            start = today - timedelta(days=len(history) - 1)
+            return [value for day, value in get_metric_series(obj, metric, start, today)]
+        self.assertEqual(get_values(coupon, 'offered', offered_history), offered_history)
+        self.assertEqual(get_values(operator, 'push', push_history), push_history)
+        self.assertEqual(get_values(operator, 'gift', gift_history), gift_history)
+        self.assertEqual(Coupon.objects.using(UMBRELLA).get(pk=coupon.id).offered_history, [])
+        self.assertEqual(CROperatorProfile.objects.using(UMBRELLA).get(pk=operator.id).push_history, [])
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_find_payment_reward_packs(self):
+        service = Service.objects.using(UMBRELLA).get(pk=getattr(settings, 'IKWEN_SERVICE_ID'))
+        invalidate_payment_interval_index(service)
+        for amount in (0, 1, 5000, 5001, 15000, 15001):
+            pack_list = find_payment_reward_packs(service, amount)
+            expected = PaymentRewardPack.objects.using(UMBRELLA).filter(service=service, floor__lt=amount,
+                                                                        ceiling__gte=amount)
+            self.assertEqual(set([pack.id for pack in pack_list]), set([pack.id for pack in expected]))
+        self.assertEqual(len(find_payment_reward_packs(service, 5000)), 2)
+        self.assertEqual(find_payment_reward_packs(service, 15001), [])
+
     @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
     def test_use_coupon(self):
         member = Member.objects.using(UMBRELLA).get(username='member3')
@@ -104,6 +459,58 @@ class RewardingUtilsTestCase(unittest.TestCase):
         cumul = CumulatedCoupon.objects.using(UMBRELLA).get(member=member, coupon=coupon)
         self.assertEqual(cumul.count, 25)
 
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_rebuild_heaps_reached_on_existing_summaries(self):
+        member = Member.objects.using(UMBRELLA).get(username='member3')
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        service = coupon.service
+        # Data from before the counter: the heap is reached but heaps_reached is still 0
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=member, coupon=coupon, count=coupon.heap_size + 20)
+        CouponSummary.objects.using(UMBRELLA).create(service=service, member=member, count=coupon.heap_size + 20)
+        call_command('rebuild_heaps_reached', service.id)
+        summary = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(summary.heaps_reached, 1)
+        self.assertTrue(summary.threshold_reached)
+
+        use_coupon(member, coupon, 'obj_id')
+        summary = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(summary.heaps_reached, 0)
+        self.assertFalse(summary.threshold_reached)
+
+        reward_member(service, member, Reward.MANUAL, coupon=coupon, count=coupon.heap_size)
+        summary = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(summary.heaps_reached, 1)
+        self.assertTrue(summary.threshold_reached)
+
+    def test_debit_cumulated_coupon(self):
+        member = Member.objects.using(UMBRELLA).get(username='member3')
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=member, coupon=coupon, count=125)
+        before, after, coupon_use = debit_cumulated_coupon(member, coupon, 100, CouponUse.PAYMENT, 'obj_id')
+        self.assertEqual((before, after), (125, 25))
+        cumul_qs = CumulatedCoupon.objects.using(UMBRELLA).filter(member=member, coupon=coupon)
+        self.assertEqual(swap_cumulated_count(cumul_qs, 10), (25, 35))
+        self.assertRaises(ValueError, swap_cumulated_count, cumul_qs, -40)
+        self.assertEqual(cumul_qs.get().count, 35)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
+    def test_use_coupon_updates_threshold_reached(self):
+        member = Member.objects.using(UMBRELLA).get(username='member3')
+        coupon = Coupon.objects.using(UMBRELLA).get(pk='593928184fc0c279dc0f73b1')
+        service = coupon.service
+        CumulatedCoupon.objects.using(UMBRELLA).create(member=member, coupon=coupon, count=225)
+        CouponSummary.objects.using(UMBRELLA).create(service=service, member=member, count=225,
+                                                     heaps_reached=1, threshold_reached=True)
+        use_coupon(member, coupon, 'obj_id')
+        summary = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(summary.heaps_reached, 1)
+        self.assertTrue(summary.threshold_reached)
+
+        use_coupon(member, coupon, 'obj_id')
+        summary = CouponSummary.objects.using(UMBRELLA).get(service=service, member=member)
+        self.assertEqual(summary.heaps_reached, 0)
+        self.assertFalse(summary.threshold_reached)
+
     @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', UNIT_TESTING=True)
     def test_donate_coupon(self):
         donor = Member.objects.using(UMBRELLA).get(username='member3')
@@ -116,6 +523,8 @@ class RewardingUtilsTestCase(unittest.TestCase):
         CumulatedCoupon.objects.using(UMBRELLA).create(member=donor, coupon=coupon, count=30)
         # use_coupon raises a ValueError
         self.assertRaises(ValueError, donate_coupon, donor, receiver, coupon, 40, 'obj_id')
+        self.assertEqual(CumulatedCoupon.objects.using(UMBRELLA).get(member=donor, coupon=coupon).count, 30)
+        self.assertEqual(CouponUse.objects.using(UMBRELLA).filter(member=donor, coupon=coupon).count(), 0)
 
         donate_coupon(donor, receiver, coupon, count, 'obj_id')
         CouponUse.objects.using(UMBRELLA).get(member=donor, coupon=coupon,
@@ -11,7 +11,7 @@ from django.utils import unittest
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.core.utils import get_service_instance
 from ikwen.rewarding.models import Coupon, JoinRewardPack, CumulatedCoupon, CouponSummary, PaymentRewardPack, \
-    ReferralRewardPack, CROperatorProfile, CouponWinner, CRBillingPlan
+    ReferralRewardPack, CROperatorProfile, CouponWinner, CRBillingPlan, CouponPurge
 
 
 def wipe_test_data(alias='default'):
@@ -33,7 +33,9 @@ def wipe_test_data(alias='default'):
         model.objects.using(alias).all().delete()
     for name in ('Coupon', 'CRBillingPlan', 'Reward', 'CumulatedCoupon', 'CouponSummary',
                  'CouponUse', 'CouponWinner', 'CRProfile', 'CROperatorProfile',
-                 'JoinRewardPack', 'ReferralRewardPack', 'PaymentRewardPack', ):
+                 'JoinRewardPack', 'ReferralRewardPack', 'PaymentRewardPack', 'RewardJob',
+                 'RewardReceipt', 'CouponPurge', 'HistoryBucket',
+                 'CouponLedgerEntry', 'CouponBalanceSnapshot', 'CronRun', 'CronCheckpoint', ):
         model = getattr(ikwen.rewarding.models, name)
         model.objects.using(alias).all().delete()
     for name in ('UserPermissionList', 'GroupPermissionList',):
@@ -98,6 +100,9 @@ class RewardingViewsTestCase(unittest.TestCase):
         self.assertTrue(summary1.threshold_reached)
         self.assertEqual(summary2.count, 50)
         self.assertFalse(summary2.threshold_reached)
+        purge = CouponPurge.objects.using(UMBRELLA).get(coupon=c)
+        self.assertEqual(purge.status, CouponPurge.COMPLETE)
+        self.assertEqual(purge.progress, 2)
 
     @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102')
     def test_Configuration_save_billing(self):
@@ -172,3 +177,19 @@ class RewardingViewsTestCase(unittest.TestCase):
         response = self.client.get(reverse('rewarding:coupon_detail'), {'id': '593928184fc0c279dc0f73b1'})
         self.assertEqual(response.status_code, 200)
         json_response = json.loads(response.content)
+
+    @override_settings(IKWEN_SERVICE_ID='56eb6d04b37b3379b531b102', CR_METRICS_TOKEN='s3cr3t',
+                       CR_METRICS_ALLOWED_IPS=('10.0.0.5', ))
+    def test_render_metrics(self):
+        """
+        Only a client with the token or from an allowed address gets the metrics
+        """
+        response = self.client.get(reverse('rewarding:metrics'))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('rewarding:metrics'), {'token': 'wrong'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('rewarding:metrics'), HTTP_X_METRICS_TOKEN='s3cr3t')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(json.loads(response.content), dict)
+        response = self.client.get(reverse('rewarding:metrics'), REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(response.status_code, 200)
@@ -2,7 +2,8 @@
 from django.conf.urls import patterns, url
 from django.contrib.auth.decorators import login_required, permission_required
 
-from ikwen.rewarding.views import Configuration, ChangeCoupon, Dashboard, CouponDetail, upload_coupon_image
+from ikwen.rewarding.views import Configuration, ChangeCoupon, Dashboard, CouponDetail, upload_coupon_image, \
+    render_metrics
 
 urlpatterns = patterns(
     '',
@@ -12,4 +13,5 @@ urlpatterns = patterns(
     url(r'^changeCoupon/(?P<object_id>[-\w]+)/$', permission_required('rewarding.ik_manage_rewarding')(ChangeCoupon.as_view()), name='change_coupon'),
     url(r'^upload_coupon_image$', upload_coupon_image, name='upload_coupon_image'),
     url(r'^coupon_detail$', CouponDetail.as_view(), name='coupon_detail'),
+    url(r'^metrics/$', render_metrics, name='metrics'),
 )
@@ -1,19 +1,675 @@
-from datetime import datetime
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import threading
+import traceback
+from copy import deepcopy
+from functools import wraps
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+from uuid import uuid4
 
 from django.conf import settings
+from django.db import IntegrityError, connections
+from django.db.models import F
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete
 from ikwen.core.models import Service
-from ikwen.core.utils import add_event
+from ikwen.core.utils import add_event, set_counters
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.accesscontrol.models import Member
 from ikwen.rewarding.models import Coupon, JoinRewardPack, CumulatedCoupon, PaymentRewardPack, Reward, CouponSummary, \
     CouponUse, CRProfile, CouponWinner, WELCOME_REWARD_OFFERED, PAYMENT_REWARD_OFFERED, CROperatorProfile, \
-    REFERRAL_REWARD_OFFERED, MANUAL_REWARD_OFFERED, ReferralRewardPack
+    REFERRAL_REWARD_OFFERED, MANUAL_REWARD_OFFERED, ReferralRewardPack, RewardJob, RewardReceipt, HistoryBucket, \
+    get_catalogue_cache, get_coupon_catalogue_version, bump_coupon_catalogue_version, CouponLedgerEntry, \
+    CouponBalanceSnapshot
 from ikwen.revival.models import MemberProfile, ProfileTag
 
 JOIN = '__Join'
 REFERRAL = '__Referral'
 
+metrics_logger = logging.getLogger('ikwen.rewarding.metrics')
 
+
+def iter_keyset_chunks(queryset, chunk_size=500, fields=None, start_after=None):
+    """
+    Iterates over a queryset by lists of at most chunk_size objects, paging
+    on the primary key instead of offsets, so that each chunk costs the same
+    whatever its position and at most one chunk is held in memory.
+
+    :param queryset: Queryset to iterate over. Its ordering is ignored.
+    :param chunk_size: Maximum number of objects per chunk
+    :param fields: If given, only these fields are loaded. *Eg: ('id', 'email')*
+    :param start_after: If given, iteration starts after the object with this primary key.
+    """
+    if fields:
+        queryset = queryset.only(*fields)
+    queryset = queryset.order_by('id')
+    last_id = start_after
+    while True:
+        chunk_qs = queryset.filter(pk__gt=last_id) if last_id is not None else queryset
+        chunk = list(chunk_qs[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last_id = chunk[-1].pk
+
+
+COUNTED_COLLECTION_METHODS = ('find', 'find_one', 'find_and_modify', 'count', 'distinct', 'insert', 'save',
+                              'update', 'remove', 'group', 'aggregate', 'map_reduce', 'inline_map_reduce')
+
+_query_local = threading.local()
+
+
+def get_query_counts():
+    """
+    Returns the dict of the number of queries sent by the current
+    thread to each database alias since counting was installed.
+    """
+    counts = getattr(_query_local, 'counts', None)
+    if counts is None:
+        counts = _query_local.counts = {}
+    return counts
+
+
+class CountingCollection(object):
+    """
+    Proxy of a pymongo Collection counting the operations run through it in
+    get_query_counts(). A find() counts once, whatever the number of batches
+    its cursor fetches.
+    """
+    def __init__(self, collection, alias):
+        self.collection = collection
+        self.alias = alias
+
+    def __getattr__(self, attr):
+        value = getattr(self.collection, attr)
+        if attr not in COUNTED_COLLECTION_METHODS:
+            return value
+        alias = self.alias
+
+        def wrapper(*args, **kwargs):
+            counts = get_query_counts()
+            counts[alias] = counts.get(alias, 0) + 1
+            return value(*args, **kwargs)
+        return wrapper
+
+
+def install_query_counting(connection):
+    """
+    Makes the class of a connection return CountingCollection from get_collection(),
+    which the compilers of django-mongodb-engine call for every query. Queries never
+    reach connection.queries on that backend, so they are counted there instead.
+    Connections of other backends are left untouched.
+    """
+    wrapper_class = connection.__class__
+    get_collection = getattr(wrapper_class, 'get_collection', None)
+    if get_collection is None or getattr(get_collection, 'counting', False):
+        return
+
+    def counting_get_collection(self, name, **kwargs):
+        collection = get_collection(self, name, **kwargs)
+        if collection is None:
+            return None
+        return CountingCollection(collection, self.alias)
+    counting_get_collection.counting = True
+    wrapper_class.get_collection = counting_get_collection
+
+
+class QueryCounter(object):
+    """
+    Context manager measuring the wall time and the number of queries run
+    by the current thread on each database alias within its block.
+    """
+    def __enter__(self):
+        for connection in connections.all():
+            install_query_counting(connection)
+        self.start = dict(get_query_counts())
+        self.queries = {}
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.duration = time.time() - self.t0
+        for alias, count in get_query_counts().items():
+            count -= self.start.get(alias, 0)
+            if count:
+                self.queries[alias] = count
+
+    def _get_total(self):
+        return sum(self.queries.values())
+    total = property(_get_total)
+
+
+_instrument_local = threading.local()
+_metrics_registry = {}
+_metrics_lock = threading.Lock()
+
+
+class Instrument(QueryCounter):
+    """
+    QueryCounter that also counts the rows written within its block and
+    reports its measures under a name when the block exits. Measures are
+    logged as JSON on the ikwen.rewarding.metrics logger and added to the
+    in-process metrics registry if CR_METRICS_REGISTRY is True.
+
+    Code run within the block reports the rows it writes with count_rows().
+    Instruments can be nested, rows and queries then count in all of them.
+    Nothing is measured if the registry is off and the logger does not log
+    DEBUG messages.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+
+    def __enter__(self):
+        self.enabled = getattr(settings, 'CR_METRICS_REGISTRY', False) or metrics_logger.isEnabledFor(logging.DEBUG)
+        if not self.enabled:
+            return self
+        stack = getattr(_instrument_local, 'stack', None)
+        if stack is None:
+            stack = _instrument_local.stack = []
+        stack.append(self)
+        return super(Instrument, self).__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.enabled:
+            return
+        super(Instrument, self).__exit__(exc_type, exc_val, exc_tb)
+        _instrument_local.stack.remove(self)
+        record_metrics(self.name, self.duration, self.queries, self.rows, exc_type is not None)
+
+
+def instrument(name=None):
+    """
+    Decorator running a function within an Instrument. The name defaults
+    to the module and the name of the function. The module is taken from the
+    file name, so that functions of a cron run as __main__ are named alike.
+    """
+    def decorator(func):
+        module = os.path.splitext(os.path.basename(func.__code__.co_filename))[0]
+        instrument_name = name or '%s.%s' % (module, func.__name__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Instrument(instrument_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_view(dispatch):
+    """
+    Decorator of the dispatch() method of class-based views. The request
+    runs within an Instrument named after the view and the action requested.
+    The block of a TemplateResponse only ends once it is rendered, so that
+    the queries run by the template count as well.
+    """
+    @wraps(dispatch)
+    def wrapper(self, request, *args, **kwargs):
+        action = request.GET.get('action') or request.method.lower()
+        block = Instrument('views.%s.%s' % (self.__class__.__name__, action))
+        block.__enter__()
+        try:
+            response = dispatch(self, request, *args, **kwargs)
+        except:
+            block.__exit__(*sys.exc_info())
+            raise
+        if getattr(response, 'is_rendered', True):
+            block.__exit__(None, None, None)
+        else:
+            response.add_post_render_callback(lambda response: block.__exit__(None, None, None))
+        return response
+    return wrapper
+
+
+def count_rows(count):
+    """
+    Adds count rows written to all Instrument blocks of the current thread.
+    """
+    for block in getattr(_instrument_local, 'stack', []):
+        block.rows += count
+
+
+def record_metrics(name, duration, queries, rows, failed=False):
+    metrics_logger.debug(json.dumps({'name': name, 'duration': round(duration, 6), 'queries': queries,
+                                     'rows': rows, 'failed': failed}, sort_keys=True))
+    if not getattr(settings, 'CR_METRICS_REGISTRY', False):
+        return
+    with _metrics_lock:
+        metrics = _metrics_registry.setdefault(name, {'calls': 0, 'failures': 0, 'duration': 0, 'max_duration': 0,
+                                                      'queries': {}, 'rows': 0})
+        metrics['calls'] += 1
+        metrics['failures'] += 1 if failed else 0
+        metrics['duration'] += duration
+        metrics['max_duration'] = max(metrics['max_duration'], duration)
+        metrics['rows'] += rows
+        for alias, count in queries.items():
+            metrics['queries'][alias] = metrics['queries'].get(alias, 0) + count
+
+
+def get_metrics():
+    """
+    Returns a copy of the metrics registry, a dict keyed by Instrument
+    name of dicts with keys *calls*, *failures*, *duration*, *max_duration*,
+    *rows* and *queries*, the latter being the query count per database alias.
+    Durations are in seconds and totals are cumulated since the last reset.
+    """
+    with _metrics_lock:
+        return deepcopy(_metrics_registry)
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics_registry.clear()
+
+
+def iter_keyset(queryset, chunk_size=500, fields=None):
+    """
+    Same as iter_keyset_chunks() but yields objects one by one.
+    """
+    for chunk in iter_keyset_chunks(queryset, chunk_size, fields):
+        for obj in chunk:
+            yield obj
+
+
+def get_model_name(obj):
+    return '%s.%s' % (obj._meta.app_label, obj._meta.object_name)
+
+
+def increment_metric(obj, metric, value=1, day=None):
+    """
+    Atomically increments the HistoryBucket of a metric of obj for a day.
+
+    :param obj: Object which history is tracked. *Eg: a Coupon*
+    :param metric: Name of the metric. *Eg: offered*
+    :param day: date of the bucket. Defaults to today.
+    """
+    bucket_fields = {'model_name': get_model_name(obj), 'object_id': obj.pk, 'metric': metric,
+                     'day': day or date.today()}
+    bucket_qs = HistoryBucket.objects.using(UMBRELLA).filter(**bucket_fields)
+    if bucket_qs.update(value=F('value') + value):
+        return
+    try:
+        HistoryBucket.objects.using(UMBRELLA).create(value=value, **bucket_fields)
+    except IntegrityError:  # Bucket created concurrently in the meantime
+        bucket_qs.update(value=F('value') + value)
+
+
+def get_metric_series(obj, metric, start, end=None):
+    """
+    Gets the daily values of a metric of obj between start and end included.
+
+    :return: list of tuples (day, value) with a tuple for every day of the range
+    """
+    end = end or date.today()
+    bucket_qs = HistoryBucket.objects.using(UMBRELLA)\
+        .filter(model_name=get_model_name(obj), object_id=obj.pk, metric=metric, day__gte=start, day__lte=end)
+    values = {}
+    for bucket in bucket_qs:
+        day = bucket.day.date() if isinstance(bucket.day, datetime) else bucket.day
+        values[day] = bucket.value
+    return [(start + timedelta(days=i), values.get(start + timedelta(days=i), 0))
+            for i in range((end - start).days + 1)]
+
+
+def rollup_metric_series(series, period):
+    """
+    Sums a series returned by get_metric_series() by week or month.
+
+    :param period: Either 'week' or 'month'
+    :return: list of tuples (first_day_of_period, value)
+    """
+    totals = {}
+    for day, value in series:
+        if period == 'week':
+            period_start = day - timedelta(days=day.weekday())
+        else:
+            period_start = day.replace(day=1)
+        totals[period_start] = totals.get(period_start, 0) + value
+    return sorted(totals.items())
+
+
+def migrate_history_lists(model, clear=False):
+    """
+    Copies the *_history ListField listed in model.HISTORY_FIELDS into
+    HistoryBucket. The last item of a list is the value of the day the
+    counters were last reset and the items before it are the previous days.
+    Buckets are set rather than incremented, so the migration can be run again.
+
+    :param clear: If True, lists are emptied once copied
+    """
+    for obj in iter_keyset(model.objects.using(UMBRELLA).all()):
+        reset_on = getattr(obj, 'counters_reset_on', None) or datetime.now()
+        last_day = reset_on.date() if isinstance(reset_on, datetime) else reset_on
+        for history_field in model.HISTORY_FIELDS:
+            metric = history_field.replace('_history', '')
+            history = getattr(obj, history_field) or []
+            for i, value in enumerate(reversed(history)):
+                if not value:
+                    continue
+                bucket_fields = {'model_name': get_model_name(obj), 'object_id': obj.pk, 'metric': metric,
+                                 'day': last_day - timedelta(days=i)}
+                if not HistoryBucket.objects.using(UMBRELLA).filter(**bucket_fields).update(value=value):
+                    HistoryBucket.objects.using(UMBRELLA).create(value=value, **bucket_fields)
+        if clear:
+            model.objects.using(UMBRELLA).filter(pk=obj.pk).update(**dict([(f, []) for f in model.HISTORY_FIELDS]))
+
+
+class HistoryAccumulator(object):
+    """
+    Collects the increments of history fields of AbstractWatchModel objects
+    during a cron run, so that each object gets written once at flush() rather
+    than once per increment with increment_history_field(). Totals are
+    applied with atomic increments, so concurrent runs do not lose any.
+    History of models defining HISTORY_FIELDS goes to HistoryBucket.
+    """
+    def __init__(self):
+        self.increments = {}
+
+    def increment(self, obj, history_field, value=1, using=None):
+        """
+        Registers an increment of obj.<history_field>. *using* is the
+        database of obj if it is not the one it was loaded from.
+        """
+        key = (type(obj), using or obj._state.db, obj.pk)
+        fields = self.increments.setdefault(key, {})
+        fields[history_field] = fields.get(history_field, 0) + value
+
+    def flush(self):
+        for (model, db, pk), fields in self.increments.items():
+            bucket_fields = getattr(model, 'HISTORY_FIELDS', ())
+            values = {}
+            obj = None
+            for history_field, value in fields.items():
+                total_field = 'total_' + history_field.replace('_history', '')
+                if history_field in bucket_fields:
+                    increment_metric(model(pk=pk), history_field.replace('_history', ''), value)
+                    values[total_field] = F(total_field) + value
+                    continue
+                if obj is None:
+                    try:
+                        obj = model.objects.using(db).get(pk=pk)
+                    except model.DoesNotExist:
+                        break
+                    set_counters(obj)
+                    # set_counters() may have shifted all history lists and set
+                    # counters_reset_on, so they are all written back with the increments.
+                    for field in obj._meta.fields:
+                        if field.name.endswith('_history') or field.name == 'counters_reset_on':
+                            values[field.name] = getattr(obj, field.name)
+                if not hasattr(obj, history_field):
+                    continue
+                history = getattr(obj, history_field)
+                history[-1] += value
+                values[history_field] = history
+                if hasattr(obj, total_field):
+                    values[total_field] = F(total_field) + value
+            if values:
+                model.objects.using(db).filter(pk=pk).update(**values)
+        self.increments = {}
+
+
+REWARD_PACK_MODELS = {
+    Reward.JOIN: JoinRewardPack,
+    Reward.REFERRAL: ReferralRewardPack,
+    Reward.PAYMENT: PaymentRewardPack,
+}
+
+
+def get_coupon_catalogue(service):
+    """
+    Gets the coupon catalogue of a Service: its coupons not deleted and all
+    its Join, Referral and Payment reward packs with their coupon resolved.
+    Catalogues are kept in the cache returned by get_catalogue_cache() under
+    the current version of the Service, so a bump_coupon_catalogue_version()
+    makes all workers reload it at their next access.
+
+    :return: dict with keys *version*, *coupons*, a dict of coupons by id,
+        and *packs*, a dict of lists of packs by type of reward.
+    """
+    cache = get_catalogue_cache()
+    version = get_coupon_catalogue_version(service.id)
+    key = 'rewarding:catalogue:%s:%s' % (service.id, version)
+    catalogue = cache.get(key)
+    if catalogue is not None:
+        return catalogue
+    coupon_qs = Coupon.objects.using(UMBRELLA).defer(*Coupon.HISTORY_FIELDS).filter(service=service.id, deleted=False)
+    coupons = dict([(coupon.id, coupon) for coupon in coupon_qs])
+    packs = {}
+    for type, pack_model in REWARD_PACK_MODELS.items():
+        packs[type] = []
+        for pack in pack_model.objects.using(UMBRELLA).filter(service=service.id):
+            coupon = coupons.get(pack.coupon_id)
+            if not coupon:
+                continue
+            pack.coupon = coupon
+            packs[type].append(pack)
+    catalogue = {'version': version, 'coupons': coupons, 'packs': packs}
+    cache.set(key, catalogue, getattr(settings, 'CR_CATALOGUE_TTL', 3600))
+    return catalogue
+
+
+def invalidate_coupon_catalogue(sender, **kwargs):
+    """
+    Receiver of post_delete of Coupon and reward packs. Coupon.save() and
+    Configuration.save_rewards_packs() bump the version themselves.
+    """
+    instance = kwargs['instance']
+    bump_coupon_catalogue_version(instance.service_id)
+
+
+for catalogue_model in (Coupon, ) + tuple(REWARD_PACK_MODELS.values()):
+    post_delete.connect(invalidate_coupon_catalogue, sender=catalogue_model,
+                        dispatch_uid="%s_catalogue_post_delete_id" % catalogue_model.__name__.lower())
+
+
+def get_reward_rules(service, type):
+    """
+    Compiles the rule table of a type of reward on a Service from its
+    coupon catalogue, so resolving the packs matching an event
+    afterwards costs no query at all.
+
+    :param service: Service which rules are compiled
+    :param type: Type of reward. Can be Reward.JOIN, Reward.REFERRAL or Reward.PAYMENT
+    :return: list of JoinRewardPack, ReferralRewardPack or PaymentRewardPack
+        having a positive count, with their coupon already resolved.
+    """
+    rule_list = []
+    for pack in get_coupon_catalogue(service)['packs'][type]:
+        if pack.count <= 0:
+            continue
+        pack.service = service
+        rule_list.append(pack)
+    return rule_list
+
+
+_payment_interval_index = {}
+
+
+def get_payment_interval_index(service):
+    """
+    Returns the interval index of PaymentRewardPack of a Service. Packs are
+    grouped by (floor, ceiling) and sorted by floor, which is enough to
+    bisect on them since Configuration.save_rewards_packs() forbids
+    overlapping intervals. The index is built once per process and kept
+    until the coupon catalogue of the Service changes, it is invalidated
+    or CR_PAYMENT_INDEX_TTL seconds elapse.
+
+    :return: dict with keys *floors*, *ceilings* and *packs*, the latter
+        being the list of packs of each interval.
+    """
+    version = get_coupon_catalogue_version(service.id)
+    index = _payment_interval_index.get(service.id)
+    if index and index['version'] == version and index['expiry'] > time.time():
+        return index
+    intervals = {}
+    for pack in get_reward_rules(service, Reward.PAYMENT):
+        intervals.setdefault((pack.floor, pack.ceiling), []).append(pack)
+    bounds = sorted(intervals.keys())
+    index = {
+        'floors': [floor for floor, ceiling in bounds],
+        'ceilings': [ceiling for floor, ceiling in bounds],
+        'packs': [intervals[bound] for bound in bounds],
+        'version': version,
+        'expiry': time.time() + getattr(settings, 'CR_PAYMENT_INDEX_TTL', 300)
+    }
+    _payment_interval_index[service.id] = index
+    return index
+
+
+def invalidate_payment_interval_index(service):
+    _payment_interval_index.pop(service.id, None)
+
+
+def find_payment_reward_packs(service, amount):
+    """
+    Finds the PaymentRewardPack of a Service matching an amount
+    paid, that is such that floor < amount <= ceiling.
+    """
+    index = get_payment_interval_index(service)
+    i = bisect_left(index['floors'], amount) - 1
+    if i < 0 or amount > index['ceilings'][i]:
+        return []
+    return list(index['packs'][i])
+
+
+_operator_profile_cache = {}
+
+
+def get_active_operator_profile(service):
+    """
+    Returns the active CROperatorProfile of a Service or None if rewarding
+    is not active on that Service. Answers, including negative ones, are kept
+    in a process-local cache for CR_OPERATOR_PROFILE_TTL seconds, and
+    dropped earlier if the profile is saved or deleted in this process.
+    Objects returned are shared, so callers must not modify them.
+    """
+    entry = _operator_profile_cache.get(service.id)
+    if entry and entry[1] > time.time():
+        return entry[0]
+    try:
+        operator = CROperatorProfile.objects.using(UMBRELLA).defer(*CROperatorProfile.HISTORY_FIELDS)\
+            .get(service=service.id, is_active=True)
+    except CROperatorProfile.DoesNotExist:
+        operator = None
+    _operator_profile_cache[service.id] = operator, time.time() + getattr(settings, 'CR_OPERATOR_PROFILE_TTL', 60)
+    return operator
+
+
+def invalidate_operator_profile(sender, **kwargs):
+    """
+    Receiver of post_save and post_delete of CROperatorProfile. This covers
+    activation, plan changes and suspension by billing_crons alike.
+    """
+    instance = kwargs['instance']
+    _operator_profile_cache.pop(instance.service_id, None)
+
+
+post_save.connect(invalidate_operator_profile, sender=CROperatorProfile, dispatch_uid="cr_operator_profile_post_save_id")
+post_delete.connect(invalidate_operator_profile, sender=CROperatorProfile,
+                    dispatch_uid="cr_operator_profile_post_delete_id")
+
+
+def get_heap_crossing(before, after, heap_size):
+    """
+    Tells whether a CumulatedCoupon crossed the heap_size of its
+    coupon when its count went from before to after.
+
+    :return: 1 if it reached the heap, -1 if it went back below, 0 otherwise
+    """
+    if before < heap_size <= after:
+        return 1
+    if after < heap_size <= before:
+        return -1
+    return 0
+
+
+def shift_heaps_reached(service, member, delta):
+    """
+    Moves CouponSummary.heaps_reached of a Member by delta and
+    updates threshold_reached accordingly, without any scan of
+    the CumulatedCoupon of the Member.
+    """
+    if delta == 0:
+        return
+    summary_qs = CouponSummary.objects.using(UMBRELLA).filter(service=service, member=member)
+    if delta > 0:
+        summary_qs.update(heaps_reached=F('heaps_reached') + delta, threshold_reached=True)
+    else:
+        summary_qs.update(heaps_reached=F('heaps_reached') + delta)
+        summary_qs.filter(heaps_reached__lte=0).update(threshold_reached=False)
+
+
+def rebuild_heaps_reached(service):
+    """
+    Recomputes CouponSummary.heaps_reached and threshold_reached of all
+    Members of a Service from their CumulatedCoupon. Meant to initialize
+    the counter on existing data or to repair it.
+    """
+    coupons = dict([(coupon.id, coupon) for coupon in Coupon.objects.using(UMBRELLA).filter(service=service)])
+    heaps_reached = {}
+    cumul_qs = CumulatedCoupon.objects.using(UMBRELLA).filter(coupon__in=coupons.keys())
+    for cumul in iter_keyset(cumul_qs, fields=('member', 'coupon', 'count')):
+        if cumul.count >= coupons[cumul.coupon_id].heap_size:
+            heaps_reached[cumul.member_id] = heaps_reached.get(cumul.member_id, 0) + 1
+    member_ids_by_count = {}
+    for member_id, count in heaps_reached.items():
+        member_ids_by_count.setdefault(count, []).append(member_id)
+    summary_qs = CouponSummary.objects.using(UMBRELLA).filter(service=service)
+    summary_qs.update(heaps_reached=0, threshold_reached=False)
+    for count, member_ids in member_ids_by_count.items():
+        summary_qs.filter(member__in=member_ids).update(heaps_reached=count, threshold_reached=True)
+
+
+def credit_member(service, member, credit_list, type, **kwargs):
+    """
+    Credits a Member with coupons and issues the matching Reward objects
+    as SENT. Each CumulatedCoupon is credited with add_cumulated_count(),
+    so heaps reached are told from exact counts. Rewards, ledger entries
+    and winners are written in bulk once all credits are done.
+
+    :param service: Service on which the Member is rewarded
+    :param member: Member from umbrella database
+    :param credit_list: list of tuples (coupon, count)
+    :param type: Type of reward issued
+    :param kwargs: Extra fields of the Reward objects. *Eg: object_id, amount*
+    :return: A tuple (coupon_count, coupon_score, heaps_delta), heaps_delta being
+        the number of coupon heaps the Member reached with this credit.
+    """
+    coupon_ids = [coupon.id for coupon, count in credit_list]
+    cumul_qs = CumulatedCoupon.objects.using(UMBRELLA).filter(member=member, coupon__in=coupon_ids)
+    with_cumul = set([cumul.coupon_id for cumul in cumul_qs.only('coupon')])
+    reward_list = []
+    entry_list = []
+    winner_list = []
+    coupon_count, coupon_score, heaps_delta = 0, 0, 0
+    for coupon, count in credit_list:
+        before, after = add_cumulated_count(member.id, coupon, count, coupon.id in with_cumul)
+        with_cumul.add(coupon.id)
+        heaps_delta += get_heap_crossing(before, after, coupon.heap_size)
+        reward_list.append(Reward(service=service, member=member, coupon=coupon, count=count,
+                                  type=type, status=Reward.SENT, **kwargs))
+        entry_list.append(CouponLedgerEntry(member=member, coupon=coupon, count=count,
+                                            source=type, object_id=kwargs.get('object_id')))
+        if after >= coupon.heap_size:
+            winner_list.append(CouponWinner(member=member, coupon=coupon))
+        coupon_count += count
+        coupon_score += count * coupon.coefficient
+    if reward_list:
+        Reward.objects.using(UMBRELLA).bulk_create(reward_list)
+        CouponLedgerEntry.objects.using(UMBRELLA).bulk_create(entry_list)
+    if winner_list:
+        CouponWinner.objects.using(UMBRELLA).bulk_create(winner_list)
+    count_rows(len(credit_list) + len(reward_list) + len(entry_list) + len(winner_list))
+    return coupon_count, coupon_score, heaps_delta
+
+
+@instrument()
 def reward_member(service, member, type, **kwargs):
     """
     Rewards a Member on a Service according the the type
@@ -33,120 +689,317 @@ def reward_member(service, member, type, **kwargs):
             *coupon*: Coupon being donated to the Member
             *count*: number of coupon given
 
+        *db* may also be passed to tell in which database the CRProfile
+        of the Member is. It defaults to the 'default' database.
+
     :return: A tuple (list of JoinRewardPack or PaymentRewardPack, total_coupon_count)
     """
-    now = datetime.now()
-    try:
-        # All rewarding actions are run only if
-        # Operator has an active profile.
-        CROperatorProfile.objects.using(UMBRELLA).get(service=service, is_active=True)
-    except CROperatorProfile.DoesNotExist:
+    db = kwargs.pop('db', 'default')
+    # All rewarding actions are run only if
+    # Operator has an active profile.
+    if get_active_operator_profile(service) is None:
         return None, 0
-    reward_pack = None
+    object_id = kwargs.get('object_id')
+    if type != Reward.PAYMENT or not object_id:
+        return _reward_member(service, member, type, db, **kwargs)
+    # The receipt is claimed before rewarding, so a retry of the same payment
+    # gets nothing here even when both run concurrently. It is only complete
+    # once rewards are written, so a retry following a process that died in
+    # between takes it over when its lease of CR_REWARD_RECEIPT_LEASE expires.
+    lease_expiry = datetime.now() + timedelta(seconds=getattr(settings, 'CR_REWARD_RECEIPT_LEASE', 300))
+    receipt = claim_reward_receipt(service.id, member.id, type, object_id, lease_expiry)
+    if receipt is None:
+        return replay_reward(service, member, type, object_id)
+    try:
+        result = _reward_member(service, member, type, db, **kwargs)
+    except:
+        receipt.delete()
+        raise
+    complete_reward_receipt(receipt)
+    return result
+
+
+def _reward_member(service, member, type, db, **kwargs):
     reward_pack_list = []
-    coupon_count = 0
+    reward_kwargs = {}
     service = Service.objects.using(UMBRELLA).get(pk=service.id)
     member = Member.objects.using(UMBRELLA).get(pk=member.id)
-    profile, update = CRProfile.objects.get_or_create(member=member)
-    coupon_summary, update = CouponSummary.objects.using(UMBRELLA).get_or_create(service=service, member=member)
-    if type == Reward.JOIN:
-        for coupon in Coupon.objects.using(UMBRELLA).filter(service=service):
-            try:
-                reward_pack = JoinRewardPack.objects.using(UMBRELLA).select_related('service', 'coupon')\
-                    .get(service=service, coupon=coupon)
-                if reward_pack.count > 0:
-                    reward_pack_list.append(reward_pack)
-                    cumul, update = CumulatedCoupon.objects.using(UMBRELLA).get_or_create(member=member, coupon=coupon)
-                    cumul.count += reward_pack.count
-                    cumul.save()
-                    Reward.objects.using(UMBRELLA).create(service=service, member=member, coupon=coupon,
-                                                          count=reward_pack.count, type=Reward.JOIN, status=Reward.SENT)
-                    coupon_summary.count += reward_pack.count
-                    coupon_count += reward_pack.count
-                    if cumul.count >= coupon.heap_size:
-                        CouponWinner.objects.using(UMBRELLA).create(member=member, coupon=coupon)
-                        coupon_summary.threshold_reached = True
-                    profile.coupon_score += reward_pack.count * coupon.coefficient
-            except JoinRewardPack.DoesNotExist:
-                continue
+    CRProfile.objects.using(db).get_or_create(member=member)
+    if type == Reward.MANUAL:
+        coupon = kwargs.pop('coupon')
+        count = kwargs.pop('count')
+        credit_list = [(coupon, count)]
+    else:
+        if type == Reward.PAYMENT:
+            amount = kwargs.pop('amount')
+            object_id = kwargs.pop('object_id', None)
+            model_name = kwargs.pop('model_name', None)
+            reward_pack_list = find_payment_reward_packs(service, amount)
+            reward_kwargs = {'object_id': object_id, 'amount': amount}
         else:
-            profile.reward_score = CRProfile.FREE_REWARD
-        if reward_pack:
+            reward_pack_list = get_reward_rules(service, type)
+        credit_list = [(pack.coupon, pack.count) for pack in reward_pack_list]
+    coupon_count, coupon_score, heaps_delta = credit_member(service, member, credit_list, type, **reward_kwargs)
+    # Summary and profile are moved with atomic increments rather than saved,
+    # so that credits and debits run concurrently on them are not overwritten.
+    shift_coupon_summary(service, member, coupon_count, heaps_delta)
+    if type == Reward.JOIN:
+        reward_score = CRProfile.FREE_REWARD
+        if reward_pack_list:
             add_event(service, WELCOME_REWARD_OFFERED, member)
     elif type == Reward.REFERRAL:
-        for coupon in Coupon.objects.using(UMBRELLA).filter(service=service):
-            try:
-                reward_pack = ReferralRewardPack.objects.using(UMBRELLA).select_related('service', 'coupon')\
-                    .get(service=service, coupon=coupon)
-                if reward_pack.count > 0:
-                    reward_pack_list.append(reward_pack)
-                    cumul, update = CumulatedCoupon.objects.using(UMBRELLA).get_or_create(member=member, coupon=coupon)
-                    cumul.count += reward_pack.count
-                    cumul.save()
-                    Reward.objects.using(UMBRELLA).create(service=service, member=member, coupon=coupon,
-                                                          count=reward_pack.count, type=Reward.REFERRAL, status=Reward.SENT)
-                    coupon_summary.count += reward_pack.count
-                    if cumul.count >= coupon.heap_size:
-                        CouponWinner.objects.using(UMBRELLA).create(member=member, coupon=coupon)
-                        coupon_summary.threshold_reached = True
-                    profile.coupon_score += reward_pack.count * coupon.coefficient
-                    coupon_count += reward_pack.count
-            except ReferralRewardPack.DoesNotExist:
-                continue
-        else:
-            profile.reward_score = CRProfile.FREE_REWARD
-        if reward_pack:
+        reward_score = CRProfile.FREE_REWARD
+        if reward_pack_list:
             add_event(service, REFERRAL_REWARD_OFFERED, member)
     elif type == Reward.PAYMENT:
-        amount = kwargs.pop('amount')
-        object_id = kwargs.pop('object_id', None)
-        model_name = kwargs.pop('model_name', None)
-        for coupon in Coupon.objects.using(UMBRELLA).filter(service=service):
-            try:
-                reward_pack = PaymentRewardPack.objects.using(UMBRELLA).select_related('service', 'coupon')\
-                    .get(service=service, coupon=coupon, floor__lt=amount, ceiling__gte=amount)
-                if reward_pack.count > 0:
-                    reward_pack_list.append(reward_pack)
-                    cumul, update = CumulatedCoupon.objects.using(UMBRELLA).get_or_create(member=member, coupon=coupon)
-                    cumul.count += reward_pack.count
-                    cumul.save()
-                    Reward.objects.using(UMBRELLA).create(service=service, member=member, coupon=coupon,
-                                                          count=reward_pack.count, type=Reward.PAYMENT,
-                                                          status=Reward.SENT, object_id=object_id, amount=amount)
-                    coupon_summary.count += reward_pack.count
-                    if cumul.count >= coupon.heap_size:
-                        CouponWinner.objects.using(UMBRELLA).create(member=member, coupon=coupon)
-                        coupon_summary.threshold_reached = True
-                    coupon_summary.save()
-                    profile.coupon_score += reward_pack.count * coupon.coefficient
-                    coupon_count += reward_pack.count
-            except PaymentRewardPack.DoesNotExist:
-                continue
-        else:
-            profile.reward_score = CRProfile.PAYMENT_REWARD
-        if reward_pack:
+        reward_score = CRProfile.PAYMENT_REWARD
+        if reward_pack_list:
             add_event(service, PAYMENT_REWARD_OFFERED, member, object_id=object_id, model=model_name)
-    elif type == Reward.MANUAL:
-        coupon = kwargs.pop('coupon')
-        count = kwargs.pop('count')
-        cumul, update = CumulatedCoupon.objects.using(UMBRELLA).get_or_create(member=member, coupon=coupon)
-        cumul.count += count
-        cumul.save()
-        Reward.objects.using(UMBRELLA).create(service=service, member=member, coupon=coupon,
-                                              count=count, type=Reward.MANUAL, status=Reward.SENT)
-        coupon_summary.count += count
-        if cumul.count >= coupon.heap_size:
-            CouponWinner.objects.using(UMBRELLA).create(member=member, coupon=coupon)
-            coupon_summary.threshold_reached = True
-        coupon_summary.save()
-        profile.coupon_score += count * coupon.coefficient
-        profile.reward_score = CRProfile.MANUAL_REWARD
+    else:
+        reward_score = CRProfile.MANUAL_REWARD
         add_event(service, MANUAL_REWARD_OFFERED, member)
-    profile.save()
-    coupon_summary.save()
+    CRProfile.objects.using(db).filter(member=member)\
+        .update(reward_score=reward_score, coupon_score=F('coupon_score') + coupon_score)
+    return reward_pack_list, coupon_count
+
+
+def replay_reward(service, member, type, object_id):
+    """
+    Rebuilds the result of a reward previously issued for the object
+    object_id, without writing anything. Packs are rebuilt from the
+    Reward objects, as the original packs may have been reconfigured since.
+
+    :return: A tuple (list of PaymentRewardPack, total_coupon_count) like reward_member()
+    """
+    reward_list = list(Reward.objects.using(UMBRELLA).filter(service=service, member=member,
+                                                             type=type, object_id=object_id))
+    coupon_ids = list(set([reward.coupon_id for reward in reward_list]))
+    coupons = Coupon.objects.using(UMBRELLA).in_bulk(coupon_ids) if coupon_ids else {}
+    reward_pack_list = []
+    coupon_count = 0
+    for reward in reward_list:
+        reward_pack_list.append(PaymentRewardPack(service=service, coupon=coupons[reward.coupon_id], count=reward.count))
+        coupon_count += reward.count
     return reward_pack_list, coupon_count
 
 
+@instrument()
+def reward_members_bulk(service, coupon, count, members, db='default', batch_size=None):
+    """
+    Rewards many Members with count coupons of a Coupon at once, typically
+    after a mission or a campaign. Members are processed by batches, each
+    batch being written with a few bulk queries: Reward, CouponWinner and
+    ledger entries are bulk created, CouponSummary and CRProfile are created
+    in bulk or updated all together. Each CumulatedCoupon is credited with
+    add_cumulated_count() though, so heaps reached are told from exact counts.
+    The MANUAL_REWARD_OFFERED event is fired once per Member after the batch
+    is written, even if the Member is listed more than once.
+
+    :param service: Service on which Members are rewarded
+    :param coupon: Coupon offered
+    :param count: number of coupons offered to each Member
+    :param members: queryset of Member or list of Member IDs
+    :param db: Database where the CRProfile of Members are
+    :param batch_size: Number of Members per batch. Defaults to CR_BULK_REWARD_BATCH_SIZE
+    :return: Number of Members rewarded
+    """
+    if get_active_operator_profile(service) is None:
+        return 0
+    batch_size = batch_size or getattr(settings, 'CR_BULK_REWARD_BATCH_SIZE', 500)
+    if isinstance(members, QuerySet):
+        batch_list = ([member.id for member in chunk]
+                      for chunk in iter_keyset_chunks(members, batch_size, fields=('id', )))
+    else:
+        batch_list = (members[i:i + batch_size] for i in range(0, len(members), batch_size))
+    service = Service.objects.using(UMBRELLA).get(pk=service.id)
+    rewarded = set()
+    for member_ids in batch_list:
+        member_map = Member.objects.using(UMBRELLA).in_bulk([member_id for member_id in member_ids
+                                                             if member_id not in rewarded])
+        if not member_map:
+            continue
+        member_ids = list(member_map.keys())
+        cumul_qs = CumulatedCoupon.objects.using(UMBRELLA).filter(member__in=member_ids, coupon=coupon)
+        with_cumul = set([cumul.member_id for cumul in cumul_qs.only('member')])
+        summary_qs = CouponSummary.objects.using(UMBRELLA).filter(member__in=member_ids, service=service)
+        summaries = set([summary.member_id for summary in summary_qs.only('member')])
+        profile_qs = CRProfile.objects.using(db).filter(member__in=member_ids)
+        profiles = set([profile.member_id for profile in profile_qs.only('member')])
+        new_summary_list, new_profile_list = [], []
+        reward_list, entry_list, winner_list = [], [], []
+        summary_ids_by_heaps = {}
+        for member_id in member_ids:
+            before, after = add_cumulated_count(member_id, coupon, count, member_id in with_cumul)
+            heaps = get_heap_crossing(before, after, coupon.heap_size)
+            if member_id in summaries:
+                summary_ids_by_heaps.setdefault(heaps, []).append(member_id)
+            else:
+                new_summary_list.append(CouponSummary(service=service, member_id=member_id, count=count,
+                                                      heaps_reached=heaps, threshold_reached=heaps > 0))
+            if member_id not in profiles:
+                new_profile_list.append(CRProfile(member_id=member_id, reward_score=CRProfile.MANUAL_REWARD,
+                                                  coupon_score=count * coupon.coefficient))
+            reward_list.append(Reward(service=service, member_id=member_id, coupon=coupon, count=count,
+                                      type=Reward.MANUAL, status=Reward.SENT))
+            entry_list.append(CouponLedgerEntry(member_id=member_id, coupon=coupon, count=count,
+                                                source=Reward.MANUAL))
+            if after >= coupon.heap_size:
+                winner_list.append(CouponWinner(member_id=member_id, coupon=coupon))
+        Reward.objects.using(UMBRELLA).bulk_create(reward_list)
+        CouponLedgerEntry.objects.using(UMBRELLA).bulk_create(entry_list)
+        if winner_list:
+            CouponWinner.objects.using(UMBRELLA).bulk_create(winner_list)
+        summary_qs = CouponSummary.objects.using(UMBRELLA).filter(service=service)
+        for heaps, summary_member_ids in summary_ids_by_heaps.items():
+            if heaps > 0:
+                summary_qs.filter(member__in=summary_member_ids)\
+                    .update(count=F('count') + count, heaps_reached=F('heaps_reached') + heaps, threshold_reached=True)
+            else:
+                summary_qs.filter(member__in=summary_member_ids).update(count=F('count') + count)
+        if new_summary_list:
+            CouponSummary.objects.using(UMBRELLA).bulk_create(new_summary_list)
+        if profiles:
+            CRProfile.objects.using(db).filter(member__in=list(profiles))\
+                .update(reward_score=CRProfile.MANUAL_REWARD, coupon_score=F('coupon_score') + count * coupon.coefficient)
+        if new_profile_list:
+            CRProfile.objects.using(db).bulk_create(new_profile_list)
+        for member in member_map.values():
+            add_event(service, MANUAL_REWARD_OFFERED, member)
+        # A CumulatedCoupon, a CouponSummary and a CRProfile per Member
+        count_rows(3 * len(member_ids) + len(reward_list) + len(entry_list) + len(winner_list))
+        rewarded.update(member_ids)
+    return len(rewarded)
+
+
+def claim_reward_receipt(service_id, member_id, type, object_id, lease_expiry):
+    """
+    Claims the RewardReceipt of a reward until lease_expiry, before the
+    reward is run. An incomplete receipt whose lease expired is taken over.
+
+    :return: The receipt claimed, or None if the reward is complete
+        or still being run by another process.
+    """
+    try:
+        return RewardReceipt.objects.using(UMBRELLA).create(service_id=service_id, member_id=member_id, type=type,
+                                                            object_id=object_id, lease_expiry=lease_expiry)
+    except IntegrityError:
+        pass
+    receipt_qs = RewardReceipt.objects.using(UMBRELLA).filter(service=service_id, member=member_id, type=type,
+                                                              object_id=object_id, is_complete=False)
+    # Only one of concurrent retries matches the expired lease and takes the receipt over
+    if receipt_qs.filter(lease_expiry__lte=datetime.now()).update(lease_expiry=lease_expiry):
+        return receipt_qs.get()
+    return None
+
+
+def complete_reward_receipt(receipt):
+    RewardReceipt.objects.using(UMBRELLA).filter(pk=receipt.id).update(is_complete=True, lease_expiry=None)
+
+
+def get_reward_job_key(service, member, type, **kwargs):
+    """
+    Builds the idempotency key of a RewardJob. Rewards paying for an object
+    are keyed on that object and a Member joins a community only once. Other
+    rewards can legitimately be issued many times and get a unique key.
+    """
+    object_id = kwargs.get('object_id')
+    if object_id:
+        model_name = kwargs.get('model_name')
+        return '%s:%s:%s:%s:%s' % (service.id, member.id, type, model_name, object_id)
+    if type == Reward.JOIN:
+        return '%s:%s:%s' % (service.id, member.id, type)
+    return uuid4().hex
+
+
+def reward_member_async(service, member, type, **kwargs):
+    """
+    Enqueues a reward_member() call to be run later by process_reward_jobs()
+    and returns immediately. Arguments are the same as those of reward_member().
+
+    :return: The RewardJob created, or the one previously enqueued for the same reward.
+    """
+    key = get_reward_job_key(service, member, type, **kwargs)
+    job_kwargs = dict(kwargs)
+    coupon = job_kwargs.pop('coupon', None)
+    if coupon:
+        job_kwargs['coupon_id'] = coupon.id
+    try:
+        return RewardJob.objects.create(service=service, member=member, type=type,
+                                        kwargs=job_kwargs, idempotency_key=key)
+    except IntegrityError:
+        return RewardJob.objects.get(idempotency_key=key)
+
+
+def run_reward_job(job, db='default'):
+    kwargs = dict(job.kwargs)
+    coupon_id = kwargs.pop('coupon_id', None)
+    if coupon_id:
+        kwargs['coupon'] = Coupon.objects.using(UMBRELLA).get(pk=coupon_id)
+    return reward_member(job.service, job.member, job.type, db=db, **kwargs)
+
+
+@instrument()
+def process_reward_jobs(db='default', batch_size=None):
+    """
+    Drains the RewardJob queue of a database by batches. Jobs are claimed with
+    a lease, so those of a worker that died are put back in the queue once
+    the lease expires: a job may thus run more than once (at-least-once).
+    A RewardReceipt keyed on the idempotency_key of the job is set complete
+    right after the job ran, so a job put back after that is just set DONE
+    instead of rewarding the Member twice.
+    Failed jobs are retried until CR_REWARD_JOB_MAX_ATTEMPTS is reached.
+
+    :return: A tuple (done_count, failed_count)
+    """
+    if not batch_size:
+        batch_size = getattr(settings, 'CR_REWARD_JOBS_BATCH_SIZE', 100)
+    lease_duration = getattr(settings, 'CR_REWARD_JOB_LEASE', 300)
+    max_attempts = getattr(settings, 'CR_REWARD_JOB_MAX_ATTEMPTS', 5)
+    queue = RewardJob.objects.using(db)
+    queue.filter(status=RewardJob.RUNNING, lease_expiry__lt=datetime.now())\
+        .update(status=RewardJob.PENDING, lease_owner=None)
+    done_count, failed_count = 0, 0
+    while True:
+        job_ids = [job.id for job in queue.filter(status=RewardJob.PENDING).order_by('id')[:batch_size]]
+        if not job_ids:
+            break
+        owner = uuid4().hex
+        lease_expiry = datetime.now() + timedelta(seconds=lease_duration)
+        queue.filter(pk__in=job_ids, status=RewardJob.PENDING)\
+            .update(status=RewardJob.RUNNING, lease_owner=owner, lease_expiry=lease_expiry)
+        for job in queue.filter(lease_owner=owner).order_by('id'):
+            job.attempts += 1
+            # Keys are longer than RewardReceipt.object_id, so their hash is used.
+            # The receipt lease ends with the job lease, so the receipt of a job
+            # put back in the queue can always be taken over if not complete.
+            receipt = claim_reward_receipt(job.service_id, job.member_id, job.type,
+                                           hashlib.sha1(job.idempotency_key.encode('utf-8')).hexdigest(),
+                                           job.lease_expiry)
+            if receipt is None:  # Job ran by a worker that died before saving it
+                job.status = RewardJob.DONE
+                job.lease_owner = None
+                job.save()
+                done_count += 1
+                continue
+            try:
+                run_reward_job(job, db)
+                complete_reward_receipt(receipt)
+                job.status = RewardJob.DONE
+                job.error = None
+                done_count += 1
+            except:
+                receipt.delete()
+                job.error = traceback.format_exc()
+                if job.attempts >= max_attempts:
+                    job.status = RewardJob.FAILED
+                    failed_count += 1
+                else:
+                    job.status = RewardJob.PENDING
+            job.lease_owner = None
+            job.save()
+    return done_count, failed_count
+
+
 def get_last_reward(member, service):
     try:
         return Reward.objects.filter(member=member, service=service).order_by('-id')[0]
@@ -154,6 +1007,130 @@ def get_last_reward(member, service):
         return None
 
 
+def get_last_reward_map(service, member_ids):
+    """
+    Finds with a single query the last Reward of a Service issued to each
+    Member of member_ids, which spares a get_last_reward() query per Member
+    when processing a whole community chunk by chunk.
+
+    :return: dict member_id -> id of the last Reward of that Member, for
+        members having at least one
+    """
+    last_reward_map = {}
+    reward_qs = Reward.objects.filter(service=service, member__in=member_ids).order_by('id').only('member')
+    for reward in reward_qs:
+        last_reward_map[reward.member_id] = reward.id
+    return last_reward_map
+
+
+def swap_cumulated_count(cumul_qs, delta):
+    """
+    Moves the count of the CumulatedCoupon matched by cumul_qs by delta with
+    a compare-and-set: the update only matches if the count is still the one
+    read, so the count replaced is known exactly even with concurrent writers.
+    Attempts losing the race are retried up to CR_COUNT_SWAP_RETRIES times.
+
+    :return: tuple (count_before, count_after)
+    :raise: CumulatedCoupon.DoesNotExist if there is no such CumulatedCoupon
+        and ValueError if the count would drop below 0
+    """
+    retries = getattr(settings, 'CR_COUNT_SWAP_RETRIES', 20)
+    for i in range(retries):
+        before = cumul_qs.only('count').get().count
+        after = before + delta
+        if after < 0:
+            raise ValueError("Insufficient coupons. Need %d of them, found only %d" % (-delta, before))
+        if cumul_qs.filter(count=before).update(count=after):
+            return before, after
+    raise ValueError("CumulatedCoupon count still changing after %d attempts" % retries)
+
+
+def debit_cumulated_coupon(member, coupon, count, usage, object_id=None):
+    """
+    Takes count coupons from the CumulatedCoupon of a Member with a
+    compare-and-set, so concurrent debits can never drive the balance negative
+    and the count before and after the debit are exact. The matching
+    CouponUse is written right after. MongoDB has no multi-document
+    transactions, so the debit is reverted if the CouponUse cannot be written.
+
+    :return: tuple (count_before, count_after, coupon_use)
+    :raise: CumulatedCoupon.DoesNotExist if Member has no such coupon and
+        ValueError if Member has less than count of them.
+    """
+    cumul_qs = CumulatedCoupon.objects.using(UMBRELLA).filter(member=member, coupon=coupon)
+    count_before, count_after = swap_cumulated_count(cumul_qs, -count)
+    try:
+        coupon_use = CouponUse.objects.using(UMBRELLA).create(member=member, coupon=coupon, usage=usage,
+                                                              object_id=object_id, count=count)
+    except:
+        cumul_qs.update(count=F('count') + count)
+        raise
+    CouponLedgerEntry.objects.using(UMBRELLA).create(member=member, coupon=coupon, count=-count,
+                                                     source=usage, object_id=object_id)
+    count_rows(3)
+    return count_before, count_after, coupon_use
+
+
+def add_cumulated_count(member_id, coupon, count, exists=True, using=UMBRELLA):
+    """
+    Adds count coupons to the CumulatedCoupon of a Member with
+    swap_cumulated_count(), creating the CumulatedCoupon if needed, so
+    the counts before and after the credit are exact even with concurrent
+    writers and heap crossings can be told from them.
+
+    :param exists: False if the CumulatedCoupon is known to be missing, to try the insert first
+    :return: tuple (count_before, count_after)
+    """
+    cumul_qs = CumulatedCoupon.objects.using(using).filter(member=member_id, coupon=coupon)
+    if exists:
+        try:
+            return swap_cumulated_count(cumul_qs, count)
+        except CumulatedCoupon.DoesNotExist:
+            pass
+    try:
+        CumulatedCoupon.objects.using(using).create(member_id=member_id, coupon=coupon, count=count)
+        return 0, count
+    except IntegrityError:  # Created concurrently in the meantime
+        return swap_cumulated_count(cumul_qs, count)
+
+
+def credit_cumulated_coupon(member, coupon, count, source, object_id=None):
+    """
+    Adds count coupons to the CumulatedCoupon of a Member with
+    add_cumulated_count(). The ledger entry is written once the credit
+    is done, and the credit is reverted if it cannot be written, so the
+    ledger never shows coupons not given.
+
+    :return: tuple (count_before, count_after) of the CumulatedCoupon
+    """
+    count_before, count_after = add_cumulated_count(member.id, coupon, count)
+    try:
+        CouponLedgerEntry.objects.using(UMBRELLA).create(member=member, coupon=coupon, count=count,
+                                                         source=source, object_id=object_id)
+    except:
+        CumulatedCoupon.objects.using(UMBRELLA).filter(member=member, coupon=coupon).update(count=F('count') - count)
+        raise
+    count_rows(2)
+    return count_before, count_after
+
+
+def shift_coupon_summary(service, member, count, heaps_delta):
+    """
+    Moves CouponSummary.count of a Member by count with an atomic
+    increment, creating the CouponSummary if needed, then its
+    heaps_reached by heaps_delta.
+    """
+    count_rows(1)
+    summary_qs = CouponSummary.objects.using(UMBRELLA).filter(service=service, member=member)
+    if not summary_qs.update(count=F('count') + count):
+        try:
+            CouponSummary.objects.using(UMBRELLA).create(service=service, member=member, count=count)
+        except IntegrityError:
+            summary_qs.update(count=F('count') + count)
+    shift_heaps_reached(service, member, heaps_delta)
+
+
+@instrument()
 def use_coupon(member, coupon, object_id=None):
     """
     Marks a Coupon heap as used to acquire any item with ID object_id
@@ -162,29 +1139,26 @@ def use_coupon(member, coupon, object_id=None):
     :param object_id: ID of the item
     """
     service = coupon.service
-    cumul = CumulatedCoupon.objects.using(UMBRELLA).get(member=member, coupon=coupon)
-    if cumul.count < coupon.heap_size:
-        raise ValueError("Insufficient coupons to be consumed. "
-                         "Need %d of them, found only %d" % (coupon.heap_size, cumul.count))
-    cumul.count -= coupon.heap_size
-    cumul.save()
-    CouponUse.objects.using(UMBRELLA).create(member=member, coupon=coupon,
-                                             usage=CouponUse.PAYMENT, object_id=object_id, count=coupon.heap_size)
-    if cumul.count >= coupon.heap_size:
+    before, after, coupon_use = debit_cumulated_coupon(member, coupon, coupon.heap_size,
+                                                       CouponUse.PAYMENT, object_id)
+    if after >= coupon.heap_size:
         try:
             coupon_winner = CouponWinner.objects.using(UMBRELLA).filter(member=member, coupon=coupon)[0]
             coupon_winner.collected = True
         except:
             pass
-    threshold_reached = False
-    for cumul in CumulatedCoupon.objects.using(UMBRELLA).filter(member=member):
-        if cumul.count >= cumul.coupon.heap_size:
-            threshold_reached = True
-            break
-    CouponSummary.objects.using(UMBRELLA).filter(service=service, member=member).update(threshold_reached=threshold_reached)
+    shift_heaps_reached(service, member, get_heap_crossing(before, after, coupon.heap_size))
 
 
+@instrument()
 def donate_coupon(donor, receiver, coupon, count, object_id):
+    """
+    Moves count coupons from donor to receiver. The donor is debited
+    first with a conditional update. As MongoDB has no multi-document
+    transactions, the debit and its CouponUse are reverted if crediting
+    the receiver fails. The credit of the receiver reverts itself if its
+    ledger entry cannot be written, so only the donor side is reverted here.
+    """
     service = coupon.service
     if getattr(settings, 'UNIT_TESTING', False):
         db = 'default'
@@ -194,40 +1168,257 @@ def donate_coupon(donor, receiver, coupon, count, object_id):
         Member.objects.using(db).get(pk=receiver.id)
     except Member.DoesNotExist:
         raise ValueError("Donor and Receiver must belong to the same community")
-    donor_cumul = CumulatedCoupon.objects.using(UMBRELLA).get(member=donor, coupon=coupon)
-    if donor_cumul.count < count:
-        raise ValueError("Insufficient coupons to be donated. found only %d" % donor_cumul.count)
-    donor_cumul.count -= count
-    donor_cumul.save()
-    CouponUse.objects.using(UMBRELLA).create(member=donor, coupon=coupon,
-                                             usage=CouponUse.DONATION, object_id=object_id, count=count)
-
-    threshold_reached = False
-    for donor_cumul in CumulatedCoupon.objects.using(UMBRELLA).filter(member=donor):
-        if donor_cumul.count >= donor_cumul.coupon.heap_size:
-            threshold_reached = True
-            break
-    donor_summary, update = CouponSummary.objects.using(UMBRELLA).get_or_create(service=service, member=donor)
-    donor_summary.count -= count
-    donor_summary.threshold_reached = threshold_reached
-    donor_summary.save()
+    donor_before, donor_after, coupon_use = debit_cumulated_coupon(donor, coupon, count,
+                                                                   CouponUse.DONATION, object_id)
+    try:
+        CRProfile.objects.using(db).get_or_create(member=receiver)
+        receiver_before, receiver_after = credit_cumulated_coupon(receiver, coupon, count,
+                                                                  CouponUse.DONATION, object_id)
+    except:
+        CumulatedCoupon.objects.using(UMBRELLA).filter(member=donor, coupon=coupon).update(count=F('count') + count)
+        CouponLedgerEntry.objects.using(UMBRELLA).create(member=donor, coupon=coupon, count=count,
+                                                         source=CouponLedgerEntry.REVERSAL, object_id=object_id)
+        coupon_use.delete()
+        raise
+    shift_coupon_summary(service, donor, -count, get_heap_crossing(donor_before, donor_after, coupon.heap_size))
+    shift_coupon_summary(service, receiver, count,
+                         get_heap_crossing(receiver_before, receiver_after, coupon.heap_size))
+
+
+@instrument()
+def donate_coupons_bulk(donor, donation_list, coupon, object_id=None):
+    """
+    Gives coupons of a donor to many receivers at once, typically for
+    prize distributions. Receivers are checked with a single query, the
+    donor is debited once of the total. Each receiver is credited with
+    add_cumulated_count(), so heaps reached are told from exact counts,
+    and CouponSummary are updated in bulk, grouping increments of equal value.
+
+    MongoDB has no multi-document transactions, so if any write fails, the
+    credits already written are taken back and the debit is reverted.
+
+    :param donor: Member giving the coupons
+    :param donation_list: list of tuples (receiver, count)
+    :param coupon: Coupon being donated
+    :param object_id: ID of the object motivating the donation, if any
+    :return: total number of coupons donated
+    :raise: ValueError if a count is not positive, if a receiver is not in
+        the community or if donor has not enough coupons.
+    """
+    service = coupon.service
+    if getattr(settings, 'UNIT_TESTING', False):
+        db = 'default'
+    else:
+        db = service.database
+    counts = {}
+    for receiver, count in donation_list:
+        if count <= 0:
+            raise ValueError("Count of coupons donated must be positive, got %d" % count)
+        counts[receiver.id] = counts.get(receiver.id, 0) + count
+    receiver_ids = list(counts.keys())
+    found = set([member.id for member in Member.objects.using(db).filter(pk__in=receiver_ids).only('id')])
+    if len(found) < len(receiver_ids):
+        raise ValueError("Donor and Receivers must belong to the same community")
+    total = sum(counts.values())
+    donor_before, donor_after, coupon_use = debit_cumulated_coupon(donor, coupon, total,
+                                                                   CouponUse.DONATION, object_id)
+    cumul_qs = CumulatedCoupon.objects.using(UMBRELLA).filter(coupon=coupon)
+    summary_qs = CouponSummary.objects.using(UMBRELLA).filter(service=service)
+    summary_deltas = {}
+    credited, summarized = [], []  # Groups of increments written, taken back if a later write fails
+    new_profile_list = []
+    try:
+        profile_qs = CRProfile.objects.using(db).filter(member__in=receiver_ids).only('member')
+        with_profile = set([profile.member_id for profile in profile_qs])
+        new_profile_list = [CRProfile(member_id=member_id) for member_id in receiver_ids
+                            if member_id not in with_profile]
+        if new_profile_list:
+            CRProfile.objects.using(db).bulk_create(new_profile_list)
+
+        with_cumul = set([cumul.member_id for cumul in cumul_qs.filter(member__in=receiver_ids).only('member')])
+        summaries = set([summary.member_id for summary in summary_qs.filter(member__in=receiver_ids).only('member')])
+        new_summary_list, entry_list = [], []
+        for member_id, count in counts.items():
+            before, after = add_cumulated_count(member_id, coupon, count, member_id in with_cumul)
+            credited.append((count, [member_id]))
+            heaps = get_heap_crossing(before, after, coupon.heap_size)
+            if member_id in summaries:
+                summary_deltas.setdefault((count, heaps), []).append(member_id)
+            else:
+                new_summary_list.append(CouponSummary(service=service, member_id=member_id, count=count,
+                                                      heaps_reached=heaps, threshold_reached=heaps > 0))
+            entry_list.append(CouponLedgerEntry(member_id=member_id, coupon=coupon, count=count,
+                                                source=CouponUse.DONATION, object_id=object_id))
+        for (count, heaps), member_ids in summary_deltas.items():
+            if heaps > 0:
+                summary_qs.filter(member__in=member_ids)\
+                    .update(count=F('count') + count, heaps_reached=F('heaps_reached') + heaps, threshold_reached=True)
+            else:
+                summary_qs.filter(member__in=member_ids).update(count=F('count') + count)
+            summarized.append((count, heaps, member_ids))
+        if new_summary_list:
+            CouponSummary.objects.using(UMBRELLA).bulk_create(new_summary_list)
+            for summary in new_summary_list:
+                summarized.append((summary.count, summary.heaps_reached, [summary.member_id]))
+        CouponLedgerEntry.objects.using(UMBRELLA).bulk_create(entry_list)
+    except:
+        for count, member_ids in credited:
+            cumul_qs.filter(member__in=member_ids).update(count=F('count') - count)
+        for count, heaps, member_ids in summarized:
+            summary_qs.filter(member__in=member_ids)\
+                .update(count=F('count') - count, heaps_reached=F('heaps_reached') - heaps)
+        CumulatedCoupon.objects.using(UMBRELLA).filter(member=donor, coupon=coupon).update(count=F('count') + total)
+        CouponLedgerEntry.objects.using(UMBRELLA).create(member=donor, coupon=coupon, count=total,
+                                                         source=CouponLedgerEntry.REVERSAL, object_id=object_id)
+        coupon_use.delete()
+        raise
+    count_rows(len(new_profile_list) + 3 * len(counts))
+    shift_coupon_summary(service, donor, -total, get_heap_crossing(donor_before, donor_after, coupon.heap_size))
+    return total
+
+
+def is_coupon_ledger_opened(coupon):
+    return Coupon.objects.using(UMBRELLA).filter(pk=coupon.id, ledger_opened_on__isnull=False).exists()
+
+
+def open_coupon_ledger(coupon):
+    """
+    Writes an Opening CouponLedgerEntry for each CumulatedCoupon of a Coupon
+    created before the ledger existed, so that the ledger accounts for their
+    current count. Entries logged since the ledger was deployed are part of
+    the count, so the opening is the count minus the balance of those entries.
+    The Coupon is then marked opened and left untouched by later runs.
+
+    Meant to be run once per Coupon right after deploying the ledger, with
+    manage.py open_coupon_ledger. An interrupted run can be run again.
+
+    :return: number of Opening entries written
+    """
+    if is_coupon_ledger_opened(coupon):
+        return 0
+    opened_on = datetime.now()
+    entry_count = 0
+    cumul_qs = CumulatedCoupon.objects.using(UMBRELLA).filter(coupon=coupon)
+    for cumul_list in iter_keyset_chunks(cumul_qs, fields=('member', 'count')):
+        balances = get_ledger_balances(coupon, [cumul.member_id for cumul in cumul_list])
+        entry_list = [CouponLedgerEntry(member_id=cumul.member_id, coupon=coupon,
+                                        count=cumul.count - balances[cumul.member_id],
+                                        source=CouponLedgerEntry.OPENING)
+                      for cumul in cumul_list if cumul.count != balances[cumul.member_id]]
+        if entry_list:
+            CouponLedgerEntry.objects.using(UMBRELLA).bulk_create(entry_list)
+            entry_count += len(entry_list)
+    Coupon.objects.using(UMBRELLA).filter(pk=coupon.id).update(ledger_opened_on=opened_on)
+    return entry_count
+
+
+def get_latest_snapshots(coupon, member_ids, at=None):
+    """
+    :return: dict of the latest CouponBalanceSnapshot taken until *at*
+        of each of the Members having one, keyed by member_id.
+    """
+    snapshot_qs = CouponBalanceSnapshot.objects.using(UMBRELLA).filter(coupon=coupon, member__in=member_ids)
+    if at:
+        snapshot_qs = snapshot_qs.filter(taken_on__lte=at)
+    snapshots = {}
+    for snapshot in snapshot_qs.order_by('taken_on'):
+        snapshots[snapshot.member_id] = snapshot
+    return snapshots
+
+
+def get_ledger_balances(coupon, member_ids, at=None):
+    """
+    Computes the balances of Members on a Coupon from the ledger, as their
+    latest snapshot plus the entries created after it, until *at* if given.
+    This costs two queries whatever the number of Members.
+
+    :return: dict of balances keyed by member_id
+    """
+    member_ids = list(set(member_ids))
+    snapshots = get_latest_snapshots(coupon, member_ids, at)
+    balances = dict([(member_id, snapshots[member_id].balance if member_id in snapshots else 0)
+                     for member_id in member_ids])
+    entry_qs = CouponLedgerEntry.objects.using(UMBRELLA).filter(coupon=coupon, member__in=member_ids)
+    if snapshots and len(snapshots) == len(member_ids):
+        # Entries older than all snapshots are already included in them
+        entry_qs = entry_qs.filter(created_on__gt=min([snapshot.taken_on for snapshot in snapshots.values()]))
+    if at:
+        entry_qs = entry_qs.filter(created_on__lte=at)
+    for entry in entry_qs.only('member', 'count', 'created_on'):
+        snapshot = snapshots.get(entry.member_id)
+        if snapshot and entry.created_on <= snapshot.taken_on:
+            continue
+        balances[entry.member_id] += entry.count
+    return balances
+
+
+def get_coupon_balance(member, coupon, at=None):
+    """
+    Balance of a Member on a Coupon according to the ledger,
+    now or at a point in time *at*.
+    """
+    return get_ledger_balances(coupon, [member.id], at)[member.id]
+
+
+@instrument()
+def take_balance_snapshots(coupon, until=None):
+    """
+    Materializes the balances of the Members having ledger entries on a
+    Coupon since the previous snapshots. Only entries older than
+    CR_LEDGER_SETTLE_DELAY seconds are folded in, so that entries still
+    being written when the snapshots are taken cannot be missed.
+    """
+    settle_delay = getattr(settings, 'CR_LEDGER_SETTLE_DELAY', 60)
+    until = until or datetime.now() - timedelta(seconds=settle_delay)
+    snapshot_qs = CouponBalanceSnapshot.objects.using(UMBRELLA).filter(coupon=coupon, taken_on__lt=until)
+    try:
+        since = snapshot_qs.order_by('-taken_on')[0].taken_on
+    except IndexError:
+        since = None
+    entry_qs = CouponLedgerEntry.objects.using(UMBRELLA).filter(coupon=coupon, created_on__lte=until)
+    if since:
+        entry_qs = entry_qs.filter(created_on__gt=since)
+    member_ids = list(set([entry.member_id for entry in iter_keyset(entry_qs, fields=('member', ))]))
+    for i in range(0, len(member_ids), 500):
+        chunk = member_ids[i:i + 500]
+        balances = get_ledger_balances(coupon, chunk, until)
+        snapshot_list = [CouponBalanceSnapshot(member_id=member_id, coupon=coupon, balance=balance, taken_on=until)
+                         for member_id, balance in balances.items()]
+        CouponBalanceSnapshot.objects.using(UMBRELLA).bulk_create(snapshot_list)
+        count_rows(len(snapshot_list))
 
-    CRProfile.objects.using(db).get_or_create(member=receiver)
-    receiver_cumul, update = CumulatedCoupon.objects.using(UMBRELLA).get_or_create(member=receiver, coupon=coupon)
-    receiver_cumul.count += count
-    receiver_cumul.save()
 
-    receiver_summary, update = CouponSummary.objects.using(UMBRELLA).get_or_create(service=service, member=receiver)
-    receiver_summary.count += count
-    if receiver_cumul.count >= coupon.heap_size:
-        receiver_summary.threshold_reached = True
-    receiver_summary.save()
+@instrument()
+def verify_coupon_balances(coupon, fix=False):
+    """
+    Compares the CumulatedCoupon.count of all Members on a Coupon
+    with their balance according to the ledger.
 
+    :param fix: If True, mismatching counts are set to the ledger balance
+    :return: list of tuples (member_id, count, ledger_balance) of mismatches
+    :raise: ValueError if fix is True and the ledger of the Coupon is not
+        opened, as counts held before the ledger existed would be lost.
+    """
+    if fix and not is_coupon_ledger_opened(coupon):
+        raise ValueError("Ledger of coupon %s is not opened. Run manage.py open_coupon_ledger first." % coupon.id)
+    mismatch_list = []
+    cumul_qs = CumulatedCoupon.objects.using(UMBRELLA).filter(coupon=coupon)
+    for cumul_list in iter_keyset_chunks(cumul_qs, fields=('member', 'count')):
+        balances = get_ledger_balances(coupon, [cumul.member_id for cumul in cumul_list])
+        for cumul in cumul_list:
+            if cumul.count != balances[cumul.member_id]:
+                mismatch_list.append((cumul.member_id, cumul.count, balances[cumul.member_id]))
+                if fix:
+                    CumulatedCoupon.objects.using(UMBRELLA).filter(pk=cumul.pk)\
+                        .update(count=balances[cumul.member_id])
+                    count_rows(1)
+    return mismatch_list
 
+
+@instrument()
 def get_coupon_summary_list(member):
     member_services = member.get_services()
-    active_operators = CROperatorProfile.objects.filter(service__in=member_services, is_active=True)
-    active_cr_services = [op.service for op in active_operators]
+    active_cr_services = [service for service in member_services if get_active_operator_profile(service)]
     coupon_summary_list = member.couponsummary_set.filter(service__in=active_cr_services)
     return coupon_summary_list
 
@@ -235,27 +1426,13 @@ def get_coupon_summary_list(member):
 def get_join_reward_pack_list(revival=None, service=None):
     if revival:
         service = revival.service
-    reward_pack_list = []
-    for coupon in Coupon.objects.using(UMBRELLA).filter(service=service, is_active=True, status=Coupon.APPROVED):
-        try:
-            reward_pack = JoinRewardPack.objects.using(UMBRELLA).select_related('service', 'coupon')\
-                .get(service=service, coupon=coupon)
-            if reward_pack.count > 0:
-                reward_pack_list.append(reward_pack)
-        except JoinRewardPack.DoesNotExist:
-            continue
+    reward_pack_list = [pack for pack in get_reward_rules(service, Reward.JOIN)
+                        if pack.coupon.is_active and pack.coupon.status == Coupon.APPROVED]
     return {'reward_pack_list': reward_pack_list}
 
 
 def get_referral_reward_pack_list(revival):
     service = revival.service
-    reward_pack_list = []
-    for coupon in Coupon.objects.using(UMBRELLA).filter(service=service, is_active=True, status=Coupon.APPROVED):
-        try:
-            reward_pack = ReferralRewardPack.objects.using(UMBRELLA).select_related('service', 'coupon')\
-                .get(service=service, coupon=coupon)
-            if reward_pack.count > 0:
-                reward_pack_list.append(reward_pack)
-        except ReferralRewardPack.DoesNotExist:
-            continue
+    reward_pack_list = [pack for pack in get_reward_rules(service, Reward.REFERRAL)
+                        if pack.coupon.is_active and pack.coupon.status == Coupon.APPROVED]
     return {'reward_pack_list': reward_pack_list}
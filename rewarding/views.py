@@ -1,4 +1,5 @@
 import json
+from copy import copy
 
 from datetime import datetime, timedelta
 
@@ -9,11 +10,12 @@ from django.conf import settings
 from django.contrib import messages
 from django.core.files import File
 from django.core.urlresolvers import reverse
-from django.http.response import HttpResponse, HttpResponseRedirect, Http404
+from django.http.response import HttpResponse, HttpResponseRedirect, Http404, HttpResponseForbidden
 from django.shortcuts import render
 from django.template import Context
 from django.template.defaultfilters import slugify
 from django.template.loader import get_template
+from django.utils.crypto import constant_time_compare
 from django.utils.decorators import method_decorator
 from django.views.generic import TemplateView, DetailView
 from django.utils.translation import ugettext as _
@@ -25,10 +27,11 @@ from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.core.views import ChangeObjectBase
 from ikwen.revival.models import Revival, ProfileTag
 from ikwen.rewarding.models import Coupon, JoinRewardPack, PaymentRewardPack, CRBillingPlan, CROperatorProfile, \
-    CouponWinner, Reward, ReferralRewardPack, WELCOME_REWARD_OFFERED, FREE_REWARD_OFFERED, REFERRAL_REWARD_OFFERED
+    CouponWinner, Reward, ReferralRewardPack, WELCOME_REWARD_OFFERED, FREE_REWARD_OFFERED, REFERRAL_REWARD_OFFERED, \
+    bump_coupon_catalogue_version
 from ikwen.rewarding.admin import CouponAdmin
 
-from ikwen.rewarding.utils import REFERRAL
+from ikwen.rewarding.utils import REFERRAL, get_coupon_catalogue, get_metrics, instrument_view
 
 CONTINUOUS_REWARDING = 'Continuous Rewarding'
 
@@ -43,36 +46,28 @@ class Configuration(TemplateView):
     def get_context_data(self, **kwargs):
         context = super(Configuration, self).get_context_data(**kwargs)
         service = get_service_instance()
-        dc_coupon_list = Coupon.objects.using(UMBRELLA).filter(service=service, type=Coupon.DISCOUNT, deleted=False)
-        po_coupon_list = Coupon.objects.using(UMBRELLA).filter(service=service, type=Coupon.PURCHASE_ORDER, deleted=False)
-        gift_coupon_list = Coupon.objects.using(UMBRELLA).filter(service=service, type=Coupon.GIFT, deleted=False)
+        catalogue = get_coupon_catalogue(service)
+        coupon_list = sorted(catalogue['coupons'].values(), key=lambda coupon: coupon.id)
+        dc_coupon_list = [coupon for coupon in coupon_list if coupon.type == Coupon.DISCOUNT]
+        po_coupon_list = [coupon for coupon in coupon_list if coupon.type == Coupon.PURCHASE_ORDER]
+        gift_coupon_list = [coupon for coupon in coupon_list if coupon.type == Coupon.GIFT]
         context['plan_list'] = CRBillingPlan.objects.using(UMBRELLA).filter(is_active=True)
         payment_interval_list = []
-        bound_list = set()
-        for reward in PaymentRewardPack.objects.using(UMBRELLA).filter(service=service).order_by('floor'):
-            bound_list.add((reward.floor, reward.ceiling))
+        payment_rewards = {}
+        for reward in catalogue['packs'][Reward.PAYMENT]:
+            payment_rewards[(reward.floor, reward.ceiling, reward.coupon_id)] = reward
+        bound_list = set([(floor, ceiling) for floor, ceiling, coupon_id in payment_rewards.keys()])
         for item in bound_list:
             floor, ceiling = item[0], item[1]
             interval = {'floor': floor, 'ceiling': ceiling}
-
-            coupon_list = []
-            for coupon in Coupon.objects.using(UMBRELLA).filter(service=service, type=Coupon.DISCOUNT, deleted=False):
-                coupon.payment_reward = coupon.get_payment_reward_pack(floor, ceiling)
-                coupon_list.append(coupon)
-            interval['dc_coupon_list'] = coupon_list
-
-            coupon_list = []
-            for coupon in Coupon.objects.using(UMBRELLA).filter(service=service, type=Coupon.PURCHASE_ORDER, deleted=False):
-                coupon.payment_reward = coupon.get_payment_reward_pack(floor, ceiling)
-                coupon_list.append(coupon)
-            interval['po_coupon_list'] = coupon_list
-
-            coupon_list = []
-            for coupon in Coupon.objects.using(UMBRELLA).filter(service=service, type=Coupon.GIFT, deleted=False):
-                coupon.payment_reward = coupon.get_payment_reward_pack(floor, ceiling)
-                coupon_list.append(coupon)
-            interval['gift_coupon_list'] = coupon_list
-
+            for key, type_coupon_list in (('dc_coupon_list', dc_coupon_list), ('po_coupon_list', po_coupon_list),
+                                          ('gift_coupon_list', gift_coupon_list)):
+                coupon_list = []
+                for coupon in type_coupon_list:
+                    coupon = copy(coupon)  # Each interval gets its own payment_reward
+                    coupon.payment_reward = payment_rewards.get((floor, ceiling, coupon.id))
+                    coupon_list.append(coupon)
+                interval[key] = coupon_list
             payment_interval_list.append(interval)
 
         context['dc_coupon_list'] = dc_coupon_list
@@ -94,6 +89,7 @@ class Configuration(TemplateView):
         return super(Configuration, self).get(request, *args, **kwargs)
 
     @method_decorator(csrf_exempt)
+    @instrument_view
     def dispatch(self, request, *args, **kwargs):
         return super(Configuration, self).dispatch(request, *args, **kwargs)
 
@@ -186,6 +182,7 @@ class Configuration(TemplateView):
 
         # Delete all previous set PurchaseRewards ...
         PaymentRewardPack.objects.using(UMBRELLA).filter(service=service_umbrella).delete()
+        bump_coupon_catalogue_version(service_umbrella.id)
 
         # Check to make sure intervals do not overlap
         intervals = rewards['payment']
@@ -215,6 +212,7 @@ class Configuration(TemplateView):
                 count = int(reward['count'])
                 PaymentRewardPack.objects.using(UMBRELLA).create(service=service_umbrella, coupon=coupon,
                                                                  floor=floor, ceiling=ceiling, count=count)
+        bump_coupon_catalogue_version(service_umbrella.id)
         return HttpResponse(json.dumps({'success': True}))
 
     def delete_coupon(self, request):
@@ -245,6 +243,10 @@ class ChangeCoupon(ChangeObjectBase):
     object_list_url = 'rewarding:configuration'
     template_name = 'rewarding/change_coupon.html'
 
+    @instrument_view
+    def dispatch(self, request, *args, **kwargs):
+        return super(ChangeCoupon, self).dispatch(request, *args, **kwargs)
+
     def get_object(self, **kwargs):
         object_id = kwargs.get('object_id')
         if object_id:
@@ -362,6 +364,25 @@ class CouponDetail(DetailView):
         return HttpResponse(json.dumps(coupon.to_dict()), content_type='application/json')
 
 
+def render_metrics(request):
+    """
+    Returns the metrics of the rewarding instruments of this
+    process as JSON. They are collected if CR_METRICS_REGISTRY is True.
+
+    Meant for monitoring tools rather than users, so access is granted either
+    to a client passing CR_METRICS_TOKEN in the X-Metrics-Token header or the
+    token GET parameter, or to one whose address is in CR_METRICS_ALLOWED_IPS.
+    Access is denied to all if none of those settings is set.
+    """
+    token = getattr(settings, 'CR_METRICS_TOKEN', None)
+    allowed_ips = getattr(settings, 'CR_METRICS_ALLOWED_IPS', ())
+    client_token = request.META.get('HTTP_X_METRICS_TOKEN', request.GET.get('token', ''))
+    if not (token and constant_time_compare(client_token, token)) \
+            and request.META.get('REMOTE_ADDR') not in allowed_ips:
+        return HttpResponseForbidden()
+    return HttpResponse(json.dumps(get_metrics()), content_type='application/json')
+
+
 class CouponUploadBackend(DefaultUploadBackend):
 
     def upload_complete(self, request, filename, *args, **kwargs):